@@ -0,0 +1,331 @@
+"""access reads the QVs of single alignments, or of the alignments in a
+reference window, from a VQ encoded cmp.h5 without decoding the whole file.
+
+The AlnIndex is read once, and the Offset_begin and Offset_end of an
+alignment give the bases of its AlnGroup to decode. Bases are read in
+blocks, the HDF5 chunks of a VQ dataset or the Huffman blocks of a
+VQEntropy dataset, and the most recently used blocks of code indices are
+kept, so nearby queries don't read or decode them again. QVs are gathered
+from the code book one feature at a time, using the code book of its movie
+for an AlnGroup encoded with one.
+"""
+import collections
+import json
+import logging
+import numpy
+import sys
+import time
+
+from qv_compress import decode, entropy, quantize, utils
+
+h5py = utils.LazyModule('h5py')
+
+log = logging.getLogger('main')
+
+# Bases read at a time from a VQ dataset that isn't chunked
+ACCESS_BLOCK_SIZE = 2 ** 14
+DEFAULT_CACHE_BLOCKS = 64
+
+AlignmentQVs = collections.namedtuple(
+    'AlignmentQVs',
+    ['aln_id', 'aln_group_path', 'ref_group_id', 't_start', 't_end', 'qvs'])
+
+def parse_window(window):
+    """Parse a reference window written as ref:start-end.
+
+    Returns:
+        (ref, start, end), with ref a RefGroup ID if it's a number and a
+        RefGroup path or reference name otherwise
+    """
+
+    ref, _, positions = window.rpartition(':')
+    start, _, end = positions.partition('-')
+    if not ref or not end:
+        raise ValueError("Window {w} isn't of the form ref:start-end"
+                         .format(w=window))
+    if ref.isdigit():
+        ref = int(ref)
+    return ref, int(start), int(end)
+
+def feature_codes(raw_codes):
+    """Return the code values of a code book as a uint8 array with a row per
+    feature.
+    """
+
+    return numpy.ascontiguousarray(numpy.asarray(raw_codes).astype('uint8').T)
+
+class CmpH5QVReader(object):
+    """Random access to the QVs encoded in the VQ or VQEntropy datasets of
+    a cmp.h5.
+
+    Args:
+        filename: path to the encoded cmp.h5
+        code_book_filename: the code book the file was encoded with, or None
+            if the cmp.h5 holds its code book
+        cache_blocks: the number of blocks of code indices kept
+    """
+
+    def __init__(self, filename, code_book_filename=None,
+                 cache_blocks=DEFAULT_CACHE_BLOCKS):
+        self.cmph5_file = h5py.File(filename, 'r')
+        raw_codes, self.feature_list = decode.find_cmph5_code_book(
+            self.cmph5_file, code_book_filename)
+        # Each feature's code values are contiguous, so gathering a feature
+        # is a single take.
+        self._feature_codes = feature_codes(raw_codes)
+        self._aln_group_feature_codes = dict(
+            (k, feature_codes(v)) for k, v in
+            decode.cmph5_aln_group_code_books(
+                self.cmph5_file, code_book_filename).items())
+
+        aln_index = self.cmph5_file['AlnInfo/AlnIndex'][:].astype('int64')
+        self._aln_index = aln_index[numpy.argsort(aln_index[:, utils.ALN_ID],
+                                                  kind='mergesort')]
+        self._aln_ids = numpy.ascontiguousarray(
+            self._aln_index[:, utils.ALN_ID])
+        self._aln_group_paths = dict(zip(
+            self.cmph5_file['AlnGroup/ID'][:].tolist(),
+            [str(k) for k in self.cmph5_file['AlnGroup/Path']]))
+        self._ref_windows = {}
+
+        self._entropy_model = entropy.read_cmph5_model(self.cmph5_file)
+        if self._entropy_model is not None:
+            self._decode_table = entropy.make_decode_table(
+                self._entropy_model[0])
+        self._aln_groups = {}
+
+        self.cache_blocks = cache_blocks
+        self._blocks = collections.OrderedDict()
+
+    def close(self):
+        self.cmph5_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _aln_group(self, aln_group_path):
+        """Return the block size and the datasets needed to read the code
+        indices and DeletionTag runs of an AlnGroup, reading them the first
+        time it's used.
+        """
+
+        if aln_group_path in self._aln_groups:
+            return self._aln_groups[aln_group_path]
+
+        aln_group = self.cmph5_file[aln_group_path]
+        state = {}
+        if self._entropy_model is not None:
+            state['block_size'] = self._entropy_model[1]
+            state['packed'] = aln_group["VQEntropy"]
+            state['num_symbols'] = int(state['packed'].attrs["NumSymbols"])
+            state['block_offsets'] = (
+                aln_group["VQEntropyOffsets"][:].astype('int64'))
+        elif aln_group.get("VQ"):
+            state['vq'] = aln_group["VQ"]
+            state['block_size'] = (state['vq'].chunks or
+                                   (ACCESS_BLOCK_SIZE,))[0]
+        else:
+            raise ValueError("AlnGroup {a} has no VQ datasets"
+                             .format(a=aln_group_path))
+
+        if aln_group.get("DeletionTagRunValues"):
+            state['deltag_run_ends'] = numpy.cumsum(
+                aln_group["DeletionTagRunLengths"][:], dtype='int64')
+            state['deltag_run_values'] = aln_group["DeletionTagRunValues"][:]
+
+        self._aln_groups[aln_group_path] = state
+        return state
+
+    def _read_block(self, aln_group_path, block_i):
+        """Return the code indices of one block of an AlnGroup, from the
+        cache if it's there.
+        """
+
+        key = (aln_group_path, block_i)
+        block = self._blocks.pop(key, None)
+        if block is None:
+            state = self._aln_group(aln_group_path)
+            block_size = state['block_size']
+            start = block_i * block_size
+            if 'vq' in state:
+                block = state['vq'][start:start + block_size]
+            else:
+                offsets = state['block_offsets']
+                byte_end = (offsets[block_i + 1] if block_i + 1 < len(offsets)
+                            else len(state['packed']))
+                block = entropy.huffman_decode_block(
+                    state['packed'][offsets[block_i]:byte_end],
+                    min(state['num_symbols'] - start, block_size),
+                    self._entropy_model[0], self._decode_table)
+            if self._blocks and len(self._blocks) >= self.cache_blocks:
+                self._blocks.popitem(last=False)
+
+        self._blocks[key] = block
+        return block
+
+    def code_indices(self, aln_group_path, start, end):
+        """Return the code indices of bases start to end of an AlnGroup."""
+
+        block_size = self._aln_group(aln_group_path)['block_size']
+        if end <= start:
+            return numpy.empty(0, dtype='uint8')
+        first_block = start // block_size
+        last_block = (end - 1) // block_size
+        if first_block == last_block:
+            block_start = first_block * block_size
+            return self._read_block(aln_group_path, first_block)[
+                start - block_start:end - block_start]
+
+        blocks_start = first_block * block_size
+        return numpy.concatenate(
+            [self._read_block(aln_group_path, k)
+             for k in xrange(first_block, last_block + 1)])[
+                 start - blocks_start:end - blocks_start]
+
+    def _alignment_qvs(self, row):
+        """Decode the QVs of the alignment in a row of the sorted AlnIndex."""
+
+        aln_group_path = self._aln_group_paths[row[utils.ALN_GROUP_ID]]
+        start = row[utils.OFFSET_BEGIN]
+        end = row[utils.OFFSET_END]
+        code_indices = self.code_indices(aln_group_path, start, end)
+        codes = self._aln_group_feature_codes.get(aln_group_path,
+                                                  self._feature_codes)
+
+        qvs = collections.OrderedDict(
+            (feature_name, codes[feature_i].take(code_indices))
+            for feature_i, feature_name in enumerate(self.feature_list))
+        state = self._aln_group(aln_group_path)
+        if 'DeletionTag' in qvs and 'deltag_run_ends' in state:
+            qvs['DeletionTag'] = quantize.expand_runs(
+                state['deltag_run_ends'], state['deltag_run_values'], start,
+                end)
+
+        return AlignmentQVs(int(row[utils.ALN_ID]), aln_group_path,
+                            int(row[utils.REF_GROUP_ID]),
+                            int(row[utils.T_START]), int(row[utils.T_END]),
+                            qvs)
+
+    def alignment_qvs(self, aln_id):
+        """Decode the QVs of one alignment.
+
+        Returns:
+            an AlignmentQVs whose qvs is an OrderedDict of a uint8 array for
+            each feature of the code book
+
+        Raises:
+            KeyError: if there's no alignment with that AlnID
+        """
+
+        row_i = numpy.searchsorted(self._aln_ids, aln_id)
+        if row_i == len(self._aln_ids) or self._aln_ids[row_i] != aln_id:
+            raise KeyError("No alignment has AlnID {a}".format(a=aln_id))
+        return self._alignment_qvs(self._aln_index[row_i])
+
+    def ref_group_id(self, ref):
+        """Return the RefGroup ID of ref, which can be a RefGroup ID, a
+        RefGroup path with or without its leading '/', or the FullName of
+        its reference in RefInfo.
+        """
+
+        ref_group_ids = self.cmph5_file['RefGroup/ID'][:].tolist()
+        if isinstance(ref, (int, long)):
+            if ref not in ref_group_ids:
+                raise KeyError("No RefGroup has ID {r}".format(r=ref))
+            return ref
+
+        ref_group_paths = [str(k).lstrip('/')
+                           for k in self.cmph5_file['RefGroup/Path']]
+        if ref.lstrip('/') in ref_group_paths:
+            return ref_group_ids[ref_group_paths.index(ref.lstrip('/'))]
+
+        if ('RefInfo/FullName' in self.cmph5_file and
+                'RefGroup/RefInfoID' in self.cmph5_file):
+            ref_info_ids = dict(zip(
+                [str(k) for k in self.cmph5_file['RefInfo/FullName']],
+                self.cmph5_file['RefInfo/ID'][:].tolist()))
+            ref_group_ref_info_ids = (
+                self.cmph5_file['RefGroup/RefInfoID'][:].tolist())
+            if ref_info_ids.get(ref) in ref_group_ref_info_ids:
+                return ref_group_ids[
+                    ref_group_ref_info_ids.index(ref_info_ids[ref])]
+
+        raise KeyError("No reference is called {r}".format(r=ref))
+
+    def _ref_window_index(self, ref_group_id):
+        """Return the AlnIndex rows of a reference sorted by tStart, with
+        their tStarts and the longest alignment, computed the first time
+        the reference is queried.
+        """
+
+        if ref_group_id not in self._ref_windows:
+            rows = numpy.flatnonzero(
+                self._aln_index[:, utils.REF_GROUP_ID] == ref_group_id)
+            rows = rows[numpy.argsort(self._aln_index[rows, utils.T_START],
+                                      kind='mergesort')]
+            t_starts = self._aln_index[rows, utils.T_START]
+            max_length = int((self._aln_index[rows, utils.T_END] -
+                              t_starts).max()) if len(rows) else 0
+            self._ref_windows[ref_group_id] = rows, t_starts, max_length
+        return self._ref_windows[ref_group_id]
+
+    def window_qvs(self, ref, start, end):
+        """Decode the QVs of every alignment that overlaps positions start
+        to end of a reference. Whole alignments are returned, not just the
+        bases in the window.
+
+        Args:
+            ref: the reference, in any form ref_group_id takes
+
+        Returns:
+            a list of AlignmentQVs, in order of tStart
+        """
+
+        rows, t_starts, max_length = self._ref_window_index(
+            self.ref_group_id(ref))
+        first = numpy.searchsorted(t_starts, start - max_length, 'right')
+        last = numpy.searchsorted(t_starts, end, 'left')
+        return [self._alignment_qvs(self._aln_index[k])
+                for k in rows[first:last]
+                if self._aln_index[k, utils.T_END] > start]
+
+def alignment_qvs_to_json(alignment):
+    """Return a JSON line with the position and QVs of an AlignmentQVs."""
+
+    return json.dumps(collections.OrderedDict(
+        [('aln_id', alignment.aln_id),
+         ('aln_group_path', alignment.aln_group_path),
+         ('ref_group_id', alignment.ref_group_id),
+         ('t_start', alignment.t_start),
+         ('t_end', alignment.t_end)] +
+        [(k, v.tolist()) for k, v in alignment.qvs.items()]))
+
+def run_query(filename, code_book_filename=None, aln_ids=(), windows=(),
+              output_filename=utils.STREAM_FILENAME):
+    """Decode the QVs of the alignments with the AlnIDs in aln_ids and of
+    the alignments overlapping each (ref, start, end) in windows, and write
+    them as JSON lines.
+    """
+
+    with CmpH5QVReader(filename, code_book_filename) as reader:
+        start_time = time.time()
+        alignments = [reader.alignment_qvs(k) for k in aln_ids]
+        for ref, window_start, window_end in windows:
+            alignments.extend(reader.window_qvs(ref, window_start, window_end))
+        seconds = time.time() - start_time
+        log.debug("Decoded {n} alignments in {s:.2f} ms".format(
+            n=len(alignments), s=seconds * 1000))
+
+    if output_filename == utils.STREAM_FILENAME:
+        output_file = sys.stdout
+    else:
+        output_file = open(output_filename, 'w')
+    for alignment in alignments:
+        output_file.write(alignment_qvs_to_json(alignment) + '\n')
+    if output_file is not sys.stdout:
+        output_file.close()
+
+    return alignments
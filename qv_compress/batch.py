@@ -0,0 +1,199 @@
+"""batch encodes many cmp.h5, SAM, and BAM files in one run, with the code
+book loaded once and one pool of worker processes shared by all the files.
+
+Files are encoded one after another, and the chunks of each cmp.h5 and the
+shards of each BAM are spread over the pool, so a large file uses every
+worker. A file that fails to encode is logged and reported in the summary,
+and the rest of the batch carries on.
+"""
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from qv_compress import quantize
+
+log = logging.getLogger('main')
+
+def read_manifest(manifest_filename):
+    """Read the input files listed in a manifest, one per line. Blank lines
+    and lines starting with '#' are skipped, and relative paths are taken to
+    be relative to the directory of the manifest.
+    """
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_filename))
+    filenames = []
+    with open(manifest_filename) as manifest_file:
+        for line in manifest_file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                filenames.append(os.path.join(manifest_dir, line))
+    return filenames
+
+def expand_inputs(patterns, manifest_filename=None):
+    """Turn input filenames, glob patterns, and a manifest into a list of
+    input files, in the order given, each listed once.
+
+    Raises:
+        ValueError: if a glob pattern matches no files
+    """
+
+    filenames = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise ValueError("No files match {p}".format(p=pattern))
+            filenames.extend(matches)
+        else:
+            filenames.append(pattern)
+    if manifest_filename is not None:
+        filenames.extend(read_manifest(manifest_filename))
+
+    seen = set()
+    unique_filenames = []
+    for filename in filenames:
+        if filename not in seen:
+            seen.add(filename)
+            unique_filenames.append(filename)
+    return unique_filenames
+
+def batch_output_filename(filename, output_dir):
+    """Return the name of the encoded copy of filename in output_dir, or None
+    if there's no output_dir and a cmp.h5 is encoded in place.
+    """
+
+    if output_dir is None:
+        return None
+    return os.path.join(output_dir, os.path.basename(filename))
+
+def file_size(filename):
+    """The size of a file in bytes, or None if it doesn't exist."""
+
+    if filename is None or not os.path.exists(filename):
+        return None
+    return os.path.getsize(filename)
+
+def format_megabytes(num_bytes):
+    """Format a size in bytes as MB for the summary table."""
+
+    if num_bytes is None:
+        return "-"
+    return "{m:.1f}".format(m=num_bytes / 1024.0 ** 2)
+
+def encode_batch(filenames, code_book_filename, output_dir=None,
+                 overwrite_qvs=False, rle_deltag=False, lookup_table=False,
+                 workers=None, threads=1, pipeline=False, entropy_code=False,
+                 output_format=None, compression_level=None,
+                 compression='gzip', summary_json=None):
+    """Encode several files with one code book.
+
+    Args:
+        filenames: paths to the cmp.h5, SAM, and BAM files
+        code_book_filename: path to the code book produced by build_code_book
+        output_dir: directory where the encoded copy of each file is
+            written, under the same name. If None, cmp.h5 files are encoded
+            in place, and SAM and BAM files can't be encoded.
+        workers: the number of processes in the shared pool. Defaults to the
+            number of CPUs.
+        summary_json: write the result for each file to this JSON file
+        The other arguments are as for quantize.add_vqs_to_file.
+
+    Returns:
+        a list with a dict for each file, with its output filename, whether
+        it was encoded, the error if it wasn't, the seconds taken, and the
+        sizes of the input and output
+    """
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if output_dir is not None and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    raw_codes, feature_list, std_dev = quantize.load_code_book(
+        code_book_filename)
+    group_code_books = quantize.load_group_code_books(code_book_filename)
+
+    # Fork before any file is opened, so every file can use the pool.
+    pool = None
+    if workers > 1:
+        pool = quantize.make_encode_pool(workers, raw_codes, feature_list,
+                                         lookup_table, std_dev,
+                                         group_code_books, threads)
+
+    results = []
+    try:
+        for file_i, filename in enumerate(filenames):
+            output_filename = batch_output_filename(filename, output_dir)
+            log.info("Encoding {f} ({i} of {n})".format(
+                f=filename, i=file_i + 1, n=len(filenames)))
+
+            result = {'filename': filename,
+                      'output_filename': output_filename or filename,
+                      'input_bytes': file_size(filename),
+                      'error': None}
+            start_time = time.time()
+            try:
+                quantize.encode_file(
+                    filename, raw_codes, feature_list, std_dev, overwrite_qvs,
+                    rle_deltag, output_filename, lookup_table, workers,
+                    threads, pipeline, entropy_code, output_format,
+                    compression_level, compression, pool, group_code_books)
+                result['status'] = 'encoded'
+            except Exception as e:
+                log.error("Failed to encode {f}: {e}".format(f=filename, e=e))
+                log.debug("Traceback of the failure", exc_info=True)
+                result.update(status='failed', error=str(e))
+                # Don't leave a partial copy that looks like an encoded file.
+                # A cmp.h5 encoded in place picks up where it stopped when
+                # it's encoded again.
+                if output_filename is not None and os.path.exists(
+                        output_filename):
+                    os.remove(output_filename)
+
+            result['seconds'] = time.time() - start_time
+            result['output_bytes'] = file_size(result['output_filename'])
+            results.append(result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    log_batch_summary(results)
+    if summary_json is not None:
+        write_batch_summary(summary_json, results)
+    return results
+
+def log_batch_summary(results):
+    """Log a table of the results of encode_batch."""
+
+    log.info("status   seconds  input MB  output MB  file")
+    for result in results:
+        log.info("{s:7s}  {t:7.2f}  {i:8s}  {o:9s}  {f}".format(
+            s=result['status'], t=result['seconds'],
+            i=format_megabytes(result['input_bytes']),
+            o=format_megabytes(result['output_bytes']),
+            f=result['filename']))
+
+    num_failed = sum(1 for k in results if k['status'] == 'failed')
+    log.info("Encoded {e} of {n} files in {t:.2f} s".format(
+        e=len(results) - num_failed, n=len(results),
+        t=sum(k['seconds'] for k in results)))
+    for result in results:
+        if result['status'] == 'failed':
+            log.warning("{f} was not encoded: {e}".format(
+                f=result['filename'], e=result['error']))
+
+def write_batch_summary(output_filename, results):
+    """Write the results of encode_batch to a JSON file."""
+
+    batch_summary = {
+        'num_files': len(results),
+        'num_failed': sum(1 for k in results if k['status'] == 'failed'),
+        'seconds': sum(k['seconds'] for k in results),
+        'files': results}
+
+    with open(output_filename, 'w') as output_file:
+        json.dump(batch_summary, output_file, indent=2, sort_keys=True)
@@ -0,0 +1,223 @@
+"""benchmark contains methods for timing code book creation, encoding, and
+decoding on synthetic cmp.h5 and BAM files, and writing the results as JSON
+so they can be compared between versions.
+"""
+import json
+import logging
+import multiprocessing
+import numpy
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+from qv_compress import code_book, decode, quantize, synthetic, utils
+
+h5py = utils.LazyModule('h5py')
+pysam = utils.LazyModule('pysam')
+
+log = logging.getLogger('main')
+
+def _run_case(run, result_queue):
+    """Run a benchmark case in a child process and report its wall time and
+    peak RSS, including any worker processes it started.
+    """
+
+    start_time = time.time()
+    run()
+    seconds = time.time() - start_time
+    peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    result_queue.put((seconds, peak_rss_kb))
+
+def time_case(run):
+    """Run a function in a fresh process, so that its peak RSS isn't hidden by
+    earlier cases.
+
+    Returns:
+        seconds: the wall time of run
+        peak_rss_mb: the peak resident set size of the process, in MB
+    """
+
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case, args=(run, result_queue))
+    process.start()
+    seconds, peak_rss_kb = result_queue.get()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError, "Benchmark case exited with {e}".format(
+            e=process.exitcode)
+
+    return seconds, peak_rss_kb / 1024.0
+
+def environment():
+    """Describe the versions and machine the benchmarks ran on."""
+
+    return {'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'h5py': h5py.version.version,
+            'hdf5': h5py.version.hdf5_version,
+            'pysam': pysam.__version__,
+            'machine': platform.machine(),
+            'cpus': multiprocessing.cpu_count()}
+
+def run_benchmarks(output_filename, work_dir=None, num_aln_groups=4,
+                   num_reads=2000, read_length=1000, num_codes=32,
+                   num_observations=1000000, repeat=1, workers=1):
+    """Generate synthetic files and time the main qv_compress operations on
+    them.
+
+    Every case, and the setup before it, runs in its own process, so memory
+    used by one doesn't count towards the peak RSS of the next. Files are
+    copied before each run, outside the timing.
+
+    Args:
+        output_filename: path of the JSON results file
+        work_dir: directory for the synthetic files, created if it doesn't
+            exist. If None, a temporary directory is used and removed
+            afterwards.
+        num_aln_groups: the number of AlnGroups in the cmp.h5
+        num_reads: the number of reads in each AlnGroup, and in the BAM
+        read_length: the maximum read length
+        num_codes: the number of codes in the code book
+        num_observations: the number of bases used to build the code book
+        repeat: run each case this many times and keep the fastest
+        workers: number of processes passed to add_vqs_to_file
+
+    Returns:
+        the results, as written to output_filename
+    """
+
+    remove_work_dir = work_dir is None
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="qv_compress_benchmark")
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    def work_file(name):
+        return os.path.join(work_dir, name)
+
+    log.info("Writing synthetic files to {d}".format(d=work_dir))
+    cmph5_bases = synthetic.write_synthetic_cmph5(
+        work_file("base.cmp.h5"), num_aln_groups, num_reads, read_length)
+    bam_bases = synthetic.write_synthetic_sam(
+        work_file("base.bam"), num_reads, read_length)
+
+    def build_code_book():
+        raw_codes, feature_list, std_dev = code_book.create_code_book(
+            work_file("base.cmp.h5"), num_codes, num_observations)
+        code_book.write_code_book(work_file("code_book.npz"), raw_codes,
+                                  feature_list, std_dev)
+    time_case(build_code_book)
+
+    def copy_cmph5():
+        shutil.copy(work_file("base.cmp.h5"), work_file("run.cmp.h5"))
+
+    def encode_cmph5():
+        copy_cmph5()
+        quantize.add_vqs_to_file(work_file("run.cmp.h5"),
+                                 work_file("code_book.npz"), workers=workers)
+
+    def encode_bam():
+        quantize.add_vqs_to_file(work_file("base.bam"),
+                                 work_file("code_book.npz"),
+                                 output_filename=work_file("encoded.bam"),
+                                 workers=workers)
+
+    def no_setup():
+        pass
+
+    training_bases = min(num_observations, cmph5_bases)
+    cases = [
+        ("build_code_book_cmph5", no_setup, training_bases,
+         lambda: code_book.create_code_book(work_file("base.cmp.h5"),
+                                            num_codes, num_observations)),
+        ("build_code_book_bam", no_setup, min(num_observations, bam_bases),
+         lambda: code_book.create_code_book(work_file("base.bam"),
+                                            num_codes, num_observations)),
+        ("encode_cmph5", copy_cmph5, cmph5_bases,
+         lambda: quantize.add_vqs_to_file(work_file("run.cmp.h5"),
+                                          work_file("code_book.npz"),
+                                          workers=workers)),
+        ("encode_cmph5_overwrite_qvs", copy_cmph5, cmph5_bases,
+         lambda: quantize.add_vqs_to_file(work_file("run.cmp.h5"),
+                                          work_file("code_book.npz"),
+                                          overwrite_qvs=True, workers=workers)),
+        ("encode_cmph5_rle_deltag", copy_cmph5, cmph5_bases,
+         lambda: quantize.add_vqs_to_file(work_file("run.cmp.h5"),
+                                          work_file("code_book.npz"),
+                                          rle_deltag=True, workers=workers)),
+        ("encode_cmph5_compact", no_setup, cmph5_bases,
+         lambda: quantize.add_vqs_to_file(
+             work_file("base.cmp.h5"), work_file("code_book.npz"),
+             output_filename=work_file("compact.cmp.h5"), workers=workers)),
+        ("encode_bam", no_setup, bam_bases, encode_bam),
+        ("encode_bam_rle_deltag", no_setup, bam_bases,
+         lambda: quantize.add_vqs_to_file(work_file("base.bam"),
+                                          work_file("code_book.npz"),
+                                          rle_deltag=True,
+                                          output_filename=work_file("run.bam"),
+                                          workers=workers)),
+        ("decode_cmph5", encode_cmph5, cmph5_bases,
+         lambda: decode.decode_file(work_file("run.cmp.h5"),
+                                    work_file("code_book.npz"))),
+        ("decode_bam", encode_bam, bam_bases,
+         lambda: decode.decode_file(work_file("encoded.bam"),
+                                    output_filename=work_file("decoded.bam"))),
+    ]
+
+    results = []
+    for name, setup, num_bases, run in cases:
+        timings = []
+        for _ in xrange(repeat):
+            time_case(setup)
+            timings.append(time_case(run))
+        seconds = min(k[0] for k in timings)
+        peak_rss_mb = max(k[1] for k in timings)
+
+        results.append({'name': name,
+                        'bases': int(num_bases),
+                        'seconds': seconds,
+                        'bases_per_second': num_bases / seconds,
+                        'peak_rss_mb': peak_rss_mb})
+        log.info("{n}: {b:.0f} bases/sec, peak RSS {r:.1f} MB".format(
+            n=name, b=num_bases / seconds, r=peak_rss_mb))
+
+    if remove_work_dir:
+        shutil.rmtree(work_dir)
+
+    benchmark_results = {
+        'parameters': {'num_aln_groups': num_aln_groups,
+                       'num_reads': num_reads,
+                       'read_length': read_length,
+                       'num_codes': num_codes,
+                       'num_observations': num_observations,
+                       'repeat': repeat,
+                       'workers': workers},
+        'environment': environment(),
+        'results': results}
+
+    with open(output_filename, 'w') as output_file:
+        json.dump(benchmark_results, output_file, indent=2, sort_keys=True)
+
+    return benchmark_results
+
+def compare_benchmarks(baseline_filename, benchmark_results):
+    """Log the speed and memory of each case relative to an earlier results
+    file written by run_benchmarks.
+    """
+
+    baseline = dict((k['name'], k) for k in
+                    json.load(open(baseline_filename))['results'])
+
+    for result in benchmark_results['results']:
+        if result['name'] not in baseline:
+            continue
+        old_result = baseline[result['name']]
+        log.info("{n}: {s:.2f}x bases/sec, {r:.2f}x peak RSS vs {f}".format(
+            n=result['name'],
+            s=result['bases_per_second'] / old_result['bases_per_second'],
+            r=result['peak_rss_mb'] / old_result['peak_rss_mb'],
+            f=baseline_filename))
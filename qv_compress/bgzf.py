@@ -0,0 +1,199 @@
+"""bgzf contains methods for splitting a BAM file into shards at BGZF block
+boundaries without decompressing the records before them.
+
+A BAM is a series of BGZF blocks, each a gzip member of at most 64 KB of
+data that records its own compressed size, so block boundaries can be found
+by reading block headers alone. Records don't start at block boundaries, so
+the first record of a shard is found by decompressing a few blocks and
+checking that a chain of SYNC_RECORDS records parses from it.
+"""
+import os
+import struct
+import zlib
+
+BGZF_MAGIC = '\x1f\x8b\x08\x04'
+BGZF_HEADER_SIZE = 18
+# Bytes of each block header searched for at once when looking for a block
+BGZF_SEARCH_SIZE = 64 * 1024
+
+# Number of consecutive records that must parse from a position for it to be
+# taken as the start of a record
+SYNC_RECORDS = 8
+# Largest record size taken as plausible while looking for a record start
+MAX_RECORD_SIZE = 64 * 1024 ** 2
+
+# Fixed length part of a BAM record after block_size
+RECORD_FIXED_SIZE = 32
+RECORD_STRUCT = struct.Struct('<iiiBBHHHiiii')
+
+def block_size(header):
+    """Return the total size of the BGZF block whose first BGZF_HEADER_SIZE
+    bytes are header, or None if they aren't a BGZF block header.
+    """
+
+    if (len(header) < BGZF_HEADER_SIZE or header[:4] != BGZF_MAGIC or
+            header[10:14] != '\x06\x00BC' or header[14:16] != '\x02\x00'):
+        return None
+    return struct.unpack('<H', header[16:18])[0] + 1
+
+def next_block_offset(raw_file, offset):
+    """Return the offset of the first BGZF block that starts at or after
+    offset, or the size of the file if there's none.
+
+    A candidate header only counts if another block header, or the end of
+    the file, follows the block it starts.
+    """
+
+    file_size = os.fstat(raw_file.fileno()).st_size
+    while offset < file_size:
+        raw_file.seek(offset)
+        window = raw_file.read(BGZF_SEARCH_SIZE + BGZF_HEADER_SIZE)
+        position = window.find(BGZF_MAGIC)
+        while 0 <= position < BGZF_SEARCH_SIZE:
+            candidate = offset + position
+            raw_file.seek(candidate)
+            size = block_size(raw_file.read(BGZF_HEADER_SIZE))
+            if size is not None:
+                raw_file.seek(candidate + size)
+                if (candidate + size == file_size or
+                        block_size(raw_file.read(BGZF_HEADER_SIZE))):
+                    return candidate
+            position = window.find(BGZF_MAGIC, position + 1)
+        offset += BGZF_SEARCH_SIZE
+    return file_size
+
+def read_block(raw_file, offset):
+    """Decompress the BGZF block at offset.
+
+    Returns:
+        data: the decompressed data of the block
+        next_offset: the offset of the next block
+    """
+
+    raw_file.seek(offset)
+    size = block_size(raw_file.read(BGZF_HEADER_SIZE))
+    if size is None:
+        raise ValueError("No BGZF block at offset {o}".format(o=offset))
+    compressed = raw_file.read(size - BGZF_HEADER_SIZE)
+    return zlib.decompress(compressed[:-8], -15), offset + size
+
+def record_size(data, position, num_references):
+    """Return the size of the BAM record at position of data if its fields
+    are consistent, or None if they aren't.
+
+    data must hold the fixed fields and read name of the record, see
+    record_header_size.
+    """
+
+    (size, ref_id, pos, l_read_name, mapq, bin_mq, n_cigar_op, flag, l_seq,
+     next_ref_id, next_pos, tlen) = RECORD_STRUCT.unpack_from(data, position)
+
+    if (not -1 <= ref_id < num_references or
+            not -1 <= next_ref_id < num_references or
+            pos < -1 or next_pos < -1 or l_read_name < 1 or l_seq < 0 or
+            size > MAX_RECORD_SIZE or
+            size < (RECORD_FIXED_SIZE + l_read_name + 4 * n_cigar_op +
+                    (l_seq + 1) // 2 + l_seq)):
+        return None
+
+    name_start = position + 4 + RECORD_FIXED_SIZE
+    read_name = data[name_start:name_start + l_read_name]
+    if read_name[-1] != '\x00' or not all('!' <= k <= '~' and k != '@'
+                                          for k in read_name[:-1]):
+        return None
+    return size + 4
+
+def record_header_size(data, position):
+    """Return the number of bytes from position that record_size needs."""
+
+    return 4 + RECORD_FIXED_SIZE + ord(data[position + 12])
+
+class BlockReader(object):
+    """Decompressed data of consecutive BGZF blocks, read as it's needed."""
+
+    def __init__(self, raw_file, block_offset):
+        self.raw_file = raw_file
+        self.file_size = os.fstat(raw_file.fileno()).st_size
+        self.data, self.next_offset = read_block(raw_file, block_offset)
+
+    def ensure(self, num_bytes):
+        """Read blocks until there are num_bytes of data or the file ends.
+
+        Returns:
+            True if there are num_bytes of data
+        """
+
+        chunks = [self.data]
+        num_read = len(self.data)
+        while num_read < num_bytes and self.next_offset < self.file_size:
+            block_data, self.next_offset = read_block(self.raw_file,
+                                                      self.next_offset)
+            chunks.append(block_data)
+            num_read += len(block_data)
+        self.data = ''.join(chunks)
+        return len(self.data) >= num_bytes
+
+def is_record_chain(blocks, position, num_references):
+    """Whether SYNC_RECORDS records in a row parse from position of the data
+    of a BlockReader, or fewer that end exactly at the end of the file.
+    """
+
+    for record_i in xrange(SYNC_RECORDS):
+        if (not blocks.ensure(position + 4 + RECORD_FIXED_SIZE) or
+                not blocks.ensure(position +
+                                  record_header_size(blocks.data, position))):
+            return record_i > 0 and position == len(blocks.data)
+        size = record_size(blocks.data, position, num_references)
+        if size is None or not blocks.ensure(position + size):
+            return False
+        position += size
+    return True
+
+def find_record_start(raw_file, block_offset, end_offset, num_references):
+    """Find the first BAM record that starts in the blocks from block_offset
+    up to end_offset.
+
+    Args:
+        raw_file: the BAM file, opened in binary mode
+        block_offset: offset of a BGZF block
+        end_offset: offset of the first block that isn't searched
+        num_references: the number of references in the BAM header
+
+    Returns:
+        the virtual offset of the record, or None if no record starts in
+        those blocks
+    """
+
+    file_size = os.fstat(raw_file.fileno()).st_size
+    while block_offset < min(end_offset, file_size):
+        blocks = BlockReader(raw_file, block_offset)
+        first_block_size = len(blocks.data)
+        first_block_end = blocks.next_offset
+        for position in xrange(first_block_size):
+            if is_record_chain(blocks, position, num_references):
+                return (block_offset << 16) | position
+        block_offset = first_block_end
+    return None
+
+def shard_block_offsets(bam_filename, num_shards, first_offset=0):
+    """Split a BAM file into about num_shards shards of compressed bytes, at
+    BGZF block boundaries, using only block headers.
+
+    Args:
+        first_offset: no shard boundary is put before this offset, usually
+            the block after the one the header of the BAM ends in
+
+    Returns:
+        a list of block offsets, one per shard boundary and none for the
+        start of the first shard, in file order
+    """
+
+    file_size = os.path.getsize(bam_filename)
+    offsets = []
+    with open(bam_filename, 'rb') as raw_file:
+        for shard_i in xrange(1, num_shards):
+            offset = next_block_offset(
+                raw_file, max(file_size * shard_i // num_shards, first_offset))
+            if offset < file_size and (not offsets or offset > offsets[-1]):
+                offsets.append(offset)
+    return offsets
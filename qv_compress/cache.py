@@ -0,0 +1,187 @@
+"""cache keeps code books built by build_code_book in a directory, keyed by a
+fingerprint of the training file and the training parameters, so building
+the same code book again just loads it.
+
+The fingerprint is the size and mtime of the file and a hash of
+FINGERPRINT_BLOCKS blocks spread evenly through it, so it costs a few small
+reads however big the file is. Entries are binary code books, and the least
+recently used ones are removed when the directory grows past its size limit.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import zipfile
+
+from qv_compress import code_book, metrics, quantize, utils
+
+log = logging.getLogger('main')
+
+# Bump when a change to training makes earlier cached code books stale
+CACHE_VERSION = 3
+
+FINGERPRINT_BLOCKS = 16
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+DEFAULT_CACHE_SIZE_MB = 100
+
+# Environment variable that turns the cache on for every build_code_book
+CACHE_DIR_VARIABLE = 'QV_COMPRESS_CACHE_DIR'
+
+def file_fingerprint(filename):
+    """Return a hex digest of the size and mtime of a file and of
+    FINGERPRINT_BLOCKS blocks of it, the first and last included.
+    """
+
+    file_stat = os.stat(filename)
+    digest = hashlib.sha1()
+    digest.update("{s} {m!r}".format(s=file_stat.st_size,
+                                     m=file_stat.st_mtime))
+
+    last_block_start = max(file_stat.st_size - FINGERPRINT_BLOCK_SIZE, 0)
+    offsets = sorted(set(last_block_start * k // max(FINGERPRINT_BLOCKS - 1, 1)
+                         for k in xrange(FINGERPRINT_BLOCKS)))
+    with open(filename, 'rb') as input_file:
+        for offset in offsets:
+            input_file.seek(offset)
+            digest.update(input_file.read(FINGERPRINT_BLOCK_SIZE))
+
+    return digest.hexdigest()
+
+def cache_key(input_filename, parameters):
+    """Return the cache key of the code book built from input_filename with
+    the training parameters in the dict parameters.
+    """
+
+    digest = hashlib.sha1()
+    digest.update(file_fingerprint(input_filename))
+    digest.update(json.dumps(dict(parameters, cache_version=CACHE_VERSION),
+                             sort_keys=True))
+    return digest.hexdigest()
+
+class CodeBookCache(object):
+    """A directory of code books, named by their cache keys, that holds at
+    most max_bytes of them.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_SIZE_MB * 1024 ** 2):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        """Return the (raw_codes, feature_list, std_dev, group_code_books)
+        stored under key, or None if there isn't one.
+        """
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            raw_codes, feature_list, std_dev = quantize.load_code_book(path)
+            group_code_books = quantize.load_group_code_books(path)
+        except (IOError, KeyError, ValueError, zipfile.BadZipfile) as e:
+            log.warning("Removing unreadable cached code book {p}: {e}"
+                        .format(p=path, e=e))
+            os.remove(path)
+            return None
+
+        # The mtime of an entry is when it was last used
+        os.utime(path, None)
+        return raw_codes, feature_list, std_dev, group_code_books
+
+    def put(self, key, raw_codes, feature_list, std_dev,
+            group_code_books=None):
+        """Store a code book under key, then evict the least recently used
+        entries until the cache fits in max_bytes.
+        """
+
+        # Write to a temporary file and rename it, so readers never see a
+        # partly written entry. Its .tmp suffix keeps evict from removing it
+        # while it's written.
+        file_descriptor, temp_path = tempfile.mkstemp(suffix=".tmp",
+                                                      dir=self.cache_dir)
+        os.close(file_descriptor)
+        try:
+            code_book.write_code_book(temp_path, raw_codes, feature_list,
+                                      std_dev, group_code_books, binary=True)
+            os.rename(temp_path, self._path(key))
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        max_bytes.
+        """
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entry_stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, path))
+
+        total_bytes = sum(k[1] for k in entries)
+        for mtime, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            log.debug("Evicting cached code book {p}".format(p=path))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+def cached_create_code_book(cache_dir, max_bytes, input_filename,
+                            num_clusters, num_observations,
+                            feature_list=utils.QUIVER_FEATURES,
+                            algorithm="weighted",
+                            batch_size=code_book.MINIBATCH_SIZE,
+                            tol=code_book.MINIBATCH_TOL, sampling="head",
+                            threads=1, seed=None, group_by="none"):
+    """Return the code books code_book.create_code_books would build, from
+    the cache in cache_dir if they have been built before, and add them to
+    the cache otherwise.
+
+    The arguments after max_bytes are those of code_book.create_code_books.
+    threads isn't part of the key, since it doesn't change the code book.
+    """
+
+    cache = CodeBookCache(cache_dir, max_bytes)
+    with metrics.stage("code_book_cache"):
+        key = cache_key(input_filename, {
+            'num_clusters': num_clusters,
+            'num_observations': num_observations,
+            'feature_list': list(feature_list),
+            'algorithm': algorithm,
+            'batch_size': batch_size,
+            'tol': tol,
+            'sampling': sampling,
+            'seed': seed,
+            'group_by': group_by})
+        cached = cache.get(key)
+
+    if cached is not None:
+        log.info("Using cached code book {k}".format(k=key))
+        return cached
+
+    raw_codes, feature_list, std_dev, group_code_books = \
+        code_book.create_code_books(input_filename, num_clusters,
+                                    num_observations, feature_list, algorithm,
+                                    batch_size, tol, sampling, threads, seed,
+                                    group_by)
+    cache.put(key, raw_codes, feature_list, std_dev, group_code_books)
+    return raw_codes, feature_list, std_dev, group_code_books
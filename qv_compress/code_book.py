@@ -1,53 +1,99 @@
 """code_book contains methods for creating a QV code book from a cmp.h5 file."""
-import h5py
+import collections
 import logging
 import numpy
-import pysam
 
-from scipy.cluster import vq
-from qv_compress import utils
+from qv_compress import kmeans, metrics, utils
+
+h5py = utils.LazyModule('h5py')
+pysam = utils.LazyModule('pysam')
 
 log = logging.getLogger('main')
 
-def make_data_clusterable(training_array, feature_list, std_dev=None, remove_skips=True):
+MINIBATCH_SIZE = 100000
+MINIBATCH_TOL = 1e-3
+# Mini-batch k-means runs at least MINIBATCH_MIN_BATCHES batches, then stops
+# once its smoothed distortion hasn't improved by a fraction of tol for
+# MINIBATCH_PATIENCE batches in a row
+MINIBATCH_MIN_BATCHES = 20
+MINIBATCH_PATIENCE = 10
+# Weight of each batch in the exponentially weighted average distortion
+MINIBATCH_EWA_WEIGHT = 0.1
+# Number of bases sampled from the whole input to whiten a mini-batch
+# k-means streamed from the head of the file
+MINIBATCH_STD_DEV_SAMPLE = 1000000
+
+# Sampled bases are read from a cmp.h5 in blocks of this many bases
+SAMPLE_BLOCK_SIZE = 4096
+
+# Format version of binary code books written by write_code_book
+CODE_BOOK_VERSION = 1
+
+# Read groups or movies with fewer training bases than this get no code book
+# of their own, and are encoded with the default code book
+MIN_GROUP_OBSERVATIONS = 10000
+
+GROUP_BY = ("none", "read_group")
+
+def make_data_clusterable(training_array, feature_list, std_dev=None, remove_skips=True,
+                          weights=None):
     """Convert data to and from raw and clusterable states. The raw QVs
     have some attributes that will break clustering, so those have to be
     cleaned up before we pass anything to k-means. 
 
+    The result is the only copy made of the data. It's float32, and the
+    fixes and whitening are applied to it in place.
+
     Args:
         training_array: the numpy array output by read_from_cmph5
         feature_list: labels for columns of the training array
         std_dev: the standard deviation of each columns of training array,
             for whitening. If None, this is calculated from training_array
+        weights: the number of times each row of training_array was observed,
+            used when calculating std_dev. Only allowed when remove_skips is
+            False.
 
     Returns:
-        clusterable_array: the modified array that can now be clustered
+        clusterable_array: the modified float32 array that can now be
+            clustered
         std_dev: the standard deviations of columns
     """
     
-    # Fix the PacBio-specific problems
-    if remove_skips:
-        clusterable_array = utils.remove_deletions_and_skips(
-            training_array, feature_list.index("InsertionQV"))
-    else:
-        clusterable_array = numpy.array(training_array, copy=True)
+    with metrics.stage("make_data_clusterable", len(training_array)):
+        # Fix the PacBio-specific problems
+        if remove_skips:
+            training_array = utils.remove_deletions_and_skips(
+                training_array, feature_list.index("InsertionQV"))
+        clusterable_array = numpy.array(training_array, dtype='float32',
+                                        order='C')
 
-    if "DeletionTag" in feature_list:
-        utils.spread_tag(clusterable_array, feature_list.index('DeletionTag'),
-                        inverse=False)
+        if "DeletionTag" in feature_list:
+            utils.spread_tag(clusterable_array,
+                             feature_list.index('DeletionTag'), inverse=False)
 
-    if "MergeQV" in feature_list:
-        utils.fix_mergeqv(clusterable_array, feature_list.index('MergeQV'), 40)
+        if "MergeQV" in feature_list:
+            utils.fix_mergeqv(clusterable_array, feature_list.index('MergeQV'),
+                              40)
     
-    # Whiten, unless there's no variance in the column
-    if std_dev is None:
-        std_dev = numpy.std(clusterable_array, axis=0)
+        # Whiten, unless there's no variance in the column. The moments are
+        # taken a column at a time in float64, so no full size temporary
+        # arrays are made.
+        if std_dev is None:
+            std_dev = numpy.zeros(clusterable_array.shape[1])
+            for feature_i in xrange(clusterable_array.shape[1]):
+                column = clusterable_array[:, feature_i]
+                if weights is None:
+                    std_dev[feature_i] = numpy.std(column, dtype='float64')
+                else:
+                    mean = numpy.average(column, weights=weights)
+                    std_dev[feature_i] = numpy.sqrt(numpy.average(
+                        (column - mean) ** 2, weights=weights))
 
-    for i in range(len(std_dev)):
-        if std_dev[i] == 0:
-            std_dev[i] = 1
+        for i in range(len(std_dev)):
+            if std_dev[i] == 0:
+                std_dev[i] = 1
 
-    clusterable_array = clusterable_array / std_dev
+        clusterable_array /= numpy.asarray(std_dev, dtype='float32')
     return clusterable_array, std_dev
 
 def convert_to_raw(clusterable_array, feature_list, std_dev):
@@ -88,48 +134,626 @@ def read_cmph5(cmph5_filename, feature_list, num_observations):
     cmph5_file.close()
     log.debug("All required features present!")
 
-    training_array = numpy.concatenate(
-        [k.data for k in utils.cmph5_chunker(
-            cmph5_filename, feature_list, num_observations, num_observations)], axis=0)
-    
-    return training_array
+    cmph5_file = h5py.File(cmph5_filename, 'r')
+    training_array = numpy.empty((num_observations, len(feature_list)),
+                                 dtype='uint8', order='F')
+    num_read_bases = 0
+
+    for chunk_range in utils.cmph5_chunk_ranges(
+            cmph5_file, feature_list, num_observations, num_observations):
+        chunk_range = chunk_range._replace(aln_group_end=min(
+            chunk_range.aln_group_end,
+            chunk_range.aln_group_start + num_observations - num_read_bases))
+        utils.read_cmph5_chunk(cmph5_file, chunk_range, feature_list,
+                               out=training_array[num_read_bases:])
+        num_read_bases += (chunk_range.aln_group_end -
+                           chunk_range.aln_group_start)
+        if num_read_bases >= num_observations:
+            break
+
+    cmph5_file.close()
+    return training_array[:num_read_bases]
 
 def read_sam(sam_filename, feature_list, num_observations):
+    """Read training data from the start of a SAM or BAM file. Returns a
+    uint8 numpy array.
+    """
 
     sam_file = pysam.Samfile(sam_filename)
     num_read_bases = 0
 
-    training_array = numpy.zeros(shape=(num_observations, len(feature_list)))
+    training_array = numpy.empty((num_observations, len(feature_list)),
+                                 dtype='uint8')
     
     while num_read_bases < num_observations:
         try:
             sam_record = sam_file.next()
         except StopIteration:
             break
-        
+
+        num_record_bases = 0
         for index, feature_name in enumerate(feature_list):
-            values = sam_record.opt(utils.QUIVER_SAM_TAGS[feature_name])
-            if feature_name.endswith("Tag"):
-                numeric_values = [ord(k) for k in values]
-            else:
-                numeric_values = [utils.char_to_qv(k) for k in values]
-
-            training_array[
-                num_read_bases:min(num_read_bases + len(numeric_values), num_observations),
-                index] = numeric_values[:min(len(numeric_values), num_observations - num_read_bases)]
-        num_read_bases += len(numeric_values)
+            values = utils.sam_tag_to_array(
+                sam_record.opt(utils.QUIVER_SAM_TAGS[feature_name]),
+                feature_name)[:num_observations - num_read_bases]
+            training_array[num_read_bases:num_read_bases + len(values),
+                           index] = values
+            num_record_bases = len(values)
+        num_read_bases += num_record_bases
     
+    sam_file.close()
     if num_read_bases < num_observations:
         log.warning("Only read {n} QV observations, less than the requested {o}"
                     .format(n=num_read_bases, o=num_observations))
-        training.array.resize(new_shape=(num_read_bases, len(feature_list)))
 
+    return training_array[:num_read_bases]
+
+def allocate_samples(stratum_sizes, num_observations, stratified=False):
+    """Decide how many observations to sample from each stratum.
+
+    Args:
+        stratum_sizes: the number of bases in each stratum
+        num_observations: the total number of bases to sample
+        stratified: if True, take the same number from every stratum, with
+            the share of strata that are too small spread over the others.
+            If False, take bases uniformly from all the strata combined.
+
+    Returns:
+        numpy array with the number of bases to take from each stratum
+    """
+
+    stratum_sizes = numpy.asarray(stratum_sizes, dtype='int64')
+    num_observations = min(num_observations, stratum_sizes.sum())
+
+    if not stratified:
+        proportions = stratum_sizes / float(stratum_sizes.sum())
+        counts = numpy.minimum(numpy.random.multinomial(num_observations,
+                                                        proportions),
+                               stratum_sizes)
+    else:
+        counts = numpy.zeros(len(stratum_sizes), dtype='int64')
+
+    while counts.sum() < num_observations:
+        open_strata = numpy.nonzero(counts < stratum_sizes)[0]
+        share = max((num_observations - counts.sum()) // len(open_strata), 1)
+        for stratum_i in open_strata:
+            counts[stratum_i] = min(counts[stratum_i] + share,
+                                    stratum_sizes[stratum_i])
+            if counts.sum() == num_observations:
+                break
+
+    return counts
+
+def sample_indices(population_size, num_samples):
+    """Return num_samples distinct sorted indices from range(population_size),
+    without materializing the whole range when num_samples is small.
+    """
+
+    if num_samples * 2 > population_size:
+        return numpy.sort(numpy.random.permutation(population_size)[:num_samples])
+
+    indices = numpy.unique(numpy.random.randint(0, population_size, num_samples))
+    while len(indices) < num_samples:
+        indices = numpy.union1d(indices, numpy.random.randint(
+            0, population_size, num_samples - len(indices)))
+    return indices
+
+def sample_cmph5(cmph5_filename, feature_list, num_observations,
+                 stratified=False, aln_group_paths=None):
+    """Sample training data from across a whole cmp.h5 file.
+
+    Bases are picked uniformly from the whole file or, if stratified, evenly
+    from every AlnGroup. Only the SAMPLE_BLOCK_SIZE blocks that contain a
+    sampled base are read.
+
+    Args:
+        aln_group_paths: the AlnGroups to sample from. Defaults to all of
+            them.
+
+    Returns:
+        numpy array with one row per sampled base and one column per feature
+    """
+
+    cmph5_file = h5py.File(cmph5_filename, 'r')
+    if aln_group_paths is None:
+        aln_group_paths = cmph5_file['AlnGroup/Path'][:]
+    aln_group_lens = [len(cmph5_file[k][feature_list[0]])
+                      for k in aln_group_paths]
+    sample_counts = allocate_samples(aln_group_lens, num_observations,
+                                     stratified)
+
+    training_array = numpy.zeros((sample_counts.sum(), len(feature_list)),
+                                 dtype='uint8')
+    block_data = numpy.empty((SAMPLE_BLOCK_SIZE, len(feature_list)),
+                             dtype='uint8', order='F')
+    training_pos = 0
+
+    for aln_group_path, aln_group_len, sample_count in zip(
+            aln_group_paths, aln_group_lens, sample_counts):
+        indices = sample_indices(aln_group_len, sample_count)
+        blocks = numpy.unique(indices // SAMPLE_BLOCK_SIZE)
+
+        for block in blocks:
+            block_start = block * SAMPLE_BLOCK_SIZE
+            block_end = min(block_start + SAMPLE_BLOCK_SIZE, aln_group_len)
+            block_indices = indices[numpy.searchsorted(indices, block_start):
+                                    numpy.searchsorted(indices, block_end)]
+
+            cmph5_chunk = utils.read_cmph5_chunk(
+                cmph5_file,
+                utils.CmpH5Chunk(aln_group_path, block_start, block_end, None),
+                feature_list, out=block_data)
+            training_array[training_pos:training_pos + len(block_indices)] = \
+                cmph5_chunk.data[block_indices - block_start]
+            training_pos += len(block_indices)
+
+    cmph5_file.close()
+    return training_array
+
+def sample_sam(sam_filename, feature_list, num_observations, stratified=False):
+    """Sample training data from across a whole SAM or BAM file in one pass,
+    with reservoir sampling.
+
+    If stratified, keep a separate reservoir for each read group, each with
+    an equal share of num_observations.
+
+    Returns:
+        numpy array with one row per sampled base and one column per feature
+    """
+
+    reservoirs = sample_sam_read_groups(sam_filename, feature_list,
+                                        num_observations, stratified)
+    training_array = numpy.concatenate(reservoirs.values(), axis=0)
+    if len(training_array) < num_observations:
+        log.warning("Only sampled {n} QV observations, less than the requested "
+                    "{o}".format(n=len(training_array), o=num_observations))
     return training_array
 
+def sample_sam_read_groups(sam_filename, feature_list, num_observations,
+                           stratified=False, reservoir_size=None):
+    """Reservoir sample the bases of a SAM or BAM file, keeping a separate
+    reservoir for each read group if stratified.
+
+    Args:
+        reservoir_size: the number of bases sampled from each read group.
+            Defaults to an equal share of num_observations.
+
+    Returns:
+        an OrderedDict from read group ID, or None if not stratified or the
+        file has no read groups, to a numpy array of the bases sampled
+    """
+
+    sam_file = utils.open_sam_file(sam_filename)
+    read_groups = [k['ID'] for k in utils.sam_header_dict(sam_file).get('RG', [])]
+    if not stratified or not read_groups:
+        read_groups = [None]
+
+    if reservoir_size is None:
+        reservoir_size = num_observations // len(read_groups)
+    reservoirs = dict((k, numpy.zeros((reservoir_size, len(feature_list)),
+                                      dtype='uint8'))
+                      for k in read_groups)
+    num_seen = dict((k, 0) for k in read_groups)
+
+    for sam_chunk in utils.sam_chunker(sam_file, feature_list, MINIBATCH_SIZE):
+        if read_groups == [None]:
+            strata = {None: sam_chunk.data}
+        else:
+            record_read_groups = numpy.array(
+                [dict(k.tags).get('RG') for k in sam_chunk.records])
+            base_read_groups = numpy.repeat(record_read_groups,
+                                            numpy.diff(sam_chunk.offsets))
+            strata = dict((k, sam_chunk.data[base_read_groups == k])
+                          for k in read_groups)
+
+        for read_group, data in strata.items():
+            reservoir = reservoirs[read_group]
+            seen = num_seen[read_group]
+
+            # Fill the reservoir, then keep the i'th observation with
+            # probability reservoir_size / (i + 1), in a random slot.
+            num_to_fill = max(min(reservoir_size - seen, len(data)), 0)
+            reservoir[seen:seen + num_to_fill] = data[:num_to_fill]
+            slots = (numpy.random.random_sample(len(data) - num_to_fill) *
+                     numpy.arange(seen + num_to_fill + 1,
+                                  seen + len(data) + 1)).astype('int64')
+            kept = slots < reservoir_size
+            reservoir[slots[kept]] = data[num_to_fill:][kept]
+
+            num_seen[read_group] = seen + len(data)
+
+    sam_file.close()
+
+    return collections.OrderedDict(
+        (k, reservoirs[k][:num_seen[k]]) for k in read_groups)
 
+def read_training_array(input_filename, feature_list, num_observations,
+                        sampling="head"):
+    """Read training data from a cmp.h5, SAM, or BAM file.
+
+    Args:
+        sampling: "head" to take the first num_observations bases, "uniform"
+            to sample them uniformly from the whole file, or "stratified" to
+            sample evenly from every AlnGroup of a cmp.h5 or read group of a
+            SAM or BAM
+
+    Returns:
+        numpy array with one row per base and one column per feature
+    """
+
+    if input_filename.endswith(".cmp.h5"):
+        if sampling == "head":
+            return read_cmph5(input_filename, feature_list, num_observations)
+        return sample_cmph5(input_filename, feature_list, num_observations,
+                            stratified=(sampling == "stratified"))
+    elif input_filename.endswith(".sam") or input_filename.endswith(".bam"):
+        if sampling == "head":
+            return read_sam(input_filename, feature_list, num_observations)
+        return sample_sam(input_filename, feature_list, num_observations,
+                          stratified=(sampling == "stratified"))
+    else:
+        raise RuntimeError, "Input file must be SAM, BAM, or cmp.h5"
+
+def read_training_batches(input_filename, feature_list, num_observations,
+                          batch_size=MINIBATCH_SIZE):
+    """Generator function for reading training data from a cmp.h5, SAM, or BAM
+    file a batch at a time, so it never has to be held in memory at once.
+
+    Yields:
+        numpy arrays of at most batch_size rows, one column per feature, until
+        num_observations rows have been read or the file runs out
+    """
+
+    if input_filename.endswith(".cmp.h5"):
+        batches = (k.data for k in utils.cmph5_chunker(
+            input_filename, feature_list, batch_size, num_observations))
+    elif input_filename.endswith(".sam") or input_filename.endswith(".bam"):
+        batches = (k.data for k in utils.sam_chunker(
+            utils.open_sam_file(input_filename), feature_list, batch_size))
+    else:
+        raise RuntimeError, "Input file must be SAM, BAM, or cmp.h5"
+
+    num_read_bases = 0
+    for batch in batches:
+        batch = batch[:num_observations - num_read_bases]
+        num_read_bases += len(batch)
+        yield batch
+        if num_read_bases >= num_observations:
+            break
+
+def read_unique_training_rows(input_filename, feature_list, num_observations,
+                              batch_size=MINIBATCH_SIZE, sampling="head"):
+    """Read training data from a cmp.h5, SAM, or BAM file, drop deletions and
+    skips, and collapse it to the distinct QV tuples.
+
+    Returns:
+        unique_rows: uint8 numpy array of the distinct raw QV tuples
+        counts: the number of times each tuple was observed
+    """
+
+    if sampling == "head":
+        training_batches = read_training_batches(
+            input_filename, feature_list, num_observations, batch_size)
+    else:
+        training_batches = [read_training_array(
+            input_filename, feature_list, num_observations, sampling)]
+
+    insertion_index = list(feature_list).index("InsertionQV")
+    unique_rows, counts = utils.count_unique_rows(
+        (utils.remove_deletions_and_skips(k, insertion_index)
+         for k in training_batches), len(feature_list))
+    log.debug("Collapsed {n} observations to {u} distinct QV tuples"
+              .format(n=counts.sum(), u=len(unique_rows)))
+    return unique_rows, counts
+
+def minibatch_kmeans(training_batches,num_clusters, feature_list,
+                     tol=MINIBATCH_TOL, std_dev=None):
+    """Cluster a stream of training batches with mini-batch k-means.
+
+    Each batch is assigned to the current centers, and every center moves
+    toward the mean of its batch members with a learning rate of one over the
+    number of observations it has been assigned so far.
+
+    The distortion of each batch is measured before the centers are moved, so
+    it's a distortion on data the centers haven't been trained on, and is
+    smoothed with an exponentially weighted average. Training stops when the
+    average hasn't improved on its best by more than a fraction of tol for
+    MINIBATCH_PATIENCE batches, after at least MINIBATCH_MIN_BATCHES, or when
+    the batches run out.
+
+    Args:
+        training_batches: iterable of raw training arrays, as produced by
+            read_training_batches
+        num_clusters: the number of codes to create
+        feature_list: labels for the columns of the training arrays
+        tol: the relative improvement in the average distortion below which
+            a batch doesn't count as progress
+        std_dev: the standard deviations used to whiten every batch. If
+            None, they are taken from the first batch.
+
+    Returns:
+        code_book: the cluster centers, in whitened units
+        std_dev: the standard deviations used for whitening
+    """
+
+    code_book = None
+    counts = numpy.zeros(num_clusters)
+    num_batches = 0
+    ewa_distortion = None
+    best_distortion = None
+    num_no_improvement = 0
+
+    for training_batch in training_batches:
+        clusterable_batch, std_dev = make_data_clusterable(
+            training_batch, feature_list, std_dev=std_dev)
+        if len(clusterable_batch) == 0:
+            continue
+
+        if code_book is None:
+            initial_rows = numpy.random.choice(
+                len(clusterable_batch), num_clusters,
+                replace=len(clusterable_batch) < num_clusters)
+            code_book = clusterable_batch[initial_rows]
+
+        code_indices, distortions = kmeans.nearest_codes(clusterable_batch,
+                                                          code_book)
+
+        batch_counts = numpy.bincount(code_indices, minlength=num_clusters)
+        batch_sums = numpy.zeros(code_book.shape)
+        for feature_i in xrange(code_book.shape[1]):
+            batch_sums[:, feature_i] = numpy.bincount(
+                code_indices, weights=clusterable_batch[:, feature_i],
+                minlength=num_clusters)
+
+        counts += batch_counts
+        updated = batch_counts > 0
+        shift = ((batch_sums[updated] -
+                  batch_counts[updated, numpy.newaxis] * code_book[updated]) /
+                 counts[updated, numpy.newaxis])
+        code_book[updated] += shift
+        num_batches += 1
+
+        batch_distortion = float(distortions.mean())
+        if ewa_distortion is None:
+            ewa_distortion = batch_distortion
+        else:
+            ewa_distortion += MINIBATCH_EWA_WEIGHT * (batch_distortion -
+                                                      ewa_distortion)
+
+        if (best_distortion is None or
+                ewa_distortion < best_distortion * (1 - tol)):
+            best_distortion = ewa_distortion
+            num_no_improvement = 0
+        else:
+            num_no_improvement += 1
+
+        log.debug("Mini-batch {b}: mean distortion {d:.4f}, average "
+                  "distortion {e:.4f}".format(b=num_batches,
+                                              d=batch_distortion,
+                                              e=ewa_distortion))
+        if (num_batches >= MINIBATCH_MIN_BATCHES and
+                num_no_improvement >= MINIBATCH_PATIENCE):
+            log.debug("Mini-batch k-means converged after {b} batches"
+                      .format(b=num_batches))
+            break
+
+    if code_book is None:
+        raise ValueError("No training observations found in the input file")
+
+    return code_book, std_dev
+
+def weighted_kmeans(obs, weights, num_clusters, iter=kmeans.KMEANS_ITER,
+                    thresh=kmeans.KMEANS_THRESH, threads=1, seed=None):
+    """Run k-means on observations that each stand for weights[i] identical
+    observations. Like scipy.cluster.vq.kmeans, it runs iter times, stops
+    each run when the mean distortion improves by less than thresh, drops
+    codes with no members, and keeps the code book with the lowest
+    distortion. Distance searches are spread over threads, see
+    kmeans.kmeans.
+
+    Args:
+        obs: whitened numpy array of distinct observations
+        weights: the number of times each row of obs was observed
+        num_clusters: the number of codes to create
+        iter: the number of runs
+        thresh: convergence threshold for the change in distortion
+        threads: the number of threads, see kmeans.kmeans
+        seed: seed for a reproducible code book, or None
+
+    Returns:
+        code_book: the cluster centers
+        distortion: the weighted mean distance from observations to their
+            nearest center
+    """
+
+    return kmeans.kmeans(obs, num_clusters, weights, iter, thresh, threads,
+                         seed)
+
+def write_code_book(code_book_filename, raw_codes, feature_list, std_dev,
+                    group_code_books=None, binary=None):
+    """Save a code book produced by create_code_book.
+
+    If code_book_filename ends with .npz, the code book is saved in a binary
+    format that also holds the whitening used in training, so encoding
+    doesn't have to parse text and whitens every chunk the same way.
+    Otherwise it is saved as a CSV with the feature names in the header.
+
+    Args:
+        code_book_filename: path of the code book to write
+        raw_codes: a numpy array of code values. rows are codes, columns are
+            features
+        feature_list: labels for the columns of raw_codes
+        std_dev: the standard deviations used to whiten the training data
+        group_code_books: an OrderedDict from read group or movie name to
+            the (raw_codes, std_dev) of its own code book, as made by
+            create_group_code_books. They are stored alongside raw_codes,
+            which is the default code book, in a binary code book.
+        binary: whether to write the binary format. If None, it's written
+            when code_book_filename ends with .npz.
+    """
+
+    if binary is None:
+        binary = code_book_filename.endswith(".npz")
+
+    if not binary:
+        if group_code_books:
+            raise ValueError("Code books for read groups can only be written "
+                             "to a binary .npz code book")
+        numpy.savetxt(code_book_filename, raw_codes,
+                      header=','.join(feature_list), fmt='%2.0f', delimiter=',')
+        return
+
+    std_dev = numpy.array(std_dev, dtype='float64')
+
+    group_arrays = {}
+    if group_code_books:
+        group_arrays = {
+            'group_names': numpy.array(group_code_books.keys()),
+            'group_num_codes': numpy.array(
+                [len(k[0]) for k in group_code_books.values()],
+                dtype='int64'),
+            'group_raw_codes': numpy.concatenate(
+                [k[0] for k in group_code_books.values()]).astype('uint8'),
+            'group_std_devs': numpy.array(
+                [k[1] for k in group_code_books.values()], dtype='float64')}
+
+    # Pass savez a file, so it doesn't add .npz to the name
+    with open(code_book_filename, 'wb') as code_book_file:
+        numpy.savez(code_book_file, version=CODE_BOOK_VERSION,
+                    raw_codes=raw_codes.astype('uint8'),
+                    feature_list=numpy.array(feature_list),
+                    std_dev=std_dev, **group_arrays)
+
+def train_weighted_code_book(unique_rows, counts, num_clusters, feature_list,
+                             threads=1, seed=None):
+    """Whiten distinct QV tuples and cluster them with weighted_kmeans.
+
+    Returns:
+        raw_code_book: a numpy array of cluster centers, in raw QV units
+        std_dev: the standard deviations used to whiten the training data
+    """
+
+    clusterable_array, std_dev = make_data_clusterable(
+        unique_rows, feature_list, remove_skips=False, weights=counts)
+    with metrics.stage("weighted_kmeans", counts.sum()):
+        code_book, distortion = weighted_kmeans(clusterable_array, counts,
+                                                num_clusters,
+                                                threads=threads, seed=seed)
+    return convert_to_raw(code_book, feature_list, std_dev), std_dev
+
+def code_book_distortion(unique_rows, counts, raw_codes, feature_list,
+                         std_dev):
+    """The weighted mean distance from distinct QV tuples to their nearest
+    code, with both whitened by std_dev.
+    """
+
+    std_dev = numpy.array(std_dev, dtype='float64')
+    clusterable_array, std_dev = make_data_clusterable(
+        unique_rows, feature_list, std_dev=std_dev, remove_skips=False)
+    whitened_codes, std_dev = make_data_clusterable(
+        raw_codes, feature_list, std_dev=std_dev, remove_skips=False)
+    code_indices, distances = kmeans.nearest_codes(clusterable_array,
+                                                   whitened_codes)
+    return float(numpy.dot(counts, distances) / counts.sum())
+
+def read_group_training_arrays(input_filename, feature_list, num_observations):
+    """Sample up to num_observations training bases from every read group of
+    a SAM or BAM file, or from every movie of a cmp.h5.
+
+    Returns:
+        an OrderedDict from read group ID or movie name to a numpy array with
+        one row per sampled base and one column per feature
+    """
+
+    if input_filename.endswith(".cmp.h5"):
+        cmph5_file = h5py.File(input_filename, 'r')
+        aln_group_movies = utils.cmph5_aln_group_movies(cmph5_file)
+        cmph5_file.close()
+
+        movie_aln_groups = collections.OrderedDict()
+        for aln_group_path, movie_name in sorted(aln_group_movies.items(),
+                                                 key=lambda k: k[1]):
+            movie_aln_groups.setdefault(movie_name, []).append(aln_group_path)
+        return collections.OrderedDict(
+            (movie_name, sample_cmph5(input_filename, feature_list,
+                                      num_observations,
+                                      aln_group_paths=aln_group_paths))
+            for movie_name, aln_group_paths in movie_aln_groups.items())
+
+    elif input_filename.endswith(".sam") or input_filename.endswith(".bam"):
+        training_arrays = sample_sam_read_groups(
+            input_filename, feature_list, num_observations, stratified=True,
+            reservoir_size=num_observations)
+        training_arrays.pop(None, None)
+        return training_arrays
+
+    else:
+        raise RuntimeError, "Input file must be SAM, BAM, or cmp.h5"
+
+def create_group_code_books(input_filename, num_clusters, num_observations,
+                            feature_list=utils.QUIVER_FEATURES, threads=1,
+                            seed=None):
+    """Create a code book for each read group of a SAM or BAM file, or each
+    movie of a cmp.h5, and a default code book from all of them for the
+    rest. Code books are built with weighted k-means.
+
+    Read groups and movies with fewer than MIN_GROUP_OBSERVATIONS training
+    bases get no code book of their own.
+
+    Args:
+        num_observations: the number of bases sampled from each read group
+        The other arguments are as for create_code_book.
+
+    Returns:
+        code_book: the default code book
+        feature_list: labels for the columns of the code books
+        std_dev: the standard deviations used to whiten the default code
+            book's training data
+        group_code_books: an OrderedDict from read group ID or movie name to
+            the (raw_codes, std_dev) of its code book
+    """
+
+    if seed is not None:
+        numpy.random.seed(seed)
+
+    insertion_index = list(feature_list).index("InsertionQV")
+    training_arrays = collections.OrderedDict(
+        (k, utils.remove_deletions_and_skips(v, insertion_index))
+        for k, v in read_group_training_arrays(
+            input_filename, feature_list, num_observations).items())
+    group_rows = collections.OrderedDict(
+        (k, utils.count_unique_rows([v], len(feature_list)))
+        for k, v in training_arrays.items())
+
+    all_rows, all_counts = utils.count_unique_rows(training_arrays.values(),
+                                                   len(feature_list))
+    raw_codes, std_dev = train_weighted_code_book(
+        all_rows, all_counts, num_clusters, feature_list, threads, seed)
+
+    group_code_books = collections.OrderedDict()
+    for group_name, (rows, counts) in group_rows.items():
+        if counts.sum() < MIN_GROUP_OBSERVATIONS:
+            log.info("{g} has only {n} training bases, so it will use the "
+                     "default code book".format(g=group_name, n=counts.sum()))
+            continue
+
+        group_codes, group_std_dev = train_weighted_code_book(
+            rows, counts, num_clusters, feature_list, threads, seed)
+        group_code_books[group_name] = (group_codes, group_std_dev)
+        log.info("{g}: distortion {d:.4f} with its own code book and {e:.4f} "
+                 "with the default one".format(
+                     g=group_name,
+                     d=code_book_distortion(rows, counts, group_codes,
+                                            feature_list, group_std_dev),
+                     e=code_book_distortion(rows, counts, raw_codes,
+                                            feature_list, group_std_dev)))
+
+    return raw_codes, feature_list, std_dev, group_code_books
 
 def create_code_book(input_filename, num_clusters, num_observations,
-                     feature_list=utils.QUIVER_FEATURES):
+                     feature_list=utils.QUIVER_FEATURES, algorithm="weighted",
+                     batch_size=MINIBATCH_SIZE, tol=MINIBATCH_TOL,
+                     sampling="head", threads=1, seed=None):
     """Create a code book from a cmp.h5 file.
     
     Args:
@@ -139,26 +763,96 @@ def create_code_book(input_filename, num_clusters, num_observations,
             clusters
         feature_list: the list of features to read from the cmp.h5 to 
             cluster
+        algorithm: "weighted" to collapse the observations to distinct QV
+            tuples and cluster them with weighted_kmeans, "kmeans" to cluster
+            all observations in memory, or "minibatch" to stream
+            them through minibatch_kmeans
+        batch_size: the number of bases in each mini-batch
+        tol: convergence tolerance for mini-batch k-means
+        sampling: how training bases are picked, see read_training_array
+        threads: the number of k-means threads, see kmeans.kmeans
+        seed: seed for the training sample and initial codes, so the same
+            input gives the same code book. If None, they differ from run to
+            run.
 
     Returns:
         code_book: a numpy array of cluster centers. rows are codes, columns are
             features
         feature_list: labels for the columns of the code book
+        std_dev: the standard deviations used to whiten the training data
     """
 
     log.debug("Checking for missing features...")
-    
-    if input_filename.endswith(".cmp.h5"):
-        training_array = read_cmph5(input_filename, feature_list, num_observations)
-    elif input_filename.endswith(".sam") or input_filename.endswith(".bam"):
-        training_array = read_sam(input_filename, feature_list, num_observations)
-    else:
-        raise RuntimeError, "Input file must be SAM, BAM, or cmp.h5"
 
+    if seed is not None:
+        numpy.random.seed(seed)
+
+    if algorithm == "minibatch":
+        # Whiten with a sample of the whole input, since the first batch of
+        # the head of a file needn't look like the rest of it.
+        if sampling == "head":
+            std_dev_sample = read_training_array(
+                input_filename, feature_list,
+                min(num_observations, MINIBATCH_STD_DEV_SAMPLE), "uniform")
+            training_batches = read_training_batches(
+                input_filename, feature_list, num_observations, batch_size)
+        else:
+            training_array = read_training_array(
+                input_filename, feature_list, num_observations, sampling)
+            std_dev_sample = training_array
+            training_batches = (training_array[k:k + batch_size] for k in
+                                xrange(0, len(training_array), batch_size))
+        clusterable_sample, std_dev = make_data_clusterable(std_dev_sample,
+                                                            feature_list)
+        del std_dev_sample, clusterable_sample
+
+        with metrics.stage("minibatch_kmeans"):
+            code_book, std_dev = minibatch_kmeans(training_batches,
+                                                  num_clusters, feature_list,
+                                                  tol, std_dev)
+        raw_code_book = convert_to_raw(code_book, feature_list, std_dev)
+        return raw_code_book, feature_list, std_dev
+
+    if algorithm == "weighted":
+        unique_rows, counts = read_unique_training_rows(
+            input_filename, feature_list, num_observations, batch_size,
+            sampling)
+        raw_code_book, std_dev = train_weighted_code_book(
+            unique_rows, counts, num_clusters, feature_list, threads, seed)
+        return raw_code_book, feature_list, std_dev
+
+    training_array = read_training_array(input_filename, feature_list,
+                                         num_observations, sampling)
 
     clusterable_array, std_dev = make_data_clusterable(training_array,
                                                        feature_list)
-    code_book, distortion = vq.kmeans(clusterable_array, num_clusters)
+    with metrics.stage("kmeans", len(clusterable_array)):
+        code_book, distortion = kmeans.kmeans(clusterable_array, num_clusters,
+                                              threads=threads, seed=seed)
 
     raw_code_book = convert_to_raw(code_book, feature_list, std_dev)
-    return raw_code_book, feature_list
+    return raw_code_book, feature_list, std_dev
+
+def create_code_books(input_filename, num_clusters, num_observations,
+                      feature_list=utils.QUIVER_FEATURES, algorithm="weighted",
+                      batch_size=MINIBATCH_SIZE, tol=MINIBATCH_TOL,
+                      sampling="head", threads=1, seed=None, group_by="none"):
+    """Create a code book with create_code_book or, if group_by is
+    "read_group", code books for each read group with
+    create_group_code_books.
+
+    Returns:
+        code_book, feature_list, std_dev: as returned by create_code_book
+        group_code_books: an OrderedDict of the code books of read groups,
+            empty if group_by is "none"
+    """
+
+    if group_by == "read_group":
+        return create_group_code_books(input_filename, num_clusters,
+                                       num_observations, feature_list,
+                                       threads, seed)
+
+    raw_codes, feature_list, std_dev = create_code_book(
+        input_filename, num_clusters, num_observations, feature_list,
+        algorithm, batch_size, tol, sampling, threads, seed)
+    return raw_codes, feature_list, std_dev, collections.OrderedDict()
@@ -0,0 +1,374 @@
+"""decode contains methods for restoring QVs from the code book indices written
+by quantize.add_vqs_to_file.
+"""
+import json
+import logging
+import numpy
+import time
+
+from qv_compress import entropy, metrics, quantize, utils
+
+h5py = utils.LazyModule('h5py')
+
+log = logging.getLogger('main')
+
+
+def read_code_book_from_sam_header(header):
+    """Find the code book that quantize.add_vqs_to_file put in the @CO lines
+    of a SAM or BAM header.
+
+    Args:
+        header: the header of a SAM or BAM file, as a dict
+
+    Returns:
+        raw_codes: a numpy.array of the code values
+        code_book_features: a list of the names of features associated with
+                            columns of raw_codes
+        code_book_comments: the @CO lines that hold the code book
+    """
+
+    raw_codes = None
+    code_book_features = None
+    code_book_comments = []
+
+    for comment in header.get('CO', []):
+        try:
+            value = json.loads(comment)
+        except ValueError:
+            continue
+        if not isinstance(value, list) or not value:
+            continue
+
+        if all(isinstance(k, list) for k in value):
+            raw_codes = numpy.array(value, ndmin=2)
+            code_book_comments.append(comment)
+        elif all(isinstance(k, basestring) for k in value):
+            code_book_features = [str(k) for k in value]
+            code_book_comments.append(comment)
+
+    if raw_codes is None or code_book_features is None:
+        raise ValueError("SAM/BAM header does not contain a code book")
+
+    return raw_codes, code_book_features, code_book_comments
+
+def read_group_code_books_from_sam_header(header):
+    """Find the code books of read groups that
+    quantize.make_encoded_header put in the @CO lines of a SAM or BAM
+    header.
+
+    Returns:
+        group_codes: a dict from read group ID to the numpy.array of the code
+                     values of its code book
+        group_comments: the @CO lines that hold them
+    """
+
+    group_codes = {}
+    group_comments = []
+
+    for comment in header.get('CO', []):
+        try:
+            value = json.loads(comment)
+        except ValueError:
+            continue
+        if isinstance(value, dict) and 'VQReadGroup' in value:
+            group_codes[str(value['VQReadGroup'])] = numpy.array(
+                value['VQCodes'], ndmin=2)
+            group_comments.append(comment)
+
+    return group_codes, group_comments
+
+def stack_code_books(code_books):
+    """Stack code books into one uint8 array, padding the shorter ones with
+    zeros, so that codes of several code books are looked up in a single
+    take.
+    """
+
+    stacked = numpy.zeros((len(code_books), max(len(k) for k in code_books),
+                           code_books[0].shape[1]), dtype='uint8')
+    for code_book_i, codes in enumerate(code_books):
+        stacked[code_book_i, :len(codes)] = codes
+    return stacked
+
+def cmph5_aln_group_code_books(cmph5_file, code_book_filename=None):
+    """Find the code book each AlnGroup of a cmp.h5 was encoded with by
+    quantize.add_vqs_to_cmph5_by_movie, from its VQCodeBookGroup attribute.
+
+    Returns:
+        a dict from AlnGroup path to the numpy.array of the code values of
+        its code book, for the AlnGroups encoded with the code book of their
+        movie. It's empty if none were.
+
+    Raises:
+        ValueError: if an AlnGroup was encoded with a code book that isn't
+            in code_book_filename
+    """
+
+    group_code_books = {}
+    if code_book_filename is not None:
+        group_code_books = quantize.load_group_code_books(code_book_filename)
+
+    aln_group_codes = {}
+    for aln_group_path in cmph5_file['AlnGroup/Path']:
+        group_name = str(cmph5_file[aln_group_path].attrs.get(
+            "VQCodeBookGroup", ''))
+        if not group_name:
+            continue
+        if group_name not in group_code_books:
+            raise ValueError("{a} was encoded with the code book of {g}, "
+                             "which isn't in the code book file"
+                             .format(a=aln_group_path, g=group_name))
+        aln_group_codes[aln_group_path] = group_code_books[group_name][0]
+
+    return aln_group_codes
+
+def decode_code_indices(code_indices, raw_codes):
+    """Look up the code book values for an array of code indices.
+
+    Returns:
+        a uint8 numpy array with one row per index and one column per feature
+    """
+
+    with metrics.stage("decode", len(code_indices)):
+        return raw_codes.astype('uint8')[code_indices]
+
+def decode_cmph5_chunks(cmph5_filename, raw_codes, feature_list,
+                        chunk_size=quantize.BUFFER_SIZE, aln_group_codes=None):
+    """Generator function for reading through the VQ datasets of a cmp.h5
+    file and restoring the QVs they encode. If the file was entropy coded,
+    the VQEntropy datasets are decoded instead.
+
+    The AlnGroups in aln_group_codes, as returned by
+    cmph5_aln_group_code_books, are decoded with their own code books.
+
+    Yields:
+        utils.CmpH5Chunk tuples whose data is a uint8 array with one column
+        per feature in feature_list
+    """
+
+    cmph5_file = h5py.File(cmph5_filename, 'r')
+    entropy_model = entropy.read_cmph5_model(cmph5_file)
+    aln_group_codes = aln_group_codes or {}
+
+    if entropy_model is not None:
+        code_lengths, block_size = entropy_model
+        decode_table = entropy.make_decode_table(code_lengths)
+        for aln_group_path in cmph5_file['AlnGroup/Path']:
+            for start, code_indices in entropy.decode_cmph5_aln_group(
+                    cmph5_file[aln_group_path], code_lengths, block_size,
+                    chunk_size, decode_table):
+                yield utils.CmpH5Chunk(
+                    aln_group_path, start, start + len(code_indices),
+                    decode_code_indices(code_indices, aln_group_codes.get(
+                        aln_group_path, raw_codes)))
+        cmph5_file.close()
+        return
+
+    if not cmph5_file[cmph5_file['AlnGroup/Path'][0]].get("VQ"):
+        raise ValueError("Cmp.h5 file {c} has no VQ datasets"
+                         .format(c=cmph5_filename))
+
+    vq_data = numpy.empty((chunk_size, 1), dtype='uint8', order='F')
+
+    for chunk_range in utils.cmph5_chunk_ranges(cmph5_file, ["VQ"], chunk_size):
+        cmph5_chunk = utils.read_cmph5_chunk(cmph5_file, chunk_range, ["VQ"],
+                                             out=vq_data)
+        yield cmph5_chunk._replace(data=decode_code_indices(
+            cmph5_chunk.data[:, 0],
+            aln_group_codes.get(cmph5_chunk.aln_group_path, raw_codes)))
+
+    cmph5_file.close()
+
+def find_cmph5_code_book(cmph5_file, code_book_filename=None):
+    """Read the code book a cmp.h5 was encoded with, from code_book_filename
+    if it's given, and otherwise from the file itself, where
+    quantize.write_compact_cmph5 stores it.
+
+    Returns:
+        raw_codes: a numpy.array of the code values
+        code_book_features: a list of the names of features associated with
+                            columns of raw_codes
+    """
+
+    if code_book_filename is not None:
+        return quantize.read_code_book(code_book_filename)
+
+    cmph5_code_book = quantize.read_cmph5_code_book(cmph5_file)
+    if cmph5_code_book is None:
+        raise ValueError("Cmp.h5 file {c} holds no code book, so the code "
+                         "book it was encoded with is needed"
+                         .format(c=cmph5_file.filename))
+    return cmph5_code_book
+
+def decode_cmph5(filename, code_book_filename):
+    """Restore the QV datasets of a cmp.h5 file from its VQ or VQEntropy
+    datasets, creating any that are missing. A run length encoded
+    DeletionTag is restored exactly from its runs.
+
+    If code_book_filename is None, the code book stored in the file by
+    quantize.write_compact_cmph5 is used. AlnGroups encoded with the code
+    book of their movie are decoded with it.
+    """
+
+    cmph5_file = h5py.File(filename, 'r+')
+    raw_codes, code_book_features = find_cmph5_code_book(
+        cmph5_file, code_book_filename)
+    aln_group_codes = cmph5_aln_group_code_books(cmph5_file,
+                                                 code_book_filename)
+
+    for cmph5_chunk in decode_cmph5_chunks(filename, raw_codes,
+                                           code_book_features,
+                                           aln_group_codes=aln_group_codes):
+        aln_group = cmph5_file[cmph5_chunk.aln_group_path]
+        for feature_i, feature_name in enumerate(code_book_features):
+            if not aln_group.get(feature_name):
+                if aln_group.get("VQ"):
+                    aln_group_len = len(aln_group["VQ"])
+                else:
+                    aln_group_len = aln_group["VQEntropy"].attrs["NumSymbols"]
+                aln_group.create_dataset(feature_name, (aln_group_len,),
+                                         dtype='uint8', chunks=True)
+            if (feature_name == "DeletionTag" and
+                    aln_group.get("DeletionTagRunValues")):
+                values = quantize.read_rle_deltag_cmph5(
+                    aln_group, cmph5_chunk.aln_group_start,
+                    cmph5_chunk.aln_group_end)
+            else:
+                values = cmph5_chunk.data[:, feature_i]
+            aln_group[feature_name][cmph5_chunk.aln_group_start:
+                                    cmph5_chunk.aln_group_end] = values
+
+    cmph5_file.close()
+
+def decode_sam_records(records, out_sam_file, raw_codes, feature_list,
+                       group_codes=None):
+    """Restore the QV tags of SAM records from the code book indices in
+    their QUAL and write them to out_sam_file. QUAL is cleared, and a run
+    length encoded DeletionTag in dr is expanded back into dt.
+
+    Records of a read group in group_codes, as returned by
+    read_group_code_books_from_sam_header, are decoded with its code book.
+    """
+
+    sam_tags = [utils.QUIVER_SAM_TAGS[k] for k in feature_list]
+    deltag = utils.QUIVER_SAM_TAGS["DeletionTag"]
+
+    if group_codes:
+        group_indices = dict((k, i + 1) for i, k in enumerate(group_codes))
+        stacked_codes = stack_code_books(
+            [numpy.asarray(raw_codes)] + list(group_codes.values()))
+
+    records = iter(records)
+    while True:
+        batch = []
+        quals = []
+        num_bases = 0
+        for record in records:
+            batch.append(record)
+            quals.append(record.qual)
+            num_bases += len(quals[-1])
+            if num_bases >= quantize.BUFFER_SIZE:
+                break
+        if not batch:
+            break
+
+        offsets = numpy.zeros(len(batch) + 1, dtype='int64')
+        numpy.cumsum([len(k) for k in quals], out=offsets[1:])
+        code_indices = (numpy.fromstring(''.join(quals), dtype='uint8') -
+                        utils.CHAR_OFFSET)
+        record_tags = [k.tags for k in batch]
+        if group_codes:
+            record_groups = numpy.array(
+                [group_indices.get(dict(k).get('RG'), 0)
+                 for k in record_tags], dtype='int64')
+            with metrics.stage("decode", len(code_indices)):
+                decoded = stacked_codes[
+                    numpy.repeat(record_groups, numpy.diff(offsets)),
+                    code_indices]
+        else:
+            decoded = decode_code_indices(code_indices, raw_codes)
+
+        tag_strings = []
+        for feature_i, feature_name in enumerate(feature_list):
+            values = decoded[:, feature_i]
+            if not feature_name.endswith("Tag"):
+                values = values + utils.CHAR_OFFSET
+            tag_strings.append(values.tostring())
+
+        rle_strings = [dict(k).get('dr') for k in record_tags]
+        rle_deltags, rle_offsets = quantize.run_length_decode_batch(
+            [k for k in rle_strings if k is not None])
+        rle_deltags = rle_deltags.tostring()
+        rle_i = 0
+
+        write_start_time = time.time()
+        for record_i, record in enumerate(batch):
+            record_start = offsets[record_i]
+            record_end = offsets[record_i + 1]
+
+            tags = [k for k in record_tags[record_i]
+                    if k[0] not in sam_tags and k[0] != 'dr']
+            tags += [(sam_tag, tag_strings[feature_i][record_start:record_end])
+                     for feature_i, sam_tag in enumerate(sam_tags)
+                     if not (rle_strings[record_i] is not None and
+                             sam_tag == deltag)]
+            if rle_strings[record_i] is not None:
+                tags.append((deltag, rle_deltags[rle_offsets[rle_i]:
+                                                 rle_offsets[rle_i + 1]]))
+                rle_i += 1
+
+            record.qual = None
+            record.tags = tags
+            out_sam_file.write(record)
+        metrics.record("sam_write", time.time() - write_start_time,
+                       len(code_indices))
+
+def decode_sam(filename, output_filename, threads=1):
+    """Write a copy of a VQ-encoded SAM or BAM file with its QV tags restored
+    from the code book in its header. The copy is SAM if output_filename ends
+    with .sam, and BAM otherwise, see utils.sam_output_mode.
+    """
+
+    in_sam_file = utils.open_sam_file(filename, threads=threads)
+    header = utils.sam_header_dict(in_sam_file)
+    raw_codes, code_book_features, code_book_comments = \
+        read_code_book_from_sam_header(header)
+    group_codes, group_comments = read_group_code_books_from_sam_header(header)
+
+    header['CO'] = [k for k in header['CO']
+                    if k not in code_book_comments and k not in group_comments]
+    if not header['CO']:
+        del header['CO']
+
+    out_sam_file = utils.open_sam_output(output_filename, header,
+                                         threads=threads)
+    decode_sam_records(in_sam_file, out_sam_file, raw_codes, code_book_features,
+                       group_codes)
+
+    in_sam_file.close()
+    out_sam_file.close()
+
+def decode_file(filename, code_book_filename=None, output_filename=None,
+                threads=1):
+    """Restore QVs in a cmp.h5, SAM, or BAM file encoded by
+    quantize.add_vqs_to_file.
+
+    If the file is a cmp.h5, write the QVs encoded by the VQ dataset of each
+    AlnGroup back into the QV datasets.
+
+    If the file is a SAM or BAM, write a copy with the QV tags restored from
+    the code book in the header.
+
+    Args:
+        filename: path to the cmp.h5, SAM, or BAM file
+        code_book_filename: path to the code book used to encode a cmp.h5,
+            or None if the cmp.h5 holds its code book
+        output_filename: path of the decoded SAM or BAM file
+        threads: number of BGZF compression threads for SAM/BAM files
+    """
+
+    if filename.endswith(".cmp.h5"):
+        decode_cmph5(filename, code_book_filename)
+    elif filename.endswith(".sam") or filename.endswith(".bam"):
+        decode_sam(filename, output_filename, threads)
+    else:
+        raise RuntimeError, "Input file must be SAM, BAM, or cmp.h5"
@@ -0,0 +1,484 @@
+"""entropy contains methods for compressing the stream of code book indices
+written by quantize.add_vqs_to_file with a static canonical Huffman code.
+
+The indices are coded in blocks of ENTROPY_BLOCK_SIZE symbols, each padded to
+a whole byte, so blocks can be written a chunk at a time and all the blocks
+of a chunk can be decoded side by side.
+"""
+import heapq
+import logging
+import numpy
+
+from qv_compress import utils
+
+h5py = utils.LazyModule('h5py')
+
+log = logging.getLogger('main')
+
+# Longest allowed Huffman code. Decoding uses a table with 2**HUFFMAN_MAX_LENGTH
+# entries.
+HUFFMAN_MAX_LENGTH = 12
+
+# Number of symbols in each independently decodable block
+ENTROPY_BLOCK_SIZE = 4096
+
+# Number of symbols encoded or decoded at a time, a multiple of
+# ENTROPY_BLOCK_SIZE
+ENTROPY_CHUNK_SIZE = 128 * ENTROPY_BLOCK_SIZE
+
+def code_frequencies(code_indices, num_codes):
+    """Count how often each code index occurs."""
+
+    return numpy.bincount(code_indices, minlength=num_codes).astype('int64')
+
+def huffman_code_lengths(frequencies, max_length=HUFFMAN_MAX_LENGTH):
+    """Find the length of the Huffman code for each symbol.
+
+    If the longest code is longer than max_length, the frequencies are
+    flattened and the code is rebuilt until it fits.
+
+    Args:
+        frequencies: the number of occurrences of each symbol
+        max_length: the longest code allowed
+
+    Returns:
+        a uint8 numpy array of code lengths. Symbols that never occur get
+        length 0.
+    """
+
+    frequencies = numpy.asarray(frequencies, dtype='int64')
+    code_lengths = numpy.zeros(len(frequencies), dtype='uint8')
+    symbols = numpy.flatnonzero(frequencies)
+
+    if len(symbols) == 0:
+        return code_lengths
+    if len(symbols) == 1:
+        code_lengths[symbols] = 1
+        return code_lengths
+    if len(symbols) > 2 ** max_length:
+        raise ValueError("{n} symbols can't be coded with codes of at most {m} "
+                         "bits".format(n=len(symbols), m=max_length))
+
+    weights = frequencies[symbols]
+    while True:
+        # Each heap item holds the symbols of a subtree, whose depths all grow
+        # by one when it is merged.
+        heap = [(weight, i, [i]) for i, weight in enumerate(weights)]
+        heapq.heapify(heap)
+        depths = numpy.zeros(len(symbols), dtype='int64')
+        while len(heap) > 1:
+            weight_a, key, members_a = heapq.heappop(heap)
+            weight_b, _, members_b = heapq.heappop(heap)
+            members = members_a + members_b
+            depths[members] += 1
+            heapq.heappush(heap, (weight_a + weight_b, key, members))
+
+        if depths.max() <= max_length:
+            break
+        weights = (weights >> 1) | 1
+
+    code_lengths[symbols] = depths
+    return code_lengths
+
+def canonical_codes(code_lengths):
+    """Assign canonical Huffman codes given the length of each symbol's code.
+
+    Returns:
+        an int64 numpy array of codes, 0 for symbols with no code
+    """
+
+    codes = numpy.zeros(len(code_lengths), dtype='int64')
+    code = 0
+    prev_length = 0
+    for symbol in numpy.lexsort((numpy.arange(len(code_lengths)), code_lengths)):
+        length = int(code_lengths[symbol])
+        if length == 0:
+            continue
+        code <<= length - prev_length
+        codes[symbol] = code
+        code += 1
+        prev_length = length
+
+    return codes
+
+def make_decode_table(code_lengths):
+    """Build the table used by huffman_decode. Entry i of the table gives the
+    symbol and code length for any bit window whose leading bits are that
+    symbol's code.
+
+    Returns:
+        table_symbols: a uint8 numpy array of symbols
+        table_lengths: an int64 numpy array of code lengths
+    """
+
+    max_length = int(code_lengths.max())
+    codes = canonical_codes(code_lengths)
+    table_symbols = numpy.zeros(2 ** max_length, dtype='uint8')
+    table_lengths = numpy.ones(2 ** max_length, dtype='int64')
+
+    for symbol in numpy.flatnonzero(code_lengths):
+        shift = max_length - int(code_lengths[symbol])
+        table_symbols[codes[symbol] << shift:(codes[symbol] + 1) << shift] = symbol
+        table_lengths[codes[symbol] << shift:(codes[symbol] + 1) << shift] = \
+            code_lengths[symbol]
+
+    return table_symbols, table_lengths
+
+def huffman_encode(symbols, code_lengths, codes=None,
+                   block_size=ENTROPY_BLOCK_SIZE):
+    """Huffman code a sequence of symbols in blocks that each start on a byte
+    boundary.
+
+    Args:
+        symbols: integer numpy array of symbols to encode
+        code_lengths: the code length of each symbol, from
+            huffman_code_lengths
+        codes: the canonical codes for code_lengths. If None, they are
+            calculated here.
+        block_size: the number of symbols in each block
+
+    Returns:
+        packed: a uint8 numpy array of the coded bits
+        block_offsets: an int64 numpy array of the byte offset of each block
+            in packed
+    """
+
+    if codes is None:
+        codes = canonical_codes(code_lengths)
+
+    symbols = numpy.asarray(symbols)
+    symbol_lengths = code_lengths.astype('int64')[symbols]
+    if len(symbols) and not symbol_lengths.min():
+        raise ValueError("Can't encode a symbol with no Huffman code")
+    symbol_codes = codes[symbols]
+
+    block_starts = numpy.arange(0, len(symbols), block_size)
+    if not len(symbols):
+        return numpy.zeros(0, dtype='uint8'), block_starts
+
+    # Bit offset of each symbol within its block, and of each block once
+    # padded to whole bytes
+    bit_offsets = numpy.cumsum(symbol_lengths) - symbol_lengths
+    block_bits = numpy.add.reduceat(symbol_lengths, block_starts)
+    block_bytes = (block_bits + 7) // 8
+    block_offsets = numpy.cumsum(block_bytes) - block_bytes
+    bit_offsets += (numpy.repeat(block_offsets * 8 - bit_offsets[block_starts],
+                                 numpy.diff(numpy.append(block_starts,
+                                                         len(symbols)))))
+
+    bits = numpy.zeros(block_bytes.sum() * 8, dtype='uint8')
+    for bit_i in xrange(int(code_lengths.max())):
+        in_code = symbol_lengths > bit_i
+        bits[bit_offsets[in_code] + bit_i] = (
+            symbol_codes[in_code] >> (symbol_lengths[in_code] - 1 - bit_i)) & 1
+
+    return numpy.packbits(bits), block_offsets
+
+def huffman_decode(packed, block_offsets, num_symbols, code_lengths,
+                   decode_table=None, block_size=ENTROPY_BLOCK_SIZE):
+    """Decode symbols coded by huffman_encode. One symbol is decoded from
+    every block at a time, so the work is spread over vector operations on
+    all the blocks.
+
+    Args:
+        packed: uint8 numpy array of coded bits
+        block_offsets: the byte offset of each block in packed
+        num_symbols: the total number of symbols coded
+        code_lengths: the code length of each symbol
+        decode_table: the result of make_decode_table(code_lengths). If
+            None, it is calculated here.
+        block_size: the number of symbols in each block
+
+    Returns:
+        a uint8 numpy array of symbols
+    """
+
+    if decode_table is None:
+        decode_table = make_decode_table(code_lengths)
+    table_symbols, table_lengths = decode_table
+    max_length = int(code_lengths.max())
+
+    symbols = numpy.empty(num_symbols, dtype='uint8')
+    if not num_symbols:
+        return symbols
+
+    bits = numpy.append(numpy.unpackbits(packed),
+                        numpy.zeros(max_length, dtype='uint8'))
+    bit_weights = 1 << numpy.arange(max_length - 1, -1, -1)
+    bit_positions = numpy.asarray(block_offsets, dtype='int64') * 8
+    window_offsets = numpy.arange(max_length)
+    last_block_size = num_symbols - (len(bit_positions) - 1) * block_size
+
+    for symbol_i in xrange(min(block_size, num_symbols)):
+        if symbol_i == last_block_size:
+            bit_positions = bit_positions[:-1]
+        windows = bits[bit_positions[:, None] + window_offsets].dot(bit_weights)
+        symbols[symbol_i::block_size] = table_symbols[windows]
+        bit_positions += table_lengths[windows]
+
+    return symbols
+
+def huffman_decode_block(packed, num_symbols, code_lengths,
+                         decode_table=None):
+    """Decode a single block coded by huffman_encode. huffman_decode steps
+    through the symbols of all its blocks together, which is slow for one
+    block, so here the table entry at every bit position is looked up at
+    once, and only the walk from one code to the next is done symbol by
+    symbol.
+
+    Args:
+        packed: uint8 numpy array of the coded bits of the block
+        num_symbols: the number of symbols in the block
+        code_lengths: the code length of each symbol
+        decode_table: the result of make_decode_table(code_lengths). If
+            None, it is calculated here.
+
+    Returns:
+        a uint8 numpy array of symbols
+    """
+
+    if decode_table is None:
+        decode_table = make_decode_table(code_lengths)
+    table_symbols, table_lengths = decode_table
+    max_length = int(code_lengths.max())
+    if not num_symbols:
+        return numpy.empty(0, dtype='uint8')
+
+    bits = numpy.unpackbits(packed)
+    num_bits = len(bits)
+    bits = numpy.append(bits, numpy.zeros(max_length, dtype='uint8'))
+    windows = numpy.zeros(num_bits, dtype='int64')
+    for offset in xrange(max_length):
+        windows <<= 1
+        windows |= bits[offset:offset + num_bits]
+
+    next_positions = (numpy.arange(num_bits) +
+                      table_lengths[windows]).tolist()
+    positions = [0] * num_symbols
+    position = 0
+    for symbol_i in xrange(1, num_symbols):
+        position = next_positions[position]
+        positions[symbol_i] = position
+
+    return table_symbols[windows[positions]]
+
+def bits_per_base(code_lengths, frequencies):
+    """The average number of bits per base with code_lengths for symbols
+    counted in frequencies.
+    """
+
+    return (float(numpy.dot(code_lengths.astype('int64'), frequencies)) /
+            max(frequencies.sum(), 1))
+
+def report(frequencies, code_lengths, num_bytes=None):
+    """Log how well the VQ index stream compresses.
+
+    Args:
+        frequencies: the number of times each code index occurs
+        code_lengths: the Huffman code length of each code index
+        num_bytes: the size of the entropy coded stream, including block
+            padding, if it was written
+    """
+
+    num_bases = frequencies.sum()
+    probs = frequencies[frequencies > 0] / float(max(num_bases, 1))
+    entropy = -numpy.dot(probs, numpy.log2(probs))
+
+    log.info("VQ index stream: {n} bases, entropy {e:.3f} bits/base, Huffman "
+             "{h:.3f} bits/base".format(n=num_bases, e=entropy,
+                                        h=bits_per_base(code_lengths,
+                                                        frequencies)))
+    if num_bytes is not None:
+        log.info("Entropy coded VQ: {b} bytes, {r:.3f} bits/base"
+                 .format(b=num_bytes, r=8.0 * num_bytes / max(num_bases, 1)))
+
+def cmph5_code_frequencies(cmph5_file, num_codes, aln_group_paths=None):
+    """Count the code indices in the VQ datasets of an open cmp.h5 file.
+
+    Only the AlnGroups in aln_group_paths are counted, or all of them if it's
+    None.
+    """
+
+    if aln_group_paths is None:
+        aln_group_paths = cmph5_file['AlnGroup/Path']
+
+    frequencies = numpy.zeros(num_codes, dtype='int64')
+    vq_data = numpy.empty((ENTROPY_CHUNK_SIZE, 1), dtype='uint8', order='F')
+    for aln_group_path in aln_group_paths:
+        aln_group_len = len(cmph5_file[aln_group_path]["VQ"])
+        for chunk_start in xrange(0, aln_group_len, ENTROPY_CHUNK_SIZE):
+            cmph5_chunk = utils.read_cmph5_chunk(
+                cmph5_file,
+                utils.CmpH5Chunk(aln_group_path, chunk_start,
+                                 min(chunk_start + ENTROPY_CHUNK_SIZE,
+                                     aln_group_len), None),
+                ["VQ"], out=vq_data)
+            frequencies += code_frequencies(cmph5_chunk.data[:, 0], num_codes)
+
+    return frequencies
+
+def entropy_code_aln_group(aln_group, code_lengths, codes):
+    """Write the VQEntropy and VQEntropyOffsets datasets of an AlnGroup from
+    its VQ dataset, replacing any already there.
+
+    Returns:
+        the number of bytes in VQEntropy
+    """
+
+    for dataset_name in ("VQEntropy", "VQEntropyOffsets"):
+        if aln_group.get(dataset_name):
+            del aln_group[dataset_name]
+    packed_dataset = aln_group.create_dataset(
+        "VQEntropy", (0,), dtype='uint8', maxshape=(None,), chunks=True)
+    offsets_dataset = aln_group.create_dataset(
+        "VQEntropyOffsets", (0,), dtype='uint64', maxshape=(None,),
+        chunks=True)
+
+    num_symbols = len(aln_group["VQ"])
+    for chunk_start in xrange(0, num_symbols, ENTROPY_CHUNK_SIZE):
+        packed, block_offsets = huffman_encode(
+            aln_group["VQ"][chunk_start:chunk_start + ENTROPY_CHUNK_SIZE],
+            code_lengths, codes)
+        block_offsets += len(packed_dataset)
+
+        packed_dataset.resize((len(packed_dataset) + len(packed),))
+        packed_dataset[-len(packed):] = packed
+        offsets_dataset.resize((len(offsets_dataset) + len(block_offsets),))
+        offsets_dataset[-len(block_offsets):] = block_offsets
+
+    packed_dataset.attrs["NumSymbols"] = num_symbols
+    return len(packed_dataset)
+
+def entropy_code_cmph5(filename, num_codes, keep_vq=False):
+    """Replace the VQ dataset of each AlnGroup of a cmp.h5 file with a
+    Huffman coded VQEntropy dataset.
+
+    The code lengths are written to the VQEntropyModel dataset at the root of
+    the file. VQEntropy holds the coded bytes and has the number of bases in
+    its NumSymbols attribute, and VQEntropyOffsets holds the byte offset of
+    each block. HDF5 doesn't reclaim the space of the deleted VQ datasets, so
+    run h5repack to shrink the file.
+
+    The model is written and the VQ datasets deleted only once every AlnGroup
+    is coded, so an interrupted run can be started again. AlnGroups that
+    already have VQEntropy and no VQ are skipped, and the rest are coded with
+    the model already in the file.
+
+    Args:
+        filename: path to a cmp.h5 file with VQ datasets
+        num_codes: the number of codes in the code book
+        keep_vq: if True, don't delete the VQ datasets
+    """
+
+    cmph5_file = h5py.File(filename, 'r+')
+
+    aln_group_paths = [k for k in cmph5_file['AlnGroup/Path']
+                       if cmph5_file[k].get("VQ")]
+    num_coded = len([k for k in cmph5_file['AlnGroup/Path']
+                     if cmph5_file[k].get("VQEntropy")
+                     and not cmph5_file[k].get("VQ")])
+    if aln_group_paths and num_coded:
+        log.info("{n} AlnGroups are already entropy coded, coding the rest "
+                 "with the same model".format(n=num_coded))
+    elif not aln_group_paths:
+        log.info("{f} is already entropy coded".format(f=filename))
+        cmph5_file.close()
+        return
+
+    frequencies = cmph5_code_frequencies(cmph5_file, num_codes,
+                                         aln_group_paths)
+    if num_coded:
+        if read_cmph5_model(cmph5_file) is None:
+            raise ValueError("{f} has AlnGroups that were entropy coded and "
+                             "had their VQ deleted, but no VQEntropyModel"
+                             .format(f=filename))
+        code_lengths = read_cmph5_model(cmph5_file)[0]
+    else:
+        code_lengths = huffman_code_lengths(frequencies)
+    codes = canonical_codes(code_lengths)
+
+    num_bytes = 0
+    for aln_group_path in aln_group_paths:
+        num_bytes += entropy_code_aln_group(cmph5_file[aln_group_path],
+                                            code_lengths, codes)
+    cmph5_file.flush()
+
+    if not num_coded:
+        if "VQEntropyModel" in cmph5_file:
+            del cmph5_file["VQEntropyModel"]
+        cmph5_file.create_dataset("VQEntropyModel", data=code_lengths)
+        cmph5_file["VQEntropyModel"].attrs["BlockSize"] = ENTROPY_BLOCK_SIZE
+        cmph5_file.flush()
+
+    if not keep_vq:
+        for aln_group_path in aln_group_paths:
+            del cmph5_file[aln_group_path]["VQ"]
+
+    cmph5_file.close()
+    report(frequencies, code_lengths, num_bytes)
+
+def read_cmph5_model(cmph5_file):
+    """Read the code lengths and block size written by entropy_code_cmph5,
+    or return None if the file isn't entropy coded.
+    """
+
+    if "VQEntropyModel" not in cmph5_file:
+        return None
+    model = cmph5_file["VQEntropyModel"]
+    return model[:], int(model.attrs["BlockSize"])
+
+def decode_cmph5_aln_group(aln_group, code_lengths, block_size,
+                           chunk_size=ENTROPY_CHUNK_SIZE, decode_table=None):
+    """Generator function for decoding the VQEntropy dataset of an AlnGroup.
+
+    Yields:
+        (start, code_indices) for successive ranges of the AlnGroup's bases.
+        The ranges hold a whole number of blocks.
+    """
+
+    if decode_table is None:
+        decode_table = make_decode_table(code_lengths)
+
+    packed_dataset = aln_group["VQEntropy"]
+    block_offsets = aln_group["VQEntropyOffsets"][:].astype('int64')
+    num_symbols = int(packed_dataset.attrs["NumSymbols"])
+    blocks_per_chunk = max(chunk_size // block_size, 1)
+
+    for first_block in xrange(0, len(block_offsets), blocks_per_chunk):
+        last_block = min(first_block + blocks_per_chunk, len(block_offsets))
+        byte_start = block_offsets[first_block]
+        byte_end = (block_offsets[last_block] if last_block < len(block_offsets)
+                    else len(packed_dataset))
+        start = first_block * block_size
+        chunk_symbols = min(num_symbols, last_block * block_size) - start
+
+        yield start, huffman_decode(
+            packed_dataset[byte_start:byte_end],
+            block_offsets[first_block:last_block] - byte_start,
+            chunk_symbols, code_lengths, decode_table, block_size)
+
+def report_sam(sam_filename, num_codes, threads=1):
+    """Log the bits per base that Huffman coding would achieve on the code
+    book indices in the QUAL field of an encoded SAM or BAM file.
+    """
+
+    sam_file = utils.open_sam_file(sam_filename, threads=threads)
+    frequencies = numpy.zeros(num_codes, dtype='int64')
+    quals = []
+    num_bases = 0
+    for record in sam_file:
+        quals.append(record.qual)
+        num_bases += len(quals[-1])
+        if num_bases >= ENTROPY_CHUNK_SIZE:
+            frequencies += code_frequencies(
+                numpy.fromstring(''.join(quals), dtype='uint8') -
+                utils.CHAR_OFFSET, num_codes)
+            quals = []
+            num_bases = 0
+    if quals:
+        frequencies += code_frequencies(
+            numpy.fromstring(''.join(quals), dtype='uint8') - utils.CHAR_OFFSET,
+            num_codes)
+    sam_file.close()
+
+    report(frequencies, huffman_code_lengths(frequencies))
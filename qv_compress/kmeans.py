@@ -0,0 +1,223 @@
+"""kmeans contains the k-means training and nearest code assignment used for
+building code books and encoding.
+
+Distances are computed a block of observations at a time as
+||x||^2 - 2 x.c + ||c||^2, so the work is a matrix multiply and the block's
+distance matrix stays in cache. Blocks can be spread over threads, since
+numpy releases the GIL in the matrix multiply.
+
+With a seed, every restart draws from its own numpy.random.RandomState
+seeded from it, so the code book is the same whatever the number of threads.
+"""
+import logging
+import multiprocessing.pool
+import numpy
+
+log = logging.getLogger('main')
+
+# Size in bytes of the block distance matrix computed at a time
+DISTANCE_BLOCK_BYTES = 2 ** 20
+MIN_BLOCK_SIZE = 256
+
+KMEANS_ITER = 20
+KMEANS_THRESH = 1e-5
+
+def distance_block_size(num_codes):
+    """The number of observations whose distances to num_codes codes fit in
+    DISTANCE_BLOCK_BYTES.
+    """
+
+    return max(DISTANCE_BLOCK_BYTES // (8 * max(num_codes, 1)), MIN_BLOCK_SIZE)
+
+def as_float_array(obs):
+    """Return obs as a float32 or float64 array, copying it only if it's
+    some other type.
+    """
+
+    obs = numpy.asarray(obs)
+    if obs.dtype in (numpy.float32, numpy.float64):
+        return obs
+    return obs.astype('float64')
+
+def _thread_map(function, items, threads, pool=None):
+    """map function over items, in pool if it's given, or else in a pool of
+    threads if threads > 1.
+    """
+
+    if pool is not None and len(items) > 1:
+        return pool.map(function, items, 1)
+    if threads <= 1 or len(items) <= 1:
+        return [function(k) for k in items]
+
+    pool = multiprocessing.pool.ThreadPool(min(threads, len(items)))
+    try:
+        return pool.map(function, items, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def nearest_codes(obs, codes, threads=1, block_size=None, pool=None):
+    """Find the nearest code to each observation. A drop-in replacement for
+    scipy.cluster.vq.vq.
+
+    Args:
+        obs: numpy array of observations, one per row
+        codes: numpy array of codes, one per row
+        threads: the number of threads computing blocks of observations
+        block_size: the number of observations in each block. Defaults to
+            distance_block_size(len(codes)).
+        pool: a ThreadPool to compute the blocks in, so a caller that
+            searches many times doesn't start threads for every search. If
+            given, threads is ignored.
+
+    Returns:
+        code_indices: the index of the nearest code to each observation
+        distances: the Euclidean distance from each observation to its code
+    """
+
+    obs = as_float_array(obs)
+    codes = numpy.asarray(codes, dtype=obs.dtype)
+    if block_size is None:
+        block_size = distance_block_size(len(codes))
+
+    code_norms = (codes ** 2).sum(axis=1)
+    codes_t = numpy.ascontiguousarray(codes.T)
+    code_indices = numpy.empty(len(obs), dtype='int32')
+    distances = numpy.empty(len(obs), dtype=obs.dtype)
+
+    def assign_block(block_start):
+        block = obs[block_start:block_start + block_size]
+        block_distances = numpy.dot(block, codes_t)
+        block_distances *= -2
+        block_distances += code_norms
+        block_indices = block_distances.argmin(axis=1)
+        nearest = block_distances[numpy.arange(len(block)), block_indices]
+        nearest += (block ** 2).sum(axis=1)
+
+        code_indices[block_start:block_start + len(block)] = block_indices
+        distances[block_start:block_start + len(block)] = numpy.sqrt(
+            numpy.maximum(nearest, 0))
+
+    _thread_map(assign_block, range(0, len(obs), block_size), threads, pool)
+    return code_indices, distances
+
+def collapse_rows(obs):
+    """Collapse identical rows of obs into the distinct rows and the number
+    of times each occurs.
+
+    Returns:
+        distinct_obs: the distinct rows of obs
+        counts: float64 numpy array of the count of each row
+    """
+
+    obs = numpy.ascontiguousarray(obs)
+    keys = obs.view([('', obs.dtype)] * obs.shape[1]).ravel()
+    distinct_keys, counts = numpy.unique(keys, return_counts=True)
+    distinct_obs = distinct_keys.view(obs.dtype).reshape(len(distinct_keys),
+                                                         obs.shape[1])
+    return distinct_obs, counts.astype('float64')
+
+def random_codes(obs, weights, num_clusters, random_state):
+    """Pick initial codes like scipy.cluster.vq.kmeans: num_clusters
+    observations drawn at random, here with probability proportional to
+    their weights. An observation drawn more than once gives one code.
+    """
+
+    rows = random_state.choice(len(obs), num_clusters,
+                               p=weights / weights.sum())
+    return obs[numpy.unique(rows)]
+
+def lloyd(obs, weights, initial_codes, thresh=KMEANS_THRESH, pool=None):
+    """Run weighted Lloyd iterations from initial_codes until the weighted
+    mean distortion improves by less than thresh. Codes with no members are
+    dropped. The distances are computed in blocks spread over pool, if it's
+    given.
+
+    Returns:
+        code_book: the cluster centers
+        distortion: the weighted mean distance from observations to their
+            nearest center
+    """
+
+    total_weight = weights.sum()
+    code_book = initial_codes
+    prev_distortion = numpy.inf
+
+    while True:
+        code_indices, distances = nearest_codes(obs, code_book, pool=pool)
+        distortion = numpy.dot(weights, distances) / total_weight
+        if prev_distortion - distortion <= thresh:
+            return code_book, distortion
+        prev_distortion = distortion
+
+        code_weights = numpy.bincount(code_indices, weights=weights,
+                                      minlength=len(code_book))
+        code_sums = numpy.zeros(code_book.shape)
+        for feature_i in xrange(obs.shape[1]):
+            code_sums[:, feature_i] = numpy.bincount(
+                code_indices, weights=weights * obs[:, feature_i],
+                minlength=len(code_book))
+        has_members = code_weights > 0
+        code_book = (code_sums[has_members] /
+                     code_weights[has_members, numpy.newaxis])
+
+def kmeans(obs, num_clusters, weights=None, iter=KMEANS_ITER,
+           thresh=KMEANS_THRESH, threads=1, seed=None):
+    """Run k-means iter times from random initial codes and keep the code
+    book with the lowest distortion. A replacement for
+    scipy.cluster.vq.kmeans that also takes weights.
+
+    Identical observations are collapsed into one weighted observation
+    first, which for QV tuples leaves far fewer rows to search.
+
+    Args:
+        obs: whitened numpy array of observations. float32 observations are
+            clustered without making a float64 copy.
+        num_clusters: the number of codes to create
+        weights: the number of times each row of obs was observed. If None,
+            every row counts once.
+        iter: the number of restarts
+        thresh: convergence threshold for the change in distortion
+        threads: the number of threads computing the distance blocks of
+            each restart
+        seed: seed for the initial codes, for a reproducible code book. If
+            None, the initial codes differ from run to run.
+
+    Returns:
+        code_book: the cluster centers
+        distortion: the weighted mean distance from observations to their
+            nearest center
+    """
+
+    obs = as_float_array(obs)
+    if weights is None:
+        obs, weights = collapse_rows(obs)
+    weights = numpy.asarray(weights, dtype='float64')
+    if len(obs) <= num_clusters:
+        return numpy.array(obs, copy=True), 0.0
+
+    if seed is None:
+        seeds = [None] * iter
+    else:
+        seeds = [seed + k for k in xrange(iter)]
+
+    pool = None
+    if threads > 1:
+        pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        runs = []
+        for run_seed in seeds:
+            random_state = numpy.random.RandomState(run_seed)
+            initial_codes = random_codes(obs, weights, num_clusters,
+                                         random_state)
+            runs.append(lloyd(obs, weights, initial_codes, thresh, pool))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # Ties go to the earliest restart
+    best_run = min(xrange(len(runs)), key=lambda k: runs[k][1])
+    log.debug("Best of {n} k-means restarts has distortion {d:.4f}".format(
+        n=len(runs), d=runs[best_run][1]))
+    return runs[best_run]
@@ -1,11 +1,19 @@
 """Entry point for qv_compress. Parses arguments, logs, contains main."""
 import argparse
 import logging
-import numpy
+import os
 import sys
 
+import qv_compress.access
+import qv_compress.batch
+import qv_compress.benchmark
+import qv_compress.cache
 import qv_compress.code_book
+import qv_compress.decode
+import qv_compress.metrics
 import qv_compress.quantize
+import qv_compress.sweep
+import qv_compress.utils
 
 log = logging.getLogger('main')
 
@@ -16,6 +24,13 @@ def get_parser():
     parser = argparse.ArgumentParser(prog='qv_compress.py', description=desc)
     parser.add_argument("--debug", help="Output detailed log information.",
                         action='store_true')
+    parser.add_argument("--metrics", default=None,
+                        help=("Write the time, bases, and bytes of each stage "
+                              "and the peak RSS to this JSON file."))
+    parser.add_argument("--profile", action='store_true',
+                        help=("Log progress with bases/sec and an ETA while "
+                              "running, and the time spent in each stage at "
+                              "the end."))
     subparsers = parser.add_subparsers(dest="cmd")
 
     parser_build_code_book = subparsers.add_parser(
@@ -24,7 +39,26 @@ def get_parser():
 
     parser_encode = subparsers.add_parser(
         "encode",
-        help="Add VQ values to a cmp.h5, SAM, or BAM file.")
+        help="Add VQ values to cmp.h5, SAM, or BAM files.")
+
+    parser_decode = subparsers.add_parser(
+        "decode",
+        help="Restore QVs from the VQ values in a cmp.h5, SAM, or BAM file.")
+
+    parser_query = subparsers.add_parser(
+        "query",
+        help=("Decode the QVs of chosen alignments or reference windows of "
+              "an encoded cmp.h5."))
+
+    parser_sweep = subparsers.add_parser(
+        "sweep",
+        help=("Build code books with several numbers of codes from one "
+              "training sample and compare their distortion and bits/base."))
+
+    parser_benchmark = subparsers.add_parser(
+        "benchmark",
+        help=("Time building code books, encoding, and decoding on synthetic "
+              "cmp.h5 and BAM files."))
 
 
     # build_code_book
@@ -45,7 +79,9 @@ def get_parser():
 
     parser_build_code_book.add_argument(
         "output_csv",
-        help="CSV file where code book will be written.",
+        help=("File where code book will be written. A .npz extension "
+              "writes a binary code book that also holds the whitening used "
+              "in training; anything else writes a CSV."),
         default="code_book.csv")
     
     parser_build_code_book.add_argument(
@@ -56,14 +92,158 @@ def get_parser():
         default="DeletionQV,DeletionTag,InsertionQV,MergeQV,SubstitutionQV",
         type=lambda x: x.split(','))
 
+    parser_build_code_book.add_argument(
+        "--sampling",
+        choices=["head", "uniform", "stratified"],
+        default="head",
+        help=("How to pick the training bases. 'head' takes the first "
+              "num_observations bases, 'uniform' samples them from the whole "
+              "file, and 'stratified' samples evenly from each AlnGroup of a "
+              "cmp.h5 or read group of a SAM or BAM."))
+
+    parser_build_code_book.add_argument(
+        "--algorithm",
+        choices=["weighted", "kmeans", "minibatch"],
+        default="weighted",
+        help=("Clustering algorithm. 'weighted' collapses the observations "
+              "to distinct QV tuples with counts and runs weighted k-means on "
+              "them. 'kmeans' clusters all observations in memory. "
+              "'minibatch' streams them through mini-batch k-means with "
+              "bounded memory."))
+
+    parser_build_code_book.add_argument(
+        "--batch_size",
+        type=int,
+        default=qv_compress.code_book.MINIBATCH_SIZE,
+        help=("Number of bases read at a time. Only used with minibatch and "
+              "weighted."))
+
+    parser_build_code_book.add_argument(
+        "--tol",
+        type=float,
+        default=qv_compress.code_book.MINIBATCH_TOL,
+        help=("Stop mini-batch k-means when its average distortion has "
+              "improved by less than this fraction for "
+              + str(qv_compress.code_book.MINIBATCH_PATIENCE) + " batches. "
+              "Only used with minibatch."))
+
+    parser_build_code_book.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help=("Number of threads for the distance searches of k-means. "
+              "Only used with weighted and kmeans."))
+
+    parser_build_code_book.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help=("Seed for the training sample and initial codes, so the same "
+              "input gives the same code book whatever the number of "
+              "threads."))
+
+    parser_build_code_book.add_argument(
+        "--group_by",
+        choices=qv_compress.code_book.GROUP_BY,
+        default="none",
+        help=("With 'read_group', also build a code book for each read group "
+              "of a SAM or BAM, or each movie of a cmp.h5, with at least "
+              + str(qv_compress.code_book.MIN_GROUP_OBSERVATIONS) + " bases. "
+              "Records are encoded with the code book of their read group or "
+              "movie. Needs a .npz output and the weighted algorithm."))
+
+    parser_build_code_book.add_argument(
+        "--cache_dir",
+        default=os.environ.get(qv_compress.cache.CACHE_DIR_VARIABLE),
+        help=("Directory of cached code books. If the same code book was "
+              "built before from the same file, it is loaded from here "
+              "instead of being trained again. Defaults to $"
+              + qv_compress.cache.CACHE_DIR_VARIABLE + ", and no cache if "
+              "that isn't set."))
+
+    parser_build_code_book.add_argument(
+        "--cache_size",
+        type=int,
+        default=qv_compress.cache.DEFAULT_CACHE_SIZE_MB,
+        help=("Largest size of the --cache_dir in MB. The least recently "
+              "used code books are removed to stay under it."))
+
+    # sweep
+    parser_sweep.add_argument(
+        "training_alignments",
+        help="Cmp.h5, SAM, or BAM file from which QV clusters will be created")
+
+    parser_sweep.add_argument(
+        "num_codes",
+        type=lambda x: [int(k) for k in x.split(',')],
+        help="A comma separated list of the numbers of codes to try.")
+
+    parser_sweep.add_argument(
+        "num_observations",
+        type=int,
+        help="The number of bases to use when creating cluster centers.")
+
+    parser_sweep.add_argument(
+        "--features_to_cluster",
+        help=("A comma separated list of features to cluster. Defaults to "
+              "the default Quiver quality values:\nDeletionQV,DeletionTag,"
+              "InsertionQV,MergeQV,SubstitutionQV"),
+        default="DeletionQV,DeletionTag,InsertionQV,MergeQV,SubstitutionQV",
+        type=lambda x: x.split(','))
+
+    parser_sweep.add_argument(
+        "--sampling",
+        choices=["head", "uniform", "stratified"],
+        default="head",
+        help="How to pick the training bases, as for build_code_book.")
+
+    parser_sweep.add_argument(
+        "--batch_size",
+        type=int,
+        default=qv_compress.code_book.MINIBATCH_SIZE,
+        help="Number of bases read at a time.")
+
+    parser_sweep.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes training code books at once.")
+
+    parser_sweep.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help=("Seed for the training sample and initial codes, so the same "
+              "input gives the same code books."))
+
+    parser_sweep.add_argument(
+        "--output_json",
+        default=None,
+        help=("Write the distortion, bits/base, and training time of each "
+              "number of codes to this JSON file."))
+
+    parser_sweep.add_argument(
+        "--knee_code_book",
+        default=None,
+        help=("Save the code book at the knee of the rate-distortion curve "
+              "to this file, as a CSV or, with a .npz extension, a binary "
+              "code book."))
+
     # encode_cmp_h5
     parser_encode.add_argument(
-        "alignment_file",
-        help="File to which a VQ information will be added.")
+        "alignment_files",
+        nargs='*',
+        metavar="alignment_file",
+        help=("Files to which a VQ information will be added, or glob "
+              "patterns matching them. Use '-' to read a SAM or BAM from "
+              "stdin. Without --code_book_csv, the last one is the code "
+              "book, as in 'encode alignment_file code_book_csv'."))
 
     parser_encode.add_argument(
-        "code_book_csv",
-        help="Code book created by 'build_code_book'.")
+        "--code_book_csv",
+        default=None,
+        help=("Code book (CSV or .npz) created by 'build_code_book'. "
+              "Required to encode more than one file or a --manifest."))
     
     parser_encode.add_argument(
         "--overwrite_qvs",
@@ -75,35 +255,346 @@ def get_parser():
     parser_encode.add_argument(
         "--rle_deltag",
         action="store_true",
-        default="False",
-        help=("Apply run length encoding to the DeletionTag and add it as an "
-              "optional field. Only works with SAM/BAM files."))
+        default=False,
+        help=("Apply run length encoding to the DeletionTag. For SAM/BAM "
+              "files it is added as an optional field. For cmp.h5 files it "
+              "replaces the DeletionTag dataset of each AlnGroup with "
+              "datasets of run values and lengths."))
+
+    parser_encode.add_argument(
+        "--lookup_table",
+        action="store_true",
+        default=False,
+        help=("Assign codes with a precomputed table of QV tuples instead of "
+              "a distance search for every base. Needs a .npz code book, "
+              "which holds the whitening of training."))
+
+    parser_encode.add_argument(
+        "--manifest",
+        default=None,
+        help=("File listing more files to encode, one per line. Relative "
+              "paths are relative to the directory of the manifest."))
+
+    parser_encode.add_argument(
+        "--output_dir",
+        default=None,
+        help=("Directory where the encoded copy of each file is written, "
+              "under its own name. Required to encode more than one SAM or "
+              "BAM file. cmp.h5 files are written as compact copies, as with "
+              "--output_filename."))
+
+    parser_encode.add_argument(
+        "--summary_json",
+        default=None,
+        help=("Write whether each file was encoded, the time taken, and the "
+              "input and output sizes to this JSON file. Only used when "
+              "encoding more than one file or with --output_dir or "
+              "--manifest."))
+
+    parser_encode.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help=("Number of processes used to quantize the files. A cmp.h5 is "
+              "split into chunks of AlnGroups, and a BAM into shards of "
+              "records. When encoding more than one file, one pool of "
+              "workers is shared by all of them. Defaults to 1 for a single "
+              "file and to the number of CPUs otherwise."))
+
+    parser_encode.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help=("Number of threads each process uses to search for the "
+              "nearest codes, and of BGZF compression threads for reading "
+              "and writing BAM files, which requires pysam 0.14 or later."))
+
+    parser_encode.add_argument(
+        "--pipeline",
+        action="store_true",
+        default=False,
+        help=("Read the next chunk and write the previous one in background "
+              "threads while quantizing. Only used for a cmp.h5 with one "
+              "worker."))
 
     parser_encode.add_argument(
         "--output_filename",
         action="store",
         default=None,
-        help=("Name of new file with VQ-encoded quality values. Only used and "
-              "required when the aligment_file is a SAM or BAM."))
+        help=("Name of new file with VQ-encoded quality values, or '-' for "
+              "stdout. Required when the alignment_file is a single SAM or "
+              "BAM, and can't be used with more than one. For "
+              "a cmp.h5, a compact copy holding the VQs and code book in "
+              "place of the QVs is written here and the input is left "
+              "unchanged."))
+
+    parser_encode.add_argument(
+        "--compression",
+        choices=qv_compress.quantize.COMPACT_COMPRESSION,
+        default="gzip",
+        help=("HDF5 compression filter of the compact cmp.h5 written to "
+              "--output_filename or --output_dir."))
+
+    parser_encode.add_argument(
+        "--entropy_code",
+        action="store_true",
+        default=False,
+        help=("Huffman code the code book indices and report the bits per "
+              "base achieved. For a cmp.h5, the VQ datasets are replaced "
+              "with VQEntropy datasets. For a SAM or BAM, the bits per base "
+              "are only reported."))
+
+    parser_encode.add_argument(
+        "--output_format",
+        choices=qv_compress.utils.SAM_OUTPUT_FORMATS,
+        default=None,
+        help=("Format of the encoded SAM or BAM: 'bam', 'ubam' for "
+              "uncompressed BAM, or 'sam'. Defaults to SAM for a .sam "
+              "--output_filename and BAM otherwise."))
+
+    parser_encode.add_argument(
+        "--compression_level",
+        type=int,
+        choices=range(10),
+        default=None,
+        help=("BGZF compression level of the encoded BAM, from 0 to 9. Levels "
+              "other than 0 need a pysam that can set them, otherwise encode "
+              "stops with an error."))
+
+    # decode
+    parser_decode.add_argument(
+        "alignment_file",
+        help="File with VQ information added by 'encode'.")
+
+    parser_decode.add_argument(
+        "--code_book_csv",
+        default=None,
+        help=("Code book used to encode the file. Only used when the "
+              "alignment_file is a cmp.h5, and required unless it is a "
+              "compact cmp.h5 that holds its code book."))
+
+    parser_decode.add_argument(
+        "--output_filename",
+        default=None,
+        help=("Name of new file with restored quality values. Only used and "
+              "required when the alignment_file is a SAM or BAM."))
+
+    parser_decode.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help=("Number of BGZF compression threads for reading and writing "
+              "BAM files. Requires pysam 0.14 or later."))
+
+    # query
+    parser_query.add_argument(
+        "alignment_file",
+        help="Cmp.h5 file with VQ information added by 'encode'.")
+
+    parser_query.add_argument(
+        "--code_book_csv",
+        default=None,
+        help=("Code book used to encode the file. Required unless it is a "
+              "compact cmp.h5 that holds its code book."))
+
+    parser_query.add_argument(
+        "--aln_ids",
+        type=lambda x: [int(k) for k in x.split(',')],
+        default=[],
+        help="A comma separated list of the AlnIDs of alignments to decode.")
+
+    parser_query.add_argument(
+        "--window",
+        type=qv_compress.access.parse_window,
+        action='append',
+        default=[],
+        help=("Decode the alignments overlapping a reference window, written "
+              "as ref:start-end, where ref is a RefGroup ID, a RefGroup path, "
+              "or a reference name. Can be given more than once."))
+
+    parser_query.add_argument(
+        "--output_filename",
+        default=qv_compress.utils.STREAM_FILENAME,
+        help=("File where the QVs of each alignment are written as a JSON "
+              "line. Defaults to stdout."))
+
+    # benchmark
+    parser_benchmark.add_argument(
+        "output_json",
+        help="JSON file where bases/sec and peak RSS of each case are written.")
+
+    parser_benchmark.add_argument(
+        "--compare",
+        default=None,
+        help="Earlier benchmark JSON file to compare the results with.")
+
+    parser_benchmark.add_argument(
+        "--work_dir",
+        default=None,
+        help=("Directory for the synthetic files, which are kept. Defaults to "
+              "a temporary directory that is removed afterwards."))
+
+    parser_benchmark.add_argument(
+        "--num_aln_groups",
+        type=int,
+        default=4,
+        help="Number of AlnGroups in the synthetic cmp.h5.")
+
+    parser_benchmark.add_argument(
+        "--num_reads",
+        type=int,
+        default=2000,
+        help="Number of reads in each AlnGroup and in the synthetic BAM.")
+
+    parser_benchmark.add_argument(
+        "--read_length",
+        type=int,
+        default=1000,
+        help="Maximum length of the synthetic reads.")
+
+    parser_benchmark.add_argument(
+        "--num_codes",
+        type=int,
+        default=32,
+        help="Number of codes in the benchmark code book.")
+
+    parser_benchmark.add_argument(
+        "--num_observations",
+        type=int,
+        default=1000000,
+        help="Number of bases used to build the code book.")
+
+    parser_benchmark.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Run each case this many times and report the fastest.")
+
+    parser_benchmark.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to encode.")
 
     return parser
 
+def parse_args(parser, argv=None):
+    """Parse the arguments, letting encode take its alignment files before
+    and after options. Python 2's argparse stops filling a positional with
+    nargs='*' at the first option, so the rest are collected here.
+    """
+
+    args, extras = parser.parse_known_args(argv)
+    if args.cmd == 'encode':
+        positional = [k for k in extras
+                      if k == qv_compress.utils.STREAM_FILENAME or
+                      not k.startswith('-')]
+        args.alignment_files += positional
+        extras = [k for k in extras if k not in positional]
+    if extras:
+        parser.error("unrecognized arguments: " + ' '.join(extras))
+    return args
+
 def check_args(args, parser):
     """Perform a few checks of the arguments. If a check fails, it calls
     parser.error
     """
 
+    if args.cmd == 'build_code_book' and args.group_by != "none":
+        if not args.output_csv.endswith(".npz"):
+            parser.error("Code books of read groups can only be written to a "
+                         ".npz code book.")
+        if args.algorithm != "weighted":
+            parser.error("Code books of read groups are only built with the "
+                         "weighted algorithm.")
+
     if args.cmd == 'encode': 
-        if args.alignment_file.endswith(".sam") or args.aligment_file.endswith(".bam"):
+        if args.code_book_csv is None:
+            if args.manifest is not None or len(args.alignment_files) > 2:
+                parser.error("Give the code book with --code_book_csv when "
+                             "encoding more than one file or a --manifest.")
+            if len(args.alignment_files) < 2:
+                parser.error("Give an alignment_file and a code book.")
+            args.code_book_csv = args.alignment_files.pop()
+        if args.lookup_table and not args.code_book_csv.endswith(".npz"):
+            parser.error("--lookup_table needs a .npz code book, which holds "
+                         "the whitening of training.")
+        if (args.compression_level not in (None, 0) and
+                not qv_compress.utils.pysam_has_compression_levels()):
+            parser.error("pysam {v} can't set a BAM compression level other "
+                         "than 0. Leave out --compression_level to get the "
+                         "default level.".format(
+                             v=qv_compress.utils.pysam.__version__))
+        try:
+            args.alignment_files = qv_compress.batch.expand_inputs(
+                args.alignment_files, args.manifest)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+        if not args.alignment_files:
+            parser.error("Give at least one alignment_file or a --manifest.")
+
+        if is_batch_encode(args):
+            check_batch_encode_args(args, parser)
+        elif qv_compress.utils.is_sam_filename(args.alignment_files[0]):
             if args.output_filename is None:
                 parser.error("When encoding a SAM or BAM file, you have to specify a "
                              "--output_filename.")
-        else: 
-            if args.rle_deltag:
-                parser.error("Run length encoding of DeletionTag only works with SAM "
-                             "or BAM files.")
+        elif args.output_filename is not None and args.overwrite_qvs:
+            parser.error("A compact cmp.h5 written to --output_filename has no "
+                         "QVs to overwrite.")
+
+    if args.cmd == 'query':
+        if not args.alignment_file.endswith(".cmp.h5"):
+            parser.error("Only cmp.h5 files can be queried.")
+        if not args.aln_ids and not args.window:
+            parser.error("Give --aln_ids or at least one --window.")
+
+    if args.cmd == 'decode':
+        if args.alignment_file.endswith(".sam") or args.alignment_file.endswith(".bam"):
+            if args.output_filename is None:
+                parser.error("When decoding a SAM or BAM file, you have to specify a "
+                             "--output_filename.")
+
+
 
+def is_batch_encode(args):
+    """Whether the encode arguments call for qv_compress.batch.encode_batch
+    rather than encoding a single file.
+    """
+
+    return (len(args.alignment_files) > 1 or args.output_dir is not None or
+            args.manifest is not None)
+
+def check_batch_encode_args(args, parser):
+    """Check the arguments of an encode of more than one file. If a check
+    fails, it calls parser.error
+    """
+
+    if args.output_filename is not None:
+        parser.error("Use --output_dir rather than --output_filename when "
+                     "encoding more than one file.")
+    if qv_compress.utils.STREAM_FILENAME in args.alignment_files:
+        parser.error("stdin can only be encoded on its own.")
 
+    if args.output_dir is None:
+        if any(qv_compress.utils.is_sam_filename(k)
+               for k in args.alignment_files):
+            parser.error("When encoding more than one SAM or BAM file, you have "
+                         "to specify an --output_dir.")
+        return
+
+    if args.overwrite_qvs:
+        parser.error("Compact cmp.h5 copies written to --output_dir have no "
+                     "QVs to overwrite.")
+    output_filenames = [os.path.realpath(
+        qv_compress.batch.batch_output_filename(k, args.output_dir))
+                        for k in args.alignment_files]
+    if len(set(output_filenames)) < len(output_filenames):
+        parser.error("Two input files have the same name, so their copies in "
+                     "--output_dir would overwrite each other.")
+    if set(output_filenames) & set(os.path.realpath(k)
+                                   for k in args.alignment_files):
+        parser.error("--output_dir can't be the directory of an input file.")
 
 def setup_log(alog, file_name=None, level=logging.DEBUG, str_formatter=None):
     """Util function for setting up logging."""
@@ -126,7 +617,7 @@ def main():
     """Entry point."""
 
     parser = get_parser()
-    args = parser.parse_args()
+    args = parse_args(parser)
     check_args(args, parser)
 
     if args.debug:
@@ -134,14 +625,68 @@ def main():
     else:
         setup_log(log, level=logging.INFO)
 
+    if args.metrics or args.profile:
+        qv_compress.metrics.enable()
+
+    exit_status = 0
+
     if args.cmd == 'build_code_book':
-        code_book, feature_list = qv_compress.code_book.create_code_book(
+        training_args = (
             args.training_alignments, args.num_codes,
-            args.num_observations, args.features_to_cluster)
+            args.num_observations, args.features_to_cluster, args.algorithm,
+            args.batch_size, args.tol, args.sampling, args.threads,
+            args.seed, args.group_by)
+        if args.cache_dir:
+            code_book, feature_list, std_dev, group_code_books = \
+                qv_compress.cache.cached_create_code_book(
+                    args.cache_dir, args.cache_size * 1024 ** 2,
+                    *training_args)
+        else:
+            code_book, feature_list, std_dev, group_code_books = \
+                qv_compress.code_book.create_code_books(*training_args)
 
-        numpy.savetxt(args.output_csv, code_book, header=','.join(feature_list),
-                      fmt='%2.0f', delimiter=',')
+        qv_compress.code_book.write_code_book(args.output_csv, code_book,
+                                              feature_list, std_dev,
+                                              group_code_books)
+    elif args.cmd == 'encode' and is_batch_encode(args):
+        batch_results = qv_compress.batch.encode_batch(
+            args.alignment_files, args.code_book_csv, args.output_dir,
+            args.overwrite_qvs, args.rle_deltag, args.lookup_table,
+            args.workers, args.threads, args.pipeline, args.entropy_code,
+            args.output_format, args.compression_level, args.compression,
+            args.summary_json)
+        exit_status = int(any(k['status'] == 'failed' for k in batch_results))
     elif args.cmd == 'encode':
         qv_compress.quantize.add_vqs_to_file(
-            args.alignment_file, args.code_book_csv, args.overwrite_qvs,
-            args.rle_deltag, args.output_filename)
+            args.alignment_files[0], args.code_book_csv, args.overwrite_qvs,
+            args.rle_deltag, args.output_filename, args.lookup_table,
+            args.workers or 1, args.threads, args.pipeline,
+            args.entropy_code, args.output_format, args.compression_level,
+            args.compression)
+    elif args.cmd == 'decode':
+        qv_compress.decode.decode_file(
+            args.alignment_file, args.code_book_csv, args.output_filename,
+            args.threads)
+    elif args.cmd == 'query':
+        qv_compress.access.run_query(
+            args.alignment_file, args.code_book_csv, args.aln_ids,
+            args.window, args.output_filename)
+    elif args.cmd == 'sweep':
+        qv_compress.sweep.run_sweep(
+            args.training_alignments, args.num_codes, args.num_observations,
+            args.features_to_cluster, args.batch_size, args.sampling,
+            args.workers, args.output_json, args.knee_code_book, args.seed)
+    elif args.cmd == 'benchmark':
+        benchmark_results = qv_compress.benchmark.run_benchmarks(
+            args.output_json, args.work_dir, args.num_aln_groups,
+            args.num_reads, args.read_length, args.num_codes,
+            args.num_observations, args.repeat, args.workers)
+        if args.compare is not None:
+            qv_compress.benchmark.compare_benchmarks(args.compare,
+                                                     benchmark_results)
+
+    if args.profile:
+        qv_compress.metrics.log_report()
+    if args.metrics:
+        qv_compress.metrics.write_report(args.metrics)
+    return exit_status
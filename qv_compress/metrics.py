@@ -0,0 +1,161 @@
+"""metrics records the wall time, bases, and bytes of each stage of a
+qv_compress run, logs progress, and writes a JSON report.
+
+Nothing is recorded until enable is called. Until then stage returns a
+shared no-op context manager and progress returns immediately, so
+instrumented code pays only for a function call.
+
+Workers started by multiprocessing disable metrics, so stages they run
+don't appear in the report.
+"""
+import contextlib
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+
+log = logging.getLogger('main')
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 10.0
+
+_state = {'enabled': False}
+_lock = threading.Lock()
+
+class _NoStage(object):
+    """Context manager used by stage when metrics are off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_STAGE = _NoStage()
+
+def enable():
+    """Start recording stages and logging progress."""
+
+    _state.update(enabled=True, start_time=time.time(), stages={},
+                  progress_total=None, progress_done=0, progress_unit='bases',
+                  progress_start=None, progress_logged=None)
+
+def disable():
+    """Stop recording, e.g. in worker processes that inherited the state of
+    their parent.
+    """
+
+    _state['enabled'] = False
+
+def record(name, seconds, bases=0, num_bytes=0):
+    """Add a measurement to the totals of a stage."""
+
+    if not _state['enabled']:
+        return
+    with _lock:
+        totals = _state['stages'].setdefault(
+            name, {'calls': 0, 'seconds': 0.0, 'bases': 0, 'bytes': 0})
+        totals['calls'] += 1
+        totals['seconds'] += seconds
+        totals['bases'] += int(bases)
+        totals['bytes'] += int(num_bytes)
+
+@contextlib.contextmanager
+def _timed_stage(name, bases, num_bytes):
+    start_time = time.time()
+    yield
+    record(name, time.time() - start_time, bases, num_bytes)
+
+def stage(name, bases=0, num_bytes=0):
+    """Context manager that times the code inside it as part of a stage.
+
+    Args:
+        name: the name of the stage, e.g. "hdf5_read"
+        bases: the number of bases the code processes
+        num_bytes: the number of bytes the code reads or writes
+    """
+
+    if not _state['enabled']:
+        return _NO_STAGE
+    return _timed_stage(name, bases, num_bytes)
+
+def start_progress(total=None, unit='bases'):
+    """Start counting progress towards total, which may be None if it isn't
+    known, in which case no ETA is logged.
+    """
+
+    if not _state['enabled']:
+        return
+    _state.update(progress_total=total, progress_done=0, progress_unit=unit,
+                  progress_start=time.time(), progress_logged=time.time())
+
+def progress(done):
+    """Count done more units of progress, and log a progress line with the
+    rate and ETA if PROGRESS_INTERVAL has passed since the last one.
+    """
+
+    if not _state['enabled'] or _state['progress_start'] is None:
+        return
+
+    _state['progress_done'] += done
+    now = time.time()
+    if now - _state['progress_logged'] < PROGRESS_INTERVAL:
+        return
+    _state['progress_logged'] = now
+
+    done = _state['progress_done']
+    total = _state['progress_total']
+    rate = done / max(now - _state['progress_start'], 1e-9)
+    message = "Processed {d} {u}, {r:.0f} {u}/sec".format(
+        d=done, u=_state['progress_unit'], r=rate)
+    if total:
+        message += ", {p:.1f}% done, ETA {e:.0f} s".format(
+            p=100.0 * done / total, e=max(total - done, 0) / max(rate, 1e-9))
+    log.info(message)
+
+def peak_rss_mb():
+    """The peak resident set size of this process and its finished children,
+    in MB.
+    """
+
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on OS X and KB elsewhere
+    if sys.platform == 'darwin':
+        return peak_rss / 1024.0 ** 2
+    return peak_rss / 1024.0
+
+def report():
+    """Return the recorded metrics as a dict."""
+
+    stages = {}
+    for name, totals in _state.get('stages', {}).items():
+        stages[name] = dict(totals)
+        if totals['seconds'] > 0:
+            stages[name]['bases_per_second'] = totals['bases'] / totals['seconds']
+            stages[name]['bytes_per_second'] = totals['bytes'] / totals['seconds']
+
+    return {'command': sys.argv,
+            'seconds': time.time() - _state.get('start_time', time.time()),
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': stages}
+
+def log_report():
+    """Log the time spent in each stage."""
+
+    metrics_report = report()
+    for name, totals in sorted(metrics_report['stages'].items(),
+                               key=lambda k: -k[1]['seconds']):
+        log.info("{n}: {s:.2f} s in {c} calls, {b} bases, {y} bytes".format(
+            n=name, s=totals['seconds'], c=totals['calls'], b=totals['bases'],
+            y=totals['bytes']))
+    log.info("Total {s:.2f} s, peak RSS {r:.1f} MB".format(
+        s=metrics_report['seconds'], r=metrics_report['peak_rss_mb']))
+
+def write_report(filename):
+    """Write the recorded metrics to a JSON file."""
+
+    with open(filename, 'w') as report_file:
+        json.dump(report(), report_file, indent=2, sort_keys=True)
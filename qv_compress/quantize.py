@@ -1,37 +1,272 @@
-import h5py
-import itertools
+import collections
+import hashlib
 import json
+import logging
+import multiprocessing
+import re
 import numpy
-import pysam
-from scipy.cluster import vq
+import os
+import Queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
 
-from qv_compress import code_book, utils
+from qv_compress import bgzf, code_book, entropy, kmeans, metrics, utils
+
+h5py = utils.LazyModule('h5py')
+pysam = utils.LazyModule('pysam')
+
+log = logging.getLogger('main')
 
 BUFFER_SIZE = 500000
+# Number of shards a BAM is split into for each worker of a parallel encode
+BAM_SHARDS_PER_WORKER = 4
+
+# Number of chunks that can wait between the reader, quantizer, and writer
+# of a pipelined cmp.h5 encode
+PIPELINE_DEPTH = 2
+# Number of chunks per worker that a pooled cmp.h5 encode reads ahead
+POOL_CHUNKS_PER_WORKER = 2
+# Size in bytes of the HDF5 raw data chunk cache of each dataset
+CHUNK_CACHE_SIZE = 64 * 1024 ** 2
+MAX_LOOKUP_TABLE_SIZE = 2 ** 27
+
+# Length of the HDF5 chunks of the datasets in a compact cmp.h5
+COMPACT_CHUNK_SIZE = 2 ** 16
+COMPACT_COMPRESSION = ('gzip', 'lzf', 'none')
+COMPACT_GZIP_LEVEL = 4
+# Datasets that encode writes into an AlnGroup, which aren't copied into a
+# compact cmp.h5
+ENCODED_DATASETS = ('VQ', 'VQEntropy', 'VQEntropyOffsets',
+                    'DeletionTagRunValues', 'DeletionTagRunLengths')
+ENCODE_PROGRESS_ATTRS = ('VQCodeBook', 'VQWrittenEnd', 'VQOverwrittenEnd')
+
+# Per-process state for encoding workers, set by _init_encode_worker
+_worker_state = {}
+
 
+def get_code_indices(chunk_data, raw_codes, feature_list, std_dev=None,
+                     whitened_codes=None, threads=1):
+    """Get nearest code index for each row in chunk_data.
 
-def get_code_indices(chunk_data, raw_codes, feature_list):
-    """Get nearest code index for each row in chunk_data."""
+    Args:
+        chunk_data: numpy array of raw QVs, one column per feature
+        raw_codes: numpy array of code values, as returned by read_code_book
+        feature_list: labels for the columns of chunk_data and raw_codes
+        std_dev: the standard deviations used to whiten the training data. If
+            None, they are calculated from chunk_data.
+        whitened_codes: raw_codes whitened with std_dev. If None, they are
+            calculated here.
+        threads: the number of threads searching blocks of chunk_data
+    """
+
+    if std_dev is not None:
+        std_dev = numpy.array(std_dev, dtype='float64')
 
     clusterable_data, std_dev = code_book.make_data_clusterable(
-        chunk_data, feature_list, std_dev=None, remove_skips=False)
+        chunk_data, feature_list, std_dev=std_dev, remove_skips=False)
 
-    whitened_codes, std_dev = code_book.make_data_clusterable(
-        raw_codes, feature_list, std_dev=std_dev, remove_skips=False)
+    if whitened_codes is None:
+        whitened_codes, std_dev = code_book.make_data_clusterable(
+            raw_codes, feature_list, std_dev=std_dev, remove_skips=False)
 
-    code_indices, distortions = vq.vq(clusterable_data, whitened_codes)
+    with metrics.stage("vq", len(clusterable_data)):
+        code_indices, distortions = kmeans.nearest_codes(
+            clusterable_data, whitened_codes, threads)
     return code_indices
 
 
-def write_vqs_to_cmph5(cmph5_file, cmph5_chunk, chunk_indices):
+class CodeLookupTable(object):
+    """Map feature tuples directly to their nearest code index.
 
-    aln_group = cmph5_file[cmph5_chunk.aln_group_path]
+    QVs and tags are small integers, so the number of distinct feature tuples
+    in a file is small. Each feature's values are mapped to a compact index,
+    and the raveled indices address a dense table of code indices, so
+    encoding a base is a handful of array lookups with no floating point
+    math. Table entries are filled with a distance search the first time
+    their tuple is seen.
+
+    Because the table caches code assignments, the whitening has to be fixed,
+    so the table needs the std_dev of training, which only a binary code
+    book carries. It then assigns the same codes as get_code_indices with
+    that std_dev.
+    """
+
+    def __init__(self, raw_codes, feature_list, std_dev, threads=1):
+        """Build the table.
+
+        Args:
+            raw_codes: numpy array of code values, as returned by read_code_book
+            feature_list: labels for the columns of raw_codes
+            std_dev: standard deviations used to whiten the training data
+            threads: the number of threads of the distance searches that fill
+                the table
+
+        Raises:
+            ValueError: if std_dev is None
+        """
+        if std_dev is None:
+            raise ValueError("A lookup table needs the whitening of training, "
+                             "so it can only be used with a .npz code book")
+        std_dev = numpy.array(std_dev, dtype='float64')
+        self.feature_list = feature_list
+        self.threads = threads
+        self.whitened_codes, self.std_dev = code_book.make_data_clusterable(
+            raw_codes, feature_list, std_dev=std_dev, remove_skips=False)
+
+        # Compact index of each possible uint8 value, per feature. -1 marks
+        # values that aren't in the table.
+        self.value_maps = -numpy.ones((len(feature_list), 256), dtype='int64')
+        self.feature_values = [numpy.zeros(0, dtype='int64')
+                               for _ in feature_list]
+        self.table = -numpy.ones(0, dtype='int16')
+
+        # Every code value, plus the skip and deletion values that fill the
+        # gaps between alignments, and every possible DeletionTag.
+        initial_values = [numpy.concatenate((raw_codes[:, k], [0, 255]))
+                          for k in xrange(len(feature_list))]
+        if "DeletionTag" in feature_list:
+            initial_values[feature_list.index("DeletionTag")] = numpy.concatenate(
+                (initial_values[feature_list.index("DeletionTag")],
+                 [k for k, v in utils.TAG_ASSIGNMENTS]))
+        self._add_values(initial_values)
+        self.get_code_indices(numpy.concatenate(
+            (raw_codes, numpy.zeros((1, len(feature_list))),
+             numpy.ones((1, len(feature_list))) * 255)))
+
+    def _table_tuples(self, flat_indices):
+        """Convert flat table indices back into rows of feature values."""
+        compact_indices = numpy.unravel_index(
+            flat_indices, [len(k) for k in self.feature_values])
+        return numpy.column_stack(
+            [self.feature_values[k][compact_indices[k]]
+             for k in xrange(len(self.feature_list))])
+
+    def _add_values(self, new_values):
+        """Add feature values to the table, keeping the entries already filled.
+
+        Returns:
+            False if the table would grow past MAX_LOOKUP_TABLE_SIZE, in which
+            case it is left unchanged
+        """
+        feature_values = [numpy.union1d(self.feature_values[k],
+                                        numpy.asarray(new_values[k], dtype='int64'))
+                          for k in xrange(len(self.feature_list))]
+        shape = [len(k) for k in feature_values]
+        if numpy.prod(shape, dtype='int64') > MAX_LOOKUP_TABLE_SIZE:
+            return False
+
+        filled = numpy.nonzero(self.table >= 0)[0]
+        if len(filled):
+            filled_tuples = self._table_tuples(filled)
+
+        self.feature_values = feature_values
+        for feature_i, values in enumerate(feature_values):
+            self.value_maps[feature_i, values] = numpy.arange(len(values))
+        new_table = -numpy.ones(numpy.prod(shape), dtype='int16')
+        if len(filled):
+            new_table[self._flat_indices(filled_tuples)] = self.table[filled]
+        self.table = new_table
+        return True
+
+    def _compact_indices(self, data):
+        """Look up the compact index of every value in data, by feature."""
+        return [self.value_maps[k][data[:, k]]
+                for k in xrange(len(self.feature_list))]
+
+    def _flat_indices(self, data):
+        """Ravel rows of feature values into flat table indices."""
+        return numpy.ravel_multi_index(
+            self._compact_indices(data), [len(k) for k in self.feature_values])
+
+    def _fill(self, data):
+        """Run a distance search for rows of data and store the results."""
+        if len(data) == 0:
+            return
+        code_indices = self._search(data)
+        self.table[self._flat_indices(data)] = code_indices
+
+    def _search(self, data):
+        """Find the nearest codes for data without touching the table."""
+        clusterable_data, std_dev = code_book.make_data_clusterable(
+            data, self.feature_list, std_dev=self.std_dev, remove_skips=False)
+        code_indices, distortions = kmeans.nearest_codes(
+            clusterable_data, self.whitened_codes, self.threads)
+        return code_indices
+
+    def get_code_indices(self, chunk_data):
+        """Get nearest code index for each row in chunk_data."""
+
+        start_time = time.time()
+        data = numpy.asarray(chunk_data).astype('uint8')
+        compact_indices = self._compact_indices(data)
+
+        unmapped = numpy.zeros(len(data), dtype=bool)
+        for feature_i in xrange(len(self.feature_list)):
+            unmapped |= compact_indices[feature_i] < 0
+        if unmapped.any():
+            new_values = [numpy.unique(data[unmapped, k])
+                          for k in xrange(len(self.feature_list))]
+            if self._add_values(new_values):
+                compact_indices = self._compact_indices(data)
+                unmapped[:] = False
+
+        code_indices = numpy.zeros(len(data), dtype='int16')
+        if unmapped.any():
+            # The table is full, so fall back to a distance search for
+            # the rows it can't hold.
+            code_indices[unmapped] = self._search(data[unmapped])
+            data = data[~unmapped]
+            compact_indices = [k[~unmapped] for k in compact_indices]
+
+        if len(data):
+            flat_indices = numpy.ravel_multi_index(
+                compact_indices, [len(k) for k in self.feature_values])
+            mapped_indices = self.table[flat_indices]
+
+            missing = mapped_indices < 0
+            if missing.any():
+                missing_flat_indices = numpy.unique(flat_indices[missing])
+                self._fill(self._table_tuples(missing_flat_indices))
+                mapped_indices = self.table[flat_indices]
+
+            code_indices[~unmapped] = mapped_indices
+
+        metrics.record("lookup_table", time.time() - start_time, len(chunk_data))
+        return code_indices
+
+def create_vq_dataset(cmph5_file, aln_group_path, chunks=True):
+    """Create the VQ dataset for an AlnGroup if it isn't there already."""
+
+    aln_group = cmph5_file[aln_group_path]
     if not aln_group.get("VQ"):
         full_aln_group_len = len(aln_group['AlnArray'])
         aln_group.create_dataset("VQ", (full_aln_group_len,), dtype='uint8',
-                                 chunks=True)
-    aln_group["VQ"][cmph5_chunk.aln_group_start:cmph5_chunk.aln_group_end] =\
-        chunk_indices
+                                 chunks=chunks)
+
+def hdf5_aligned_chunk_size(cmph5_file, feature_list, chunk_size):
+    """Round chunk_size down to a whole number of HDF5 chunks of the feature
+    datasets, so that reads and writes cover whole HDF5 chunks.
+    """
+
+    aln_group = cmph5_file[cmph5_file['AlnGroup/Path'][0]]
+    hdf5_chunk_lens = [aln_group[k].chunks[0] for k in feature_list
+                       if aln_group[k].chunks is not None]
+    if not hdf5_chunk_lens:
+        return chunk_size
+
+    hdf5_chunk_len = max(hdf5_chunk_lens)
+    return max(chunk_size // hdf5_chunk_len, 1) * hdf5_chunk_len
+
+def write_vqs_to_cmph5(cmph5_file, cmph5_chunk, chunk_indices):
+
+    create_vq_dataset(cmph5_file, cmph5_chunk.aln_group_path)
+    aln_group = cmph5_file[cmph5_chunk.aln_group_path]
+    with metrics.stage("hdf5_write", len(chunk_indices), len(chunk_indices)):
+        aln_group["VQ"][cmph5_chunk.aln_group_start:cmph5_chunk.aln_group_end] =\
+            chunk_indices
 
 def overwrite_qvs_cmph5_chunk(cmph5_file, chunk, code_indices, code_book,
                               feature_list):
@@ -42,10 +277,70 @@ def overwrite_qvs_cmph5_chunk(cmph5_file, chunk, code_indices, code_book,
     
     full_feature_array = code_book[code_indices]
 
-    for feature_i in xrange(len(feature_list)):
-        feature_name = feature_list[feature_i]
-        aln_group[feature_name][chunk.aln_group_start:chunk.aln_group_end] =\
-            full_feature_array[...,feature_i]
+    with metrics.stage("hdf5_write", len(code_indices),
+                       len(code_indices) * len(feature_list)):
+        for feature_i in xrange(len(feature_list)):
+            feature_name = feature_list[feature_i]
+            aln_group[feature_name][chunk.aln_group_start:chunk.aln_group_end] =\
+                full_feature_array[...,feature_i]
+
+def load_code_book(code_book_filename):
+    """Reads a code book written by code_book.write_code_book, in either the
+    binary .npz format or CSV.
+
+    Returns:
+        raw_codes: a numpy.array of the code values
+        code_book_features: a list of the names of features associated with
+                            columns of raw_codes
+        std_dev: the standard deviations used to whiten the training data, or
+                 None for a CSV code book
+    """
+
+    if not code_book_filename.endswith(".npz"):
+        raw_codes, code_book_features = read_code_book(code_book_filename)
+        return raw_codes, code_book_features, None
+
+    code_book_file = numpy.load(code_book_filename)
+    version = int(code_book_file['version'])
+    if version > code_book.CODE_BOOK_VERSION:
+        raise ValueError("Code book {c} has format version {v}, but only "
+                         "versions up to {s} are supported"
+                         .format(c=code_book_filename, v=version,
+                                 s=code_book.CODE_BOOK_VERSION))
+
+    raw_codes = code_book_file['raw_codes']
+    code_book_features = [str(k) for k in code_book_file['feature_list']]
+    std_dev = code_book_file['std_dev']
+    code_book_file.close()
+
+    return raw_codes, code_book_features, std_dev
+
+def load_group_code_books(code_book_filename):
+    """Read the code books of read groups or movies stored in a binary code
+    book by code_book.write_code_book.
+
+    Returns:
+        an OrderedDict from read group ID or movie name to the
+        (raw_codes, std_dev) of its code book. It's empty for a CSV code
+        book or a code book without them.
+    """
+
+    group_code_books = collections.OrderedDict()
+    if not code_book_filename.endswith(".npz"):
+        return group_code_books
+
+    code_book_file = numpy.load(code_book_filename)
+    if 'group_names' in code_book_file.files:
+        code_ends = numpy.cumsum(code_book_file['group_num_codes'])
+        group_raw_codes = numpy.split(code_book_file['group_raw_codes'],
+                                      code_ends[:-1])
+        for group_name, raw_codes, std_dev in zip(
+                code_book_file['group_names'], group_raw_codes,
+                code_book_file['group_std_devs']):
+            group_code_books[str(group_name)] = (raw_codes, std_dev)
+    code_book_file.close()
+
+    return group_code_books
 
 def read_code_book(code_book_filename):
     """Reads the feature names and cluster values from code book produced
@@ -56,12 +351,240 @@ def read_code_book(code_book_filename):
         code_book_features: a list of the names of features associated with
                             columns of raw_codes
     """
+    if code_book_filename.endswith(".npz"):
+        return load_code_book(code_book_filename)[:2]
+
     header_line = open(code_book_filename).readline().strip()
     code_book_features = header_line[2:].split(',')
     raw_codes = numpy.loadtxt(code_book_filename, delimiter=',', ndmin=2)
     
     return raw_codes, code_book_features
 
+def code_book_hash(raw_codes, feature_list, std_dev=None):
+    """Return a hex digest that identifies a code book and the whitening
+    used with it, so an encode can tell whether a file was partly encoded
+    with the same code book.
+    """
+
+    digest = hashlib.sha1()
+    digest.update(numpy.asarray(raw_codes).astype('uint8').tostring())
+    digest.update(','.join(feature_list))
+    if std_dev is not None:
+        digest.update(numpy.asarray(std_dev, dtype='float64').tostring())
+    return digest.hexdigest()
+
+def read_encode_progress(aln_group, code_book_digest):
+    """Read how far a previous encode of an AlnGroup got.
+
+    The progress is kept in attributes of the AlnGroup: VQCodeBook holds the
+    code_book_hash of the code book, VQWrittenEnd the end of the VQs written
+    so far, and VQOverwrittenEnd the end of the QVs overwritten so far.
+
+    Returns:
+        vq_end: the number of bases whose VQs have been written
+        qv_end: the number of bases whose QVs have been overwritten
+    """
+
+    attrs = aln_group.attrs
+    if "VQCodeBook" not in attrs:
+        return 0, 0
+
+    vq_end = int(attrs["VQWrittenEnd"])
+    qv_end = int(attrs["VQOverwrittenEnd"])
+    if attrs["VQCodeBook"] != code_book_digest:
+        if qv_end > 0:
+            raise ValueError("The QVs of {a} were overwritten with a different "
+                             "code book, so it can't be encoded again"
+                             .format(a=aln_group.name))
+        log.info("{a} was encoded with a different code book, starting over"
+                 .format(a=aln_group.name))
+        return 0, 0
+
+    return vq_end, qv_end
+
+def restore_overwritten_qvs(cmph5_file, aln_group_path, start, end, raw_codes,
+                            feature_list):
+    """Overwrite the QVs of bases start to end of an AlnGroup from the VQs
+    already written for them, rather than quantizing them again.
+    """
+
+    vq_data = numpy.empty((BUFFER_SIZE, 1), dtype='uint8', order='F')
+    aln_group = cmph5_file[aln_group_path]
+    for chunk_start in xrange(start, end, BUFFER_SIZE):
+        cmph5_chunk = utils.read_cmph5_chunk(
+            cmph5_file, utils.CmpH5Chunk(aln_group_path, chunk_start,
+                                         min(chunk_start + BUFFER_SIZE, end),
+                                         None),
+            ["VQ"], out=vq_data)
+        overwrite_qvs_cmph5_chunk(cmph5_file, cmph5_chunk,
+                                  cmph5_chunk.data[:, 0], raw_codes,
+                                  feature_list)
+        aln_group.attrs["VQOverwrittenEnd"] = cmph5_chunk.aln_group_end
+        cmph5_file.flush()
+
+def resume_encode(cmph5_file, code_book_digest, raw_codes, feature_list,
+                  overwrite_qvs, aln_group_paths=None):
+    """Prepare each AlnGroup of a cmp.h5 file to be encoded, continuing from
+    where a previous encode with the same code book stopped.
+
+    QVs are only overwritten after the VQs of their chunk are recorded, so
+    bases whose VQs were written but whose QVs weren't yet overwritten get
+    their QVs from the VQs. QVs that were overwritten are never quantized a
+    second time.
+
+    Only the AlnGroups in aln_group_paths are prepared, or all of them if
+    it's None.
+
+    Returns:
+        vq_ends: dict from AlnGroup path to the number of bases whose VQs
+            are already written
+        overwrite_qvs: True if QVs must be overwritten, which is the case if
+            a previous encode started overwriting them
+    """
+
+    if aln_group_paths is None:
+        aln_group_paths = cmph5_file['AlnGroup/Path']
+
+    vq_ends = {}
+    for aln_group_path in aln_group_paths:
+        aln_group = cmph5_file[aln_group_path]
+        vq_end, qv_end = read_encode_progress(aln_group, code_book_digest)
+        if qv_end > 0 and not overwrite_qvs:
+            log.warning("The QVs of {a} were partly overwritten, so they will "
+                        "all be overwritten".format(a=aln_group_path))
+            overwrite_qvs = True
+        if vq_end > 0:
+            log.info("Resuming {a} from base {v}".format(a=aln_group_path,
+                                                          v=vq_end))
+
+        aln_group.attrs["VQCodeBook"] = code_book_digest
+        aln_group.attrs["VQWrittenEnd"] = vq_end
+        aln_group.attrs["VQOverwrittenEnd"] = qv_end
+        vq_ends[aln_group_path] = vq_end
+
+    if overwrite_qvs:
+        for aln_group_path, vq_end in vq_ends.items():
+            qv_end = int(cmph5_file[aln_group_path].attrs["VQOverwrittenEnd"])
+            restore_overwritten_qvs(cmph5_file, aln_group_path, qv_end, vq_end,
+                                    raw_codes, feature_list)
+
+    cmph5_file.flush()
+    return vq_ends, overwrite_qvs
+
+def remaining_chunk_ranges(chunk_ranges, vq_ends):
+    """Trim chunk ranges to the bases whose VQs haven't been written yet,
+    leaving out the AlnGroups that aren't in vq_ends.
+    """
+
+    for chunk_range in chunk_ranges:
+        if chunk_range.aln_group_path not in vq_ends:
+            continue
+        start = max(chunk_range.aln_group_start,
+                    vq_ends[chunk_range.aln_group_path])
+        if start < chunk_range.aln_group_end:
+            yield chunk_range._replace(aln_group_start=start)
+
+def find_runs(values, offsets=None):
+    """Find the runs of equal values in an array.
+
+    Args:
+        values: a numpy array, usually the concatenated DeletionTags of a
+            batch of records
+        offsets: optional record boundaries, so that record i is
+            values[offsets[i]:offsets[i + 1]]. Runs never cross a boundary.
+
+    Returns:
+        run_values: the value of each run
+        run_lengths: an int64 numpy array of the length of each run
+        run_offsets: the runs of record i are run_offsets[i]:run_offsets[i + 1]
+    """
+
+    if offsets is None:
+        offsets = numpy.array([0, len(values)], dtype='int64')
+
+    is_run_start = numpy.empty(len(values), dtype='bool')
+    is_run_start[:1] = True
+    numpy.not_equal(values[1:], values[:-1], out=is_run_start[1:])
+    is_run_start[offsets[:-1][offsets[:-1] < len(values)]] = True
+
+    run_starts = numpy.flatnonzero(is_run_start)
+    run_lengths = numpy.diff(numpy.append(run_starts, len(values)))
+    run_offsets = numpy.searchsorted(run_starts, offsets)
+
+    return values[run_starts], run_lengths, run_offsets
+
+def run_length_encode_batch(values, offsets):
+    """Run length encode the DeletionTags of a batch of records at once.
+
+    Args:
+        values: uint8 numpy array of the concatenated DeletionTag characters
+        offsets: record boundaries, so that record i is
+            values[offsets[i]:offsets[i + 1]]
+
+    Returns:
+        a list with the RLE string of each record, as run_length_encode
+        would produce it
+    """
+
+    run_values, run_lengths, run_offsets = find_runs(values, offsets)
+
+    # Runs of one are written without a count
+    num_digits = numpy.zeros(len(run_lengths), dtype='int64')
+    long_runs = run_lengths > 1
+    num_digits[long_runs] = numpy.floor(
+        numpy.log10(run_lengths[long_runs])).astype('int64') + 1
+
+    char_offsets = numpy.zeros(len(run_lengths) + 1, dtype='int64')
+    numpy.cumsum(num_digits + 1, out=char_offsets[1:])
+
+    rle_array = numpy.empty(char_offsets[-1], dtype='uint8')
+    rle_array[char_offsets[1:] - 1] = run_values
+    for digit_i in xrange(int(num_digits.max()) if len(num_digits) else 0):
+        has_digit = num_digits > digit_i
+        rle_array[char_offsets[:-1][has_digit] + digit_i] = ord('0') + (
+            run_lengths[has_digit] //
+            10 ** (num_digits[has_digit] - 1 - digit_i)) % 10
+
+    rle_string = rle_array.tostring()
+    char_offsets = char_offsets[run_offsets]
+    return [rle_string[char_offsets[k]:char_offsets[k + 1]]
+            for k in xrange(len(offsets) - 1)]
+
+def run_length_decode_batch(rle_strings):
+    """Expand the RLE strings of a batch of records at once.
+
+    Args:
+        rle_strings: a list of strings produced by run_length_encode
+
+    Returns:
+        values: uint8 numpy array of the concatenated expanded strings
+        offsets: record boundaries, so that the expansion of rle_strings[i]
+            is values[offsets[i]:offsets[i + 1]]
+    """
+
+    string_offsets = numpy.zeros(len(rle_strings) + 1, dtype='int64')
+    numpy.cumsum([len(k) for k in rle_strings], out=string_offsets[1:])
+    rle_array = numpy.fromstring(''.join(rle_strings), dtype='uint8')
+
+    is_digit = (rle_array >= ord('0')) & (rle_array <= ord('9'))
+    char_positions = numpy.flatnonzero(~is_digit)
+    digit_positions = numpy.flatnonzero(is_digit)
+
+    # Each digit belongs to the run of the next non-digit, and is worth
+    # 10 ** (number of digits between it and that character)
+    digit_runs = numpy.searchsorted(char_positions, digit_positions)
+    digit_values = ((rle_array[digit_positions] - ord('0')).astype('int64') *
+                    10 ** (char_positions[digit_runs] - digit_positions - 1))
+    run_lengths = numpy.bincount(digit_runs, weights=digit_values,
+                                 minlength=len(char_positions)).astype('int64')
+    run_lengths[run_lengths == 0] = 1
+
+    run_ends = numpy.zeros(len(char_positions) + 1, dtype='int64')
+    numpy.cumsum(run_lengths, out=run_ends[1:])
+    offsets = run_ends[numpy.searchsorted(char_positions, string_offsets)]
+
+    return numpy.repeat(rle_array[char_positions], run_lengths), offsets
+
 def run_length_encode(tags_to_encode):
     """Perform run length encoding.
 
@@ -73,82 +596,1107 @@ def run_length_encode(tags_to_encode):
             the function would return 5N1C2N2T1C
     """
 
-    rle_list = [(len(list(g)), str(k))
-                for k,g in itertools.groupby(tags_to_encode)]
-    rle_string = ''.join([(str(n) if n > 1 else '') + str(c) for n, c in rle_list])
-    return rle_string
+    return run_length_encode_batch(
+        numpy.fromstring(tags_to_encode, dtype='uint8'),
+        numpy.array([0, len(tags_to_encode)], dtype='int64'))[0]
 
-def add_vqs_to_file(filename, code_book_filename, overwrite_qvs=False,
-                    rle_deltag=False, output_filename=None):
-    """Add VQ values to a cmp.h5, SAM, or BAM file. 
-    
-    If the file is a cmp.h5, write a dataset named VQ to each align
-    group that represents the index in the code book. Optionally, overwrite
-    all the QVs with values from the code book.
+def run_length_decode(rle_string):
+    """Expand a string produced by run_length_encode.
 
-    If the file is a SAM or BAM, write code book indices to the QUAL field
-    and put the code book in the header.
+    Args:
+        rle_string: the RLE string, for example 5N1C2N2T1C or 5NC2N2TC
+
+    Returns:
+        the expanded string, NNNNNCNNTTC in the example
+    """
+
+    return run_length_decode_batch([rle_string])[0].tostring()
+
+def find_cmph5_deltag_runs(cmph5_file, aln_group_path):
+    """Find the runs of the DeletionTag of an AlnGroup, reading it a chunk at
+    a time.
+
+    Returns:
+        run_values: uint8 numpy array of the tag of each run
+        run_lengths: uint32 numpy array of the length of each run
+    """
+
+    deltag_data = numpy.empty((BUFFER_SIZE, 1), dtype='uint8', order='F')
+    aln_group_len = len(cmph5_file[aln_group_path]["DeletionTag"])
+    all_values = [numpy.zeros(0, dtype='uint8')]
+    all_lengths = [numpy.zeros(0, dtype='int64')]
+
+    for chunk_start in xrange(0, aln_group_len, BUFFER_SIZE):
+        cmph5_chunk = utils.read_cmph5_chunk(
+            cmph5_file,
+            utils.CmpH5Chunk(aln_group_path, chunk_start,
+                             min(chunk_start + BUFFER_SIZE, aln_group_len),
+                             None),
+            ["DeletionTag"], out=deltag_data)
+        run_values, run_lengths, _ = find_runs(cmph5_chunk.data[:, 0])
+
+        # Join a run that continues from the previous chunk
+        if len(all_values) > 1 and all_values[-1][-1] == run_values[0]:
+            all_lengths[-1][-1] += run_lengths[0]
+            run_values, run_lengths = run_values[1:], run_lengths[1:]
+        all_values.append(run_values)
+        all_lengths.append(run_lengths)
+
+    return (numpy.concatenate(all_values).astype('uint8'),
+            numpy.concatenate(all_lengths).astype('uint32'))
+
+def write_rle_deltag_cmph5(cmph5_file, aln_group_paths=None):
+    """Write the DeletionTag of each AlnGroup of a cmp.h5 as its runs, in
+    DeletionTagRunValues and DeletionTagRunLengths datasets.
 
     Args:
-        filename: path to the cmp.h5, SAM, or BAM file
-        code_book_filename: path to the code book produced by build_code_book
-        overwrite_qvs: if True, overwrite QVs with values from the code book
+        cmph5_file: an h5py.File open for writing
+        aln_group_paths: the AlnGroups to write. If None, all of them.
     """
 
-    raw_codes, code_book_features = read_code_book(code_book_filename)
+    if aln_group_paths is None:
+        aln_group_paths = cmph5_file['AlnGroup/Path'][:]
+
+    for aln_group_path in aln_group_paths:
+        aln_group = cmph5_file[aln_group_path]
+        run_values, run_lengths = find_cmph5_deltag_runs(cmph5_file,
+                                                         aln_group_path)
+        for dataset_name, runs in (("DeletionTagRunValues", run_values),
+                                   ("DeletionTagRunLengths", run_lengths)):
+            if aln_group.get(dataset_name):
+                del aln_group[dataset_name]
+            aln_group.create_dataset(dataset_name, data=runs, chunks=True)
+
+def read_rle_deltag_cmph5(aln_group, start, end):
+    """Expand the DeletionTag of bases start to end of an AlnGroup from the
+    datasets written by write_rle_deltag_cmph5.
+
+    Returns:
+        a uint8 numpy array of DeletionTag values
+    """
+
+    run_ends = numpy.cumsum(aln_group["DeletionTagRunLengths"][:],
+                            dtype='int64')
+    return expand_runs(run_ends, aln_group["DeletionTagRunValues"], start, end)
+
+def expand_runs(run_ends, run_values, start, end):
+    """Expand positions start to end of runs.
+
+    Args:
+        run_ends: numpy array of the position after the end of each run
+        run_values: the value of each run, as a numpy array or an h5py
+            dataset, of which only the runs needed are read
+
+    Returns:
+        a numpy array of the values at positions start to end
+    """
+
+    first_run = numpy.searchsorted(run_ends, start, 'right')
+    last_run = numpy.searchsorted(run_ends, end - 1, 'right') + 1
+
+    run_ends = run_ends[first_run:last_run].clip(None, end)
+    run_lengths = numpy.diff(numpy.append(start, run_ends))
+    return numpy.repeat(run_values[first_run:last_run], run_lengths)
+
+def deltag_run_groups(cmph5_file, aln_group_paths, feature_list):
+    """Find the AlnGroups whose DeletionTag runs write_rle_deltag_cmph5
+    should write before an encode with rle_deltag.
+
+    Runs are written for the groups that still have their DeletionTag, unless
+    runs were already written and some QVs have been overwritten since.
+
+    Raises:
+        ValueError: if a group has no runs, but a previous encode already
+            overwrote part of its DeletionTag with code book values, so its
+            original tags are lost
+    """
+
+    run_groups = []
+    for aln_group_path in aln_group_paths:
+        aln_group = cmph5_file[aln_group_path]
+        if not aln_group.get("DeletionTag"):
+            continue
+        qv_end = int(aln_group.attrs.get("VQOverwrittenEnd", 0))
+        if aln_group.get("DeletionTagRunValues") and qv_end > 0:
+            continue
+        if qv_end > 0 and "DeletionTag" in feature_list:
+            raise ValueError("The DeletionTag of {a} was partly overwritten "
+                             "by an encode without --rle_deltag, so its runs "
+                             "can't be written".format(a=aln_group_path))
+        run_groups.append(aln_group_path)
+    return run_groups
+
+def make_code_assigner(raw_codes, feature_list, lookup_table=False,
+                       std_dev=None, threads=1):
+    """Return a function that gets the nearest code index for each row of a
+    chunk of data, using either a CodeLookupTable or get_code_indices.
+
+    If std_dev is given, every chunk is whitened with it and the codes are
+    whitened once, up front. Otherwise get_code_indices whitens each chunk
+    with its own standard deviations. Distance searches are spread over
+    threads.
+    """
+
+    if lookup_table:
+        return CodeLookupTable(raw_codes, feature_list, std_dev,
+                               threads).get_code_indices
+    elif std_dev is not None:
+        whitened_codes, std_dev = code_book.make_data_clusterable(
+            raw_codes, feature_list, std_dev=numpy.array(std_dev, dtype='float64'),
+            remove_skips=False)
+        return lambda data: get_code_indices(data, raw_codes, feature_list,
+                                             std_dev, whitened_codes, threads)
+    else:
+        return lambda data: get_code_indices(data, raw_codes, feature_list,
+                                             threads=threads)
+
+class GroupCodeAssigner(object):
+    """Assign codes with a code book per read group or movie, falling back
+    to a default code book for the rest.
+
+    The code assigner of every code book is made once, up front, so picking
+    the code book of a group is a dict lookup, and a chunk of bases from
+    several groups takes one code assignment per group in it.
+
+    Args:
+        raw_codes, std_dev: the default code book
+        group_code_books: an OrderedDict from group name to the
+            (raw_codes, std_dev) of its code book, as returned by
+            load_group_code_books
+        The other arguments are as for make_code_assigner.
+    """
+
+    def __init__(self, raw_codes, feature_list, group_code_books=None,
+                 lookup_table=False, std_dev=None, threads=1):
+        group_code_books = group_code_books or {}
+        self.group_indices = dict((k, i + 1)
+                                  for i, k in enumerate(group_code_books))
+        self.assigners = [make_code_assigner(raw_codes, feature_list,
+                                             lookup_table, std_dev, threads)]
+        self.assigners += [make_code_assigner(k[0], feature_list,
+                                              lookup_table, k[1], threads)
+                           for k in group_code_books.values()]
+
+    def group_index(self, group_name):
+        """The index of the code book of a group, 0 for the default."""
+
+        return self.group_indices.get(group_name, 0)
+
+    def for_group(self, group_name):
+        """Return the code assigner of a group's code book."""
+
+        return self.assigners[self.group_index(group_name)]
+
+    def __call__(self, data, row_groups=None):
+        """Get the code index of each row of data.
 
-    if filename.endswith(".cmp.h5"):
+        Args:
+            row_groups: the group_index of each row. If None, every row uses
+                the default code book.
+        """
 
-        cmph5_file = h5py.File(filename, 'r+')
+        if row_groups is None:
+            return self.assigners[0](data)
 
-        for cmph5_chunk in utils.cmph5_chunker(
-                filename, code_book_features, BUFFER_SIZE):
+        code_indices = numpy.empty(len(data), dtype='int32')
+        for group_i in numpy.unique(row_groups):
+            rows = row_groups == group_i
+            code_indices[rows] = self.assigners[group_i](data[rows])
+        return code_indices
 
-            chunk_code_indices = get_code_indices(cmph5_chunk.data, raw_codes,
-                                                  code_book_features)
+def _init_encode_worker(raw_codes, feature_list, lookup_table, std_dev,
+                        group_code_books=None, threads=1):
+    """Set up the state an encoding worker process needs. Nothing in it is
+    tied to one file, so a pool can encode chunks and shards of any file
+    using the same code books.
+    """
+
+    metrics.disable()
+
+    _worker_state['feature_list'] = feature_list
+    _worker_state['assign_codes'] = GroupCodeAssigner(
+        raw_codes, feature_list, group_code_books, lookup_table, std_dev,
+        threads)
+
+def make_encode_pool(workers, raw_codes, feature_list, lookup_table=False,
+                     std_dev=None, group_code_books=None, threads=1):
+    """Return a pool of processes set up by _init_encode_worker, each
+    searching for codes with threads threads.
+    """
+
+    return multiprocessing.Pool(
+        workers, _init_encode_worker,
+        (raw_codes, feature_list, lookup_table, std_dev, group_code_books,
+         threads))
+
+def _worker_code_indices(chunk_data, code_book_group):
+    """Get the code indices of a chunk of data in a worker process.
+
+    Args:
+        chunk_data: the data of a chunk, read by the parent process
+        code_book_group: the group whose code book is used, or None for the
+            default code book
+    """
+
+    return _worker_state['assign_codes'].for_group(code_book_group)(chunk_data)
+
+def pooled_code_indices(pool, cmph5_file, chunk_ranges, feature_list,
+                        workers, code_book_group=None):
+    """Assign codes to the chunks of a cmp.h5 file in a pool made by
+    make_encode_pool, yielding each chunk range and its code indices in
+    order.
+
+    Chunks are read here and only their data is sent to the workers, so
+    no worker holds a handle on a file this process is writing. At most
+    POOL_CHUNKS_PER_WORKER chunks per worker are read ahead of the chunk
+    being yielded.
+    """
+
+    in_flight = collections.deque()
+    max_in_flight = POOL_CHUNKS_PER_WORKER * max(workers, 1)
+
+    for chunk_range in chunk_ranges:
+        cmph5_chunk = utils.read_cmph5_chunk(cmph5_file, chunk_range,
+                                             feature_list)
+        in_flight.append((chunk_range, pool.apply_async(
+            _worker_code_indices, (cmph5_chunk.data, code_book_group))))
+        if len(in_flight) >= max_in_flight:
+            chunk_range, result = in_flight.popleft()
+            yield chunk_range, result.get()
+
+    while in_flight:
+        chunk_range, result = in_flight.popleft()
+        yield chunk_range, result.get()
+
+def _pipeline_put(work_queue, item, stop):
+    """Put item on a bounded queue, giving up if stop gets set."""
+
+    while not stop.is_set():
+        try:
+            work_queue.put(item, timeout=0.1)
+            return
+        except Queue.Full:
+            pass
+
+def _pipeline_get(work_queue, stop):
+    """Get an item from a queue, returning None if stop gets set."""
+
+    while not stop.is_set():
+        try:
+            return work_queue.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+    return None
+
+def pipelined_code_indices(cmph5_file, chunk_ranges, feature_list,
+                           assign_codes, write_results):
+    """Assign codes to the chunks of a cmp.h5 file while the next chunk is
+    read and the previous one is written in background threads.
+
+    Args:
+        cmph5_file: open h5py.File to read from
+        chunk_ranges: list of CmpH5Chunk ranges to encode, in order
+        feature_list: the features to read
+        assign_codes: function from make_code_assigner
+        write_results: function called with each chunk range and its code
+            indices, in order, from the writer thread
+    """
+
+    read_queue = Queue.Queue(maxsize=PIPELINE_DEPTH)
+    write_queue = Queue.Queue(maxsize=PIPELINE_DEPTH)
+    stop = threading.Event()
+    # sys.exc_info() of anything raised in the threads, re-raised here with
+    # its traceback
+    errors = []
+
+    # Chunks are read into a ring of buffers. A buffer is reused only after
+    # its chunk has left the queue and been quantized.
+    buffers = [numpy.empty((max([k.aln_group_end - k.aln_group_start
+                                 for k in chunk_ranges] or [0]),
+                            len(feature_list)), dtype='uint8', order='F')
+               for _ in xrange(PIPELINE_DEPTH + 2)]
+
+    def read_chunks():
+        try:
+            for chunk_i, chunk_range in enumerate(chunk_ranges):
+                _pipeline_put(read_queue, utils.read_cmph5_chunk(
+                    cmph5_file, chunk_range, feature_list,
+                    out=buffers[chunk_i % len(buffers)]), stop)
+        except:
+            errors.append(sys.exc_info())
+            stop.set()
+        finally:
+            _pipeline_put(read_queue, None, stop)
+
+    def write_chunks():
+        try:
+            while True:
+                item = _pipeline_get(write_queue, stop)
+                if item is None:
+                    break
+                write_results(*item)
+        except:
+            errors.append(sys.exc_info())
+            stop.set()
+
+    reader = threading.Thread(target=read_chunks)
+    writer = threading.Thread(target=write_chunks)
+    reader.daemon = writer.daemon = True
+    reader.start()
+    writer.start()
+
+    try:
+        while True:
+            cmph5_chunk = _pipeline_get(read_queue, stop)
+            if cmph5_chunk is None:
+                break
+            chunk_code_indices = assign_codes(cmph5_chunk.data)
+            _pipeline_put(write_queue,
+                          (cmph5_chunk._replace(data=None), chunk_code_indices),
+                          stop)
+    except:
+        stop.set()
+        raise
+    finally:
+        _pipeline_put(write_queue, None, stop)
+        reader.join()
+        writer.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+def add_vqs_to_cmph5(filename, raw_codes, feature_list, overwrite_qvs=False,
+                     lookup_table=False, workers=1, pipeline=False,
+                     std_dev=None, rle_deltag=False, pool=None,
+                     aln_group_paths=None, code_book_group=None, threads=1):
+    """Write a VQ dataset to each AlnGroup of a cmp.h5 file, and optionally
+    overwrite its QVs with values from the code book.
+
+    With more than one worker, chunks are assigned codes in a pool of
+    processes, while this process does all the reading and writing, in file
+    order, so the output is the same as with one worker.
+
+    With pipeline, and a single worker, chunks are read and written in
+    background threads while the current chunk is quantized. Chunks are sized
+    to whole HDF5 chunks of the QV datasets and VQ is chunked to match.
+
+    With rle_deltag, the original DeletionTag of each AlnGroup is stored as
+    runs by write_rle_deltag_cmph5, and the per-base DeletionTag dataset is
+    deleted once the VQs are written.
+
+    Progress is recorded in each AlnGroup after every chunk, so an encode
+    that was interrupted continues where it stopped when it is run again
+    with the same code book, see resume_encode.
+
+    If pool, a pool made by make_encode_pool with the same code book, is
+    given, it is used instead of starting one, and is left running.
+
+    Only the AlnGroups in aln_group_paths are encoded, or all of them if
+    it's None. code_book_group names the group in the pool's code books that
+    raw_codes is, see GroupCodeAssigner, and is written to the
+    VQCodeBookGroup attribute of each AlnGroup, empty for the default code
+    book.
+
+    Each process spreads its distance searches over threads.
+    """
+
+    own_pool = pool is None and workers > 1
+
+    if own_pool:
+        # Fork before opening the file, so the workers don't inherit it
+        pool = make_encode_pool(workers, raw_codes, feature_list, lookup_table,
+                                std_dev, threads=threads)
+
+    try:
+        cmph5_file = h5py.File(filename, 'r+', rdcc_nbytes=CHUNK_CACHE_SIZE)
+        if aln_group_paths is None:
+            aln_group_paths = list(cmph5_file['AlnGroup/Path'])
+
+        if rle_deltag:
+            # The DeletionTag of a group is only original until its QVs are
+            # overwritten, so keep the runs written before that, and write
+            # them before resume_encode overwrites any more QVs.
+            write_rle_deltag_cmph5(cmph5_file, deltag_run_groups(
+                cmph5_file, aln_group_paths, feature_list))
+
+        vq_ends, overwrite_qvs = resume_encode(
+            cmph5_file, code_book_hash(raw_codes, feature_list, std_dev),
+            raw_codes, feature_list, overwrite_qvs, aln_group_paths)
+        for aln_group_path in aln_group_paths:
+            cmph5_file[aln_group_path].attrs["VQCodeBookGroup"] = (
+                code_book_group or '')
+        aln_group_lens = dict((k, len(cmph5_file[k]['AlnArray']))
+                              for k in aln_group_paths)
+        num_remaining = sum(aln_group_lens[k] - vq_ends[k]
+                            for k in aln_group_lens)
+
+        def write_results(cmph5_chunk, chunk_code_indices):
+            aln_group = cmph5_file[cmph5_chunk.aln_group_path]
             write_vqs_to_cmph5(cmph5_file, cmph5_chunk, chunk_code_indices)
+            aln_group.attrs["VQWrittenEnd"] = cmph5_chunk.aln_group_end
+            cmph5_file.flush()
             if overwrite_qvs:
                 overwrite_qvs_cmph5_chunk(cmph5_file, cmph5_chunk,
                                         chunk_code_indices, raw_codes,
-                                        code_book_features)
-        cmph5_file.close()
+                                        feature_list)
+                aln_group.attrs["VQOverwrittenEnd"] = cmph5_chunk.aln_group_end
+            metrics.progress(len(chunk_code_indices))
 
-    elif filename.endswith(".sam") or filename.endswith(".bam"):
+        metrics.start_progress(num_remaining)
 
-        in_sam_file = pysam.Samfile(filename)
+        if num_remaining == 0:
+            log.info("{f} is already encoded with this code book"
+                     .format(f=filename))
+            chunk_results = []
+        elif pool is None and pipeline:
+            chunk_size = hdf5_aligned_chunk_size(cmph5_file, feature_list,
+                                                 BUFFER_SIZE)
+            chunk_ranges = list(remaining_chunk_ranges(
+                utils.cmph5_chunk_ranges(cmph5_file, feature_list, chunk_size),
+                vq_ends))
+            for aln_group_path in aln_group_paths:
+                feature_chunks = cmph5_file[aln_group_path][feature_list[0]].chunks
+                create_vq_dataset(cmph5_file, aln_group_path,
+                                  feature_chunks or True)
 
-        header = in_sam_file.header
-        if 'CO' not in header:
-            header['CO'] = []
+            pipelined_code_indices(
+                cmph5_file, chunk_ranges, feature_list,
+                make_code_assigner(raw_codes, feature_list, lookup_table,
+                                   std_dev, threads),
+                write_results)
+            chunk_results = []
+        elif pool is not None:
+            chunk_ranges = list(remaining_chunk_ranges(
+                utils.cmph5_chunk_ranges(cmph5_file, feature_list, BUFFER_SIZE),
+                vq_ends))
+            for aln_group_path in aln_group_paths:
+                create_vq_dataset(cmph5_file, aln_group_path)
 
-        header['CO'].append(json.dumps(raw_codes.tolist()))
-        header['CO'].append(json.dumps(code_book_features))
+            chunk_results = pooled_code_indices(pool, cmph5_file, chunk_ranges,
+                                                feature_list, workers,
+                                                code_book_group)
+        else:
+            assign_codes = make_code_assigner(raw_codes, feature_list,
+                                              lookup_table, std_dev, threads)
+            chunk_data = numpy.empty((BUFFER_SIZE, len(feature_list)),
+                                     dtype='uint8', order='F')
+            chunk_results = (
+                (k, assign_codes(utils.read_cmph5_chunk(
+                    cmph5_file, k, feature_list, out=chunk_data).data))
+                for k in remaining_chunk_ranges(
+                    utils.cmph5_chunk_ranges(cmph5_file, feature_list,
+                                             BUFFER_SIZE),
+                    vq_ends))
 
-        out_sam_file = pysam.Samfile(output_filename, 'wb', header=header)
-        
-        encoded_tags = [utils.QUIVER_SAM_TAGS[k] for k in code_book_features]
+        for cmph5_chunk, chunk_code_indices in chunk_results:
+            write_results(cmph5_chunk, chunk_code_indices)
         if rle_deltag:
-            encoded_tags.append(utils.QUIVER_SAM_TAGS["DeletionTag"])
+            for aln_group_path in aln_group_paths:
+                if cmph5_file[aln_group_path].get("DeletionTag"):
+                    del cmph5_file[aln_group_path]["DeletionTag"]
+        cmph5_file.close()
+
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+def add_vqs_to_cmph5_by_movie(filename, raw_codes, feature_list,
+                              group_code_books, overwrite_qvs=False,
+                              lookup_table=False, workers=1, pipeline=False,
+                              std_dev=None, rle_deltag=False, pool=None,
+                              threads=1):
+    """Encode each AlnGroup of a cmp.h5 with the code book of its movie, or
+    with the default code book if its movie has none.
+
+    The AlnGroups of each code book are encoded in one add_vqs_to_cmph5
+    pass, all using the same pool, which records the movie in their
+    VQCodeBookGroup attribute so decoding picks the same code book.
+
+    Args:
+        group_code_books: an OrderedDict from movie name to the
+            (raw_codes, std_dev) of its code book, as returned by
+            load_group_code_books
+        The other arguments are as for add_vqs_to_cmph5.
+    """
+
+    cmph5_file = h5py.File(filename, 'r')
+    aln_group_movies = utils.cmph5_aln_group_movies(cmph5_file)
+    group_aln_group_paths = collections.OrderedDict(
+        [(None, [])] + [(k, []) for k in group_code_books])
+    for aln_group_path in cmph5_file['AlnGroup/Path']:
+        movie_name = aln_group_movies.get(aln_group_path)
+        if movie_name not in group_code_books:
+            movie_name = None
+        group_aln_group_paths[movie_name].append(aln_group_path)
+    cmph5_file.close()
 
-        for record in in_sam_file:
-            record_data = numpy.zeros(shape=(len(record.qual), len(code_book_features)))
-            for i, feature_name in enumerate(code_book_features):
-                record_data[:, i] = [utils.char_to_qv(k) for k in 
-                                     record.opt(utils.QUIVER_SAM_TAGS[feature_name])]
+    log.info("{g} of {n} AlnGroups have a code book for their movie".format(
+        g=sum(len(v) for k, v in group_aln_group_paths.items() if k),
+        n=sum(len(k) for k in group_aln_group_paths.values())))
 
-            chunk_code_indices = get_code_indices(record_data, raw_codes,
-                                                  code_book_features)
+    own_pool = pool is None and workers > 1
+    if own_pool:
+        pool = make_encode_pool(workers, raw_codes, feature_list, lookup_table,
+                                std_dev, group_code_books, threads)
+    try:
+        for movie_name, aln_group_paths in group_aln_group_paths.items():
+            if not aln_group_paths:
+                continue
+            group_raw_codes, group_std_dev = group_code_books.get(
+                movie_name, (raw_codes, std_dev))
+            add_vqs_to_cmph5(filename, group_raw_codes, feature_list,
+                             overwrite_qvs, lookup_table, workers, pipeline,
+                             group_std_dev, rle_deltag, pool, aln_group_paths,
+                             movie_name, threads)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
 
-            qual_string = ''.join([utils.qv_to_char(k) for k in chunk_code_indices])
-            
+def compact_dataset_options(length, compression='gzip'):
+    """Return the create_dataset keyword arguments for a 1-D dataset of a
+    compact cmp.h5: COMPACT_CHUNK_SIZE chunks, shuffled and compressed.
+    """
+
+    options = {'chunks': (max(min(length, COMPACT_CHUNK_SIZE), 1),)}
+    if compression != 'none':
+        options.update(compression=compression, shuffle=True)
+    if compression == 'gzip':
+        options['compression_opts'] = COMPACT_GZIP_LEVEL
+    return options
+
+def write_cmph5_code_book(cmph5_file, raw_codes, feature_list, std_dev=None):
+    """Store a code book in the VQCodeBook dataset at the root of a cmp.h5,
+    with the feature names and whitening as attributes.
+    """
+
+    code_book_dataset = cmph5_file.create_dataset(
+        "VQCodeBook", data=numpy.asarray(raw_codes).astype('uint8'))
+    code_book_dataset.attrs["FeatureList"] = ','.join(feature_list)
+    if std_dev is not None:
+        code_book_dataset.attrs["StdDev"] = numpy.asarray(std_dev,
+                                                          dtype='float64')
+
+def read_cmph5_code_book(cmph5_file):
+    """Read a code book stored by write_cmph5_code_book, or return None if
+    the cmp.h5 doesn't hold one.
+
+    Returns:
+        raw_codes: a numpy.array of the code values
+        code_book_features: a list of the names of features associated with
+                            columns of raw_codes
+    """
+
+    if "VQCodeBook" not in cmph5_file:
+        return None
+    code_book_dataset = cmph5_file["VQCodeBook"]
+    return (code_book_dataset[:],
+            str(code_book_dataset.attrs["FeatureList"]).split(','))
+
+def copy_cmph5_attrs(in_object, out_object):
+    """Copy the attributes of an HDF5 object, except the encode progress."""
+
+    for name, value in in_object.attrs.items():
+        if name not in ENCODE_PROGRESS_ATTRS:
+            out_object.attrs[name] = value
+
+def copy_cmph5_structure(in_group, out_group, aln_group_paths, skip_datasets):
+    """Copy a cmp.h5 group into out_group, leaving out the datasets named in
+    skip_datasets from the AlnGroups, and the encode progress attributes.
+
+    Args:
+        in_group: an h5py.Group of the input file, usually the root
+        out_group: the h5py.Group to copy into
+        aln_group_paths: the paths of the AlnGroups
+        skip_datasets: names of the AlnGroup datasets that aren't copied
+    """
+
+    copy_cmph5_attrs(in_group, out_group)
+
+    for name in in_group:
+        item = in_group[name]
+        if item.name in aln_group_paths:
+            out_aln_group = out_group.create_group(name)
+            copy_cmph5_attrs(item, out_aln_group)
+            for dataset_name in item:
+                if dataset_name not in skip_datasets:
+                    item.copy(dataset_name, out_aln_group)
+        elif (isinstance(item, h5py.Group) and
+              any(k.startswith(item.name + '/') for k in aln_group_paths)):
+            copy_cmph5_structure(item, out_group.create_group(name),
+                                 aln_group_paths, skip_datasets)
+        elif item.name not in ("/VQCodeBook", "/VQEntropyModel"):
+            in_group.copy(name, out_group)
+
+def write_compact_cmph5(filename, output_filename, raw_codes, feature_list,
+                        lookup_table=False, workers=1, std_dev=None,
+                        rle_deltag=False, compression='gzip', pool=None,
+                        threads=1):
+    """Write a new cmp.h5 that holds a VQ dataset in place of the QV datasets
+    of each AlnGroup, and the code book in a VQCodeBook dataset, leaving the
+    input untouched.
+
+    Everything else in the input is copied as it is. The VQ datasets, and
+    the DeletionTag runs if rle_deltag, are written in COMPACT_CHUNK_SIZE
+    chunks with the shuffle filter and compression, so the output is small
+    and quick to read sequentially.
+
+    Args:
+        filename: path to the cmp.h5 to encode
+        output_filename: path of the compact cmp.h5 to write
+        compression: 'gzip', 'lzf', or 'none'
+        The other arguments are as for add_vqs_to_cmph5.
+    """
+
+    own_pool = pool is None and workers > 1
+    if own_pool:
+        pool = make_encode_pool(workers, raw_codes, feature_list, lookup_table,
+                                std_dev, threads=threads)
+
+    try:
+        in_file = h5py.File(filename, 'r', rdcc_nbytes=CHUNK_CACHE_SIZE)
+        out_file = h5py.File(output_filename, 'w')
+        aln_group_paths = list(in_file['AlnGroup/Path'][:])
+
+        copy_cmph5_structure(in_file, out_file, aln_group_paths,
+                             set(feature_list) | set(ENCODED_DATASETS))
+        write_cmph5_code_book(out_file, raw_codes, feature_list, std_dev)
+
+        for aln_group_path in aln_group_paths:
+            aln_group_len = len(in_file[aln_group_path]['AlnArray'])
+            out_file[aln_group_path].create_dataset(
+                "VQ", (aln_group_len,), dtype='uint8',
+                **compact_dataset_options(aln_group_len, compression))
             if rle_deltag:
-                deltag = run_length_encode(record.opt(utils.QUIVER_SAM_TAGS['DeletionTag']))
-                record.tags += [('dr', deltag)]
-            
+                run_values, run_lengths = find_cmph5_deltag_runs(
+                    in_file, aln_group_path)
+                for dataset_name, runs in (
+                        ("DeletionTagRunValues", run_values),
+                        ("DeletionTagRunLengths", run_lengths)):
+                    out_file[aln_group_path].create_dataset(
+                        dataset_name, data=runs,
+                        **compact_dataset_options(len(runs), compression))
+
+        chunk_ranges = utils.cmph5_chunk_ranges(in_file, feature_list,
+                                                BUFFER_SIZE)
+        metrics.start_progress(sum(len(in_file[k]['AlnArray'])
+                                   for k in aln_group_paths))
+
+        if pool is not None:
+            chunk_results = pooled_code_indices(pool, in_file, chunk_ranges,
+                                                feature_list, workers)
+        else:
+            assign_codes = make_code_assigner(raw_codes, feature_list,
+                                              lookup_table, std_dev, threads)
+            chunk_data = numpy.empty((BUFFER_SIZE, len(feature_list)),
+                                     dtype='uint8', order='F')
+            chunk_results = (
+                (k, assign_codes(utils.read_cmph5_chunk(
+                    in_file, k, feature_list, out=chunk_data).data))
+                for k in chunk_ranges)
+
+        for cmph5_chunk, chunk_code_indices in chunk_results:
+            write_vqs_to_cmph5(out_file, cmph5_chunk, chunk_code_indices)
+            metrics.progress(len(chunk_code_indices))
+
+        in_file.close()
+        out_file.close()
+
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+def make_encoded_header(in_sam_file, raw_codes, feature_list,
+                        group_code_books=None):
+    """Return the header of in_sam_file with the code book added as @CO
+    lines.
+
+    The code book of each read group in group_code_books that's in the
+    header is added as a @CO line holding a JSON object with its read group
+    ID under VQReadGroup and its codes under VQCodes.
+    """
+
+    header = utils.sam_header_dict(in_sam_file)
+    if 'CO' not in header:
+        header['CO'] = []
+
+    header['CO'].append(json.dumps(raw_codes.tolist()))
+    header['CO'].append(json.dumps(feature_list))
+
+    read_group_ids = set(k.get('ID') for k in header.get('RG', []))
+    for read_group_id, (group_raw_codes, _) in (group_code_books or {}).items():
+        if read_group_id in read_group_ids:
+            header['CO'].append(json.dumps(collections.OrderedDict(
+                [('VQReadGroup', read_group_id),
+                 ('VQCodes', numpy.asarray(group_raw_codes).tolist())])))
+    return header
+
+def header_group_code_books(header, group_code_books):
+    """Return the code books of group_code_books whose read groups are in
+    the header, the ones make_encoded_header writes.
+    """
+
+    if not group_code_books:
+        return None
+    read_group_ids = set(k.get('ID') for k in header.get('RG', []))
+    return collections.OrderedDict(
+        (k, v) for k, v in group_code_books.items() if k in read_group_ids)
+
+def encode_sam_records(records, out_sam_file, assign_codes, feature_list,
+                       rle_deltag=False, read_groups=False):
+    """Replace the QVs of SAM records with code book indices in QUAL and
+    write them to out_sam_file.
+
+    Args:
+        records: an iterable of pysam records, usually an open pysam.Samfile
+        out_sam_file: pysam.Samfile open for writing
+        assign_codes: function from make_code_assigner, or a
+            GroupCodeAssigner
+        feature_list: the features in the code book
+        rle_deltag: if True, add the run length encoded DeletionTag as the
+            dr tag
+        read_groups: if True, encode each record with the code book of its
+            RG tag, using the GroupCodeAssigner assign_codes
+
+    Returns:
+        the number of records written
+    """
+
+    num_records = 0
+    encoded_tags = [utils.QUIVER_SAM_TAGS[k] for k in feature_list]
+    if rle_deltag:
+        encoded_tags.append(utils.QUIVER_SAM_TAGS["DeletionTag"])
+
+    for sam_chunk in utils.sam_chunker(records, feature_list, BUFFER_SIZE):
+
+        if read_groups:
+            record_groups = numpy.array(
+                [assign_codes.group_index(dict(k.tags).get('RG'))
+                 for k in sam_chunk.records], dtype='int32')
+            chunk_code_indices = assign_codes(
+                sam_chunk.data,
+                numpy.repeat(record_groups, numpy.diff(sam_chunk.offsets)))
+        else:
+            chunk_code_indices = assign_codes(sam_chunk.data)
+        chunk_qual_string = (chunk_code_indices + utils.CHAR_OFFSET).astype(
+            'uint8').tostring()
+
+        if rle_deltag and "DeletionTag" in feature_list:
+            deltags = run_length_encode_batch(
+                sam_chunk.data[:, list(feature_list).index("DeletionTag")],
+                sam_chunk.offsets)
+        elif rle_deltag:
+            deltags = run_length_encode_batch(
+                numpy.fromstring(''.join(
+                    [k.opt(utils.QUIVER_SAM_TAGS['DeletionTag'])
+                     for k in sam_chunk.records]), dtype='uint8'),
+                sam_chunk.offsets)
+
+        write_start_time = time.time()
+        for record_i, record in enumerate(sam_chunk.records):
+            record_start = sam_chunk.offsets[record_i]
+            record_end = sam_chunk.offsets[record_i + 1]
+
+            if rle_deltag:
+                record.tags += [('dr', deltags[record_i])]
+
             record.tags = [k for k in record.tags if k[0] not in encoded_tags]
 
-            record.qual = qual_string
+            record.qual = chunk_qual_string[record_start:record_end]
             out_sam_file.write(record)
+        metrics.record("sam_write", time.time() - write_start_time,
+                       len(chunk_code_indices))
+        metrics.progress(len(sam_chunk.records))
+        num_records += len(sam_chunk.records)
+
+    return num_records
+
+def bam_shard_ranges(bam_filename, num_shards):
+    """Split a BAM file into shards at BGZF block boundaries, found from the
+    block headers, without decompressing any records.
+
+    A record belongs to the shard holding the block it starts in, see
+    _encode_bam_shard.
+
+    Returns:
+        a list of (start_offset, end_offset) tuples of the block offsets of
+        each shard, in file order. The start of the first shard is None,
+        meaning just after the header, and the end of the last is None,
+        meaning the end of the file.
+    """
+
+    bam_file = utils.open_sam_file(bam_filename)
+    header_block = bam_file.tell() >> 16
+    bam_file.close()
+
+    offsets = bgzf.shard_block_offsets(bam_filename, num_shards,
+                                       header_block + 1)
+    return zip([None] + offsets, offsets + [None])
+
+def shard_records(sam_file, end_offset):
+    """Generator function for the records of an open BAM file, from where it
+    is up to the first record that starts at or after the block at
+    end_offset, or to the end of the file if end_offset is None.
+    """
+
+    while end_offset is None or (sam_file.tell() >> 16) < end_offset:
+        try:
+            yield sam_file.next()
+        except StopIteration:
+            return
+
+def _encode_bam_shard(shard):
+    """Encode one shard of a BAM file into its own BAM file in a worker
+    process.
+
+    The worker finds the first record that starts in the shard itself, with
+    bgzf.find_record_start, and encodes up to the first record of the next
+    shard. Batches of records start over at the start of the shard.
+
+    Args:
+        shard: a (filename, header, rle_deltag, read_groups, start_offset,
+            end_offset, shard_filename) tuple, with the offsets as returned
+            by bam_shard_ranges
+
+    Returns:
+        the shard_filename and the number of records encoded
+    """
+
+    (filename, header, rle_deltag, read_groups, start_offset, end_offset,
+     shard_filename) = shard
+
+    in_sam_file = utils.open_sam_file(filename)
+    out_sam_file = utils.open_sam_file(shard_filename, 'wb', header=header)
 
+    virtual_offset = None
+    if start_offset is not None:
+        with open(filename, 'rb') as raw_file:
+            virtual_offset = bgzf.find_record_start(
+                raw_file, start_offset,
+                end_offset if end_offset is not None else os.path.getsize(filename),
+                in_sam_file.nreferences)
+
+    num_records = 0
+    if start_offset is None or virtual_offset is not None:
+        if virtual_offset is not None:
+            in_sam_file.seek(virtual_offset)
+        num_records = encode_sam_records(
+            shard_records(in_sam_file, end_offset), out_sam_file,
+            _worker_state['assign_codes'], _worker_state['feature_list'],
+            rle_deltag, read_groups)
+
+    in_sam_file.close()
+    out_sam_file.close()
+    return shard_filename, num_records
+
+def add_vqs_to_sam(filename, output_filename, raw_codes, feature_list,
+                   rle_deltag=False, lookup_table=False, workers=1, threads=1,
+                   std_dev=None, output_format=None, compression_level=None,
+                   pool=None, group_code_books=None):
+    """Write a copy of a SAM or BAM file with code book indices in QUAL and
+    the code book in the header.
+
+    Records of a read group in group_code_books are encoded with its code
+    book, which is written to the header too, see make_encoded_header.
+
+    Either file can be '-' for stdin or stdout, so that encoding can sit in
+    a pipeline. Records are read, encoded, and written in batches, so memory
+    use doesn't depend on the size of the input.
+
+    With more than one worker, a BAM input, and compressed BAM output to a
+    file, the input is split into BAM_SHARDS_PER_WORKER shards per worker at
+    BGZF block boundaries, see bam_shard_ranges. The shards are encoded to
+    temporary BAMs in a pool of processes and concatenated in order. If pool, a pool made by
+    make_encode_pool with the same code book, is given, the shards are
+    encoded in it, and it is left running.
+    """
+
+    in_sam_file = utils.open_sam_file(filename, threads=threads)
+    header = make_encoded_header(in_sam_file, raw_codes, feature_list,
+                                 group_code_books)
+    group_code_books = header_group_code_books(header, group_code_books)
+    read_groups = bool(group_code_books)
+
+    shardable = (filename.endswith(".bam") and
+                 output_filename != utils.STREAM_FILENAME and
+                 utils.sam_output_mode(output_filename, output_format,
+                                       compression_level) == 'wb')
+    parallel = workers > 1 or pool is not None
+    if parallel and not shardable:
+        log.info("Encoding with one process, since only BAM files written to "
+                 "compressed BAM files can be split between workers")
+
+    if parallel and shardable:
+        num_reads = utils.sam_num_reads(in_sam_file)
+        in_sam_file.close()
+
+        shard_dir = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(output_filename)))
+        try:
+            shards = [(filename, header, rle_deltag, read_groups,
+                       start_offset, end_offset,
+                       os.path.join(shard_dir, "shard{i}.bam".format(i=i)))
+                      for i, (start_offset, end_offset) in enumerate(
+                          bam_shard_ranges(filename,
+                                           BAM_SHARDS_PER_WORKER * workers))]
+
+            own_pool = pool is None
+            if own_pool:
+                pool = make_encode_pool(workers, raw_codes, feature_list,
+                                        lookup_table, std_dev,
+                                        group_code_books, threads)
+            metrics.start_progress(num_reads, 'reads')
+            shard_filenames = []
+            for shard_filename, num_records in pool.imap(
+                    _encode_bam_shard, shards, chunksize=1):
+                shard_filenames.append(shard_filename)
+                metrics.progress(num_records)
+            if own_pool:
+                pool.close()
+                pool.join()
+
+            pysam.cat("-o", output_filename, *shard_filenames)
+        finally:
+            shutil.rmtree(shard_dir)
+
+    else:
+        assign_codes = GroupCodeAssigner(raw_codes, feature_list,
+                                         group_code_books, lookup_table,
+                                         std_dev, threads)
+        out_sam_file = utils.open_sam_output(output_filename, header,
+                                             output_format, compression_level,
+                                             threads)
+        metrics.start_progress(utils.sam_num_reads(in_sam_file), 'reads')
+        encode_sam_records(in_sam_file, out_sam_file, assign_codes,
+                           feature_list, rle_deltag, read_groups)
         in_sam_file.close()
         out_sam_file.close()
+
+def add_vqs_to_file(filename, code_book_filename, overwrite_qvs=False,
+                    rle_deltag=False, output_filename=None, lookup_table=False,
+                    workers=1, threads=1, pipeline=False, entropy_code=False,
+                    output_format=None, compression_level=None,
+                    compression='gzip'):
+    """Add VQ values to a cmp.h5, SAM, or BAM file. 
+    
+    If the file is a cmp.h5, write a dataset named VQ to each align
+    group that represents the index in the code book. Optionally, overwrite
+    all the QVs with values from the code book. If output_filename is given,
+    the cmp.h5 is left as it is and a compact copy with VQ datasets in place
+    of the QVs is written instead, see write_compact_cmph5.
+
+    If the file is a SAM or BAM, write code book indices to the QUAL field
+    and put the code book in the header. The input and output can be '-'
+    for stdin and stdout.
+
+    Args:
+        filename: path to the cmp.h5, SAM, or BAM file
+        code_book_filename: path to the code book produced by build_code_book.
+            A binary .npz code book also carries the whitening used in
+            training, which is then used for every chunk.
+        overwrite_qvs: if True, overwrite QVs with values from the code book
+        rle_deltag: if True, keep the DeletionTag run length encoded. For a
+            SAM or BAM it goes in the dr tag, and for a cmp.h5 in
+            DeletionTagRunValues and DeletionTagRunLengths datasets that
+            replace DeletionTag.
+        lookup_table: if True, assign codes with a CodeLookupTable instead
+            of a distance search for every base. Needs a .npz code book
+        workers: number of processes used to encode the file. For a cmp.h5,
+            the calling process does all the writing. For a BAM, each worker
+            encodes a shard of records.
+        threads: number of threads each process uses to search for codes,
+            and of BGZF compression threads for SAM/BAM files
+        pipeline: if True, overlap reading, quantizing, and writing a cmp.h5
+            in separate threads
+        entropy_code: if True, replace the VQ datasets of a cmp.h5 with
+            Huffman coded VQEntropy datasets. For a SAM or BAM, just report
+            the bits per base Huffman coding would achieve.
+        output_format: 'bam', 'ubam' for uncompressed BAM, or 'sam'. If None,
+            it's chosen from the extension of output_filename, and BAM for
+            stdout.
+        compression_level: BGZF compression level of BAM output
+        compression: HDF5 compression filter of a compact cmp.h5, 'gzip',
+            'lzf', or 'none'
+
+    If the code book holds code books of read groups or movies, built with
+    build_code_book --group_by read_group, each record of a SAM or BAM is
+    encoded with the code book of its read group, and each AlnGroup of a
+    cmp.h5 with the code book of its movie.
+    """
+
+    raw_codes, code_book_features, std_dev = load_code_book(
+        code_book_filename)
+    group_code_books = load_group_code_books(code_book_filename)
+
+    encode_file(filename, raw_codes, code_book_features, std_dev,
+                overwrite_qvs, rle_deltag, output_filename, lookup_table,
+                workers, threads, pipeline, entropy_code, output_format,
+                compression_level, compression,
+                group_code_books=group_code_books)
+
+def encode_file(filename, raw_codes, feature_list, std_dev=None,
+                overwrite_qvs=False, rle_deltag=False, output_filename=None,
+                lookup_table=False, workers=1, threads=1, pipeline=False,
+                entropy_code=False, output_format=None,
+                compression_level=None, compression='gzip', pool=None,
+                group_code_books=None):
+    """Encode a cmp.h5, SAM, or BAM file with a code book that's already
+    loaded, as add_vqs_to_file does.
+
+    Args:
+        raw_codes, feature_list, std_dev: the code book, as returned by
+            load_code_book
+        pool: a pool made by make_encode_pool with these code books, used in
+            place of starting one with workers processes. It is left running,
+            so it can encode more files.
+        group_code_books: the code books of read groups or movies, as
+            returned by load_group_code_books
+        The other arguments are as for add_vqs_to_file.
+
+    Raises:
+        ValueError: if group_code_books are given for a compact cmp.h5, which
+            holds a single code book
+    """
+
+    num_codes = max([len(raw_codes)] +
+                    [len(k[0]) for k in (group_code_books or {}).values()])
+
+    if filename.endswith(".cmp.h5") and output_filename is not None:
+
+        if group_code_books:
+            raise ValueError("A compact cmp.h5 can't be written with the code "
+                             "books of movies, encode it in place instead")
+
+        write_compact_cmph5(filename, output_filename, raw_codes,
+                            feature_list, lookup_table, workers, std_dev,
+                            rle_deltag, compression, pool, threads)
+        if entropy_code:
+            entropy.entropy_code_cmph5(output_filename, num_codes)
+
+    elif filename.endswith(".cmp.h5"):
+
+        if group_code_books:
+            add_vqs_to_cmph5_by_movie(filename, raw_codes, feature_list,
+                                      group_code_books, overwrite_qvs,
+                                      lookup_table, workers, pipeline, std_dev,
+                                      rle_deltag, pool, threads)
+        else:
+            add_vqs_to_cmph5(filename, raw_codes, feature_list, overwrite_qvs,
+                             lookup_table, workers, pipeline, std_dev,
+                             rle_deltag, pool, threads=threads)
+        if entropy_code:
+            entropy.entropy_code_cmph5(filename, num_codes)
+
+    elif utils.is_sam_filename(filename):
+
+        add_vqs_to_sam(filename, output_filename, raw_codes, feature_list,
+                       rle_deltag, lookup_table, workers, threads, std_dev,
+                       output_format, compression_level, pool,
+                       group_code_books)
+        if entropy_code and output_filename == utils.STREAM_FILENAME:
+            log.warning("Can't report the bits per base of output written to "
+                        "stdout")
+        elif entropy_code:
+            entropy.report_sam(output_filename, num_codes, threads)
@@ -0,0 +1,228 @@
+"""sweep contains methods for choosing the number of codes in a code book by
+training code books of several sizes on the same training sample and
+comparing their distortion and bits per base.
+
+The training sample is read, collapsed to distinct QV tuples, and whitened
+once, before the worker processes are forked, so the workers share it
+read-only instead of each reading the file again.
+"""
+import json
+import logging
+import multiprocessing
+import numpy
+import time
+
+from qv_compress import code_book, entropy, kmeans, metrics, utils
+
+log = logging.getLogger('main')
+
+# Training sample shared with the sweep workers, set by sweep_code_books
+# before the pool is forked
+_sweep_state = {}
+
+def _init_sweep_worker():
+    """Set up a sweep worker process."""
+
+    metrics.disable()
+
+def evaluate_code_book(clusterable_array, weights, whitened_codes, std_dev):
+    """Measure how well a code book represents a weighted training sample.
+
+    Args:
+        clusterable_array: whitened distinct observations
+        weights: the number of times each row of clusterable_array was
+            observed
+        whitened_codes: the code book, in whitened units
+        std_dev: the standard deviations used for whitening
+
+    Returns:
+        dict with the root mean square error of each feature, in unwhitened
+        units, the entropy of the code indices, and the bits per base of a
+        Huffman code for them
+    """
+
+    weights = numpy.asarray(weights, dtype='float64')
+    code_indices, distances = kmeans.nearest_codes(clusterable_array,
+                                                    whitened_codes)
+    errors = (clusterable_array - whitened_codes[code_indices]) * std_dev
+    feature_rmse = numpy.sqrt(numpy.dot(weights, errors ** 2) / weights.sum())
+
+    frequencies = numpy.bincount(code_indices, weights=weights,
+                                 minlength=len(whitened_codes)).astype('int64')
+    probs = frequencies[frequencies > 0] / float(frequencies.sum())
+    code_lengths = entropy.huffman_code_lengths(frequencies)
+
+    return {'distortion': float(numpy.dot(weights, distances) / weights.sum()),
+            'feature_rmse': feature_rmse,
+            'entropy_bits_per_base': float(-numpy.dot(probs, numpy.log2(probs))),
+            'bits_per_base': entropy.bits_per_base(code_lengths, frequencies)}
+
+def _train_sweep_code_book(num_codes):
+    """Train and evaluate a code book with num_codes codes on the shared
+    training sample.
+    """
+
+    clusterable_array = _sweep_state['clusterable_array']
+    counts = _sweep_state['counts']
+    std_dev = _sweep_state['std_dev']
+
+    start_time = time.time()
+    whitened_codes, distortion = code_book.weighted_kmeans(
+        clusterable_array, counts, num_codes, seed=_sweep_state['seed'])
+    seconds = time.time() - start_time
+
+    result = evaluate_code_book(clusterable_array, counts, whitened_codes,
+                                std_dev)
+    result.update(num_codes=num_codes, codes_used=len(whitened_codes),
+                  seconds=seconds,
+                  raw_codes=code_book.convert_to_raw(
+                      whitened_codes, _sweep_state['feature_list'], std_dev))
+    return result
+
+def find_knee(bits_per_base, distortions):
+    """Find the knee of a rate-distortion curve, the point farthest below the
+    line joining its ends once both axes are scaled to [0, 1].
+
+    Args:
+        bits_per_base: the rate of each point, in increasing order of
+            code book size
+        distortions: the distortion of each point
+
+    Returns:
+        the index of the knee point
+    """
+
+    rates = numpy.asarray(bits_per_base, dtype='float64')
+    distortions = numpy.asarray(distortions, dtype='float64')
+    if len(rates) < 3:
+        return len(rates) - 1
+
+    scaled_rates = (rates - rates[0]) / max(rates[-1] - rates[0], 1e-12)
+    scaled_distortions = ((distortions - distortions[-1]) /
+                          max(distortions[0] - distortions[-1], 1e-12))
+    return int(numpy.argmax(1 - scaled_rates - scaled_distortions))
+
+def sweep_code_books(input_filename, num_codes_list, num_observations,
+                     feature_list=utils.QUIVER_FEATURES,
+                     batch_size=code_book.MINIBATCH_SIZE, sampling="head",
+                     workers=1, seed=None):
+    """Train weighted k-means code books of several sizes on one training
+    sample.
+
+    Args:
+        input_filename: path to the cmp.h5, SAM, or BAM file
+        num_codes_list: the code book sizes to try
+        num_observations: the number of bases to train on
+        feature_list: the features to cluster
+        batch_size: the number of bases read at a time
+        sampling: how training bases are picked, see
+            code_book.read_training_array
+        workers: the number of processes training code books at once
+        seed: seed for the training sample and initial codes, or None
+
+    Returns:
+        results: a list with one dict per code book size, in increasing
+            order of size, as returned by _train_sweep_code_book
+        std_dev: the standard deviations used to whiten the training data
+    """
+
+    feature_list = list(feature_list)
+    if seed is not None:
+        numpy.random.seed(seed)
+    unique_rows, counts = code_book.read_unique_training_rows(
+        input_filename, feature_list, num_observations, batch_size, sampling)
+    clusterable_array, std_dev = code_book.make_data_clusterable(
+        unique_rows, feature_list, remove_skips=False, weights=counts)
+
+    _sweep_state.update(clusterable_array=clusterable_array, counts=counts,
+                        std_dev=std_dev, feature_list=feature_list,
+                        seed=seed)
+    # Start the largest code books first, since they take longest
+    num_codes_list = sorted(set(num_codes_list), reverse=True)
+
+    try:
+        if workers > 1:
+            pool = multiprocessing.Pool(min(workers, len(num_codes_list)),
+                                        _init_sweep_worker)
+            try:
+                sweep_results = pool.imap_unordered(_train_sweep_code_book,
+                                                    num_codes_list, 1)
+                results = []
+                for result in sweep_results:
+                    log.debug("Trained {n} codes in {s:.2f} s".format(
+                        n=result['num_codes'], s=result['seconds']))
+                    results.append(result)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_train_sweep_code_book(k) for k in num_codes_list]
+    finally:
+        _sweep_state.clear()
+
+    for result in results:
+        metrics.record("weighted_kmeans", result['seconds'], counts.sum())
+
+    results.sort(key=lambda k: k['num_codes'])
+    return results, std_dev
+
+def log_sweep(results, feature_list, knee_index=None):
+    """Log a table of the results of sweep_code_books."""
+
+    log.info("codes  used  bits/base  entropy  distortion  seconds  " +
+             "  ".join("{f} RMSE".format(f=k) for k in feature_list))
+    for result_i, result in enumerate(results):
+        line = "{n:5d}  {u:4d}  {b:9.3f}  {e:7.3f}  {d:10.4f}  {s:7.2f}  ".format(
+            n=result['num_codes'], u=result['codes_used'],
+            b=result['bits_per_base'], e=result['entropy_bits_per_base'],
+            d=result['distortion'], s=result['seconds'])
+        line += "  ".join("{r:{w}.3f}".format(r=r, w=len(f) + 5) for f, r in
+                          zip(feature_list, result['feature_rmse']))
+        if result_i == knee_index:
+            line += "  <- knee"
+        log.info(line)
+
+def write_sweep(output_filename, results, feature_list, knee_index):
+    """Write the results of sweep_code_books to a JSON file."""
+
+    sweep_report = {
+        'knee_num_codes': results[knee_index]['num_codes'],
+        'results': [{'num_codes': k['num_codes'],
+                     'codes_used': k['codes_used'],
+                     'bits_per_base': k['bits_per_base'],
+                     'entropy_bits_per_base': k['entropy_bits_per_base'],
+                     'distortion': k['distortion'],
+                     'seconds': k['seconds'],
+                     'feature_rmse': dict(zip(feature_list,
+                                              k['feature_rmse'].tolist()))}
+                    for k in results]}
+
+    with open(output_filename, 'w') as output_file:
+        json.dump(sweep_report, output_file, indent=2, sort_keys=True)
+
+def run_sweep(input_filename, num_codes_list, num_observations,
+              feature_list=utils.QUIVER_FEATURES,
+              batch_size=code_book.MINIBATCH_SIZE, sampling="head", workers=1,
+              output_json=None, knee_code_book=None, seed=None):
+    """Sweep code book sizes, log the results, and optionally write them as
+    JSON and save the code book at the knee of the rate-distortion curve.
+    """
+
+    feature_list = list(feature_list)
+    results, std_dev = sweep_code_books(input_filename, num_codes_list,
+                                        num_observations, feature_list,
+                                        batch_size, sampling, workers, seed)
+    knee_index = find_knee([k['bits_per_base'] for k in results],
+                           [k['distortion'] for k in results])
+    log_sweep(results, feature_list, knee_index)
+
+    if output_json is not None:
+        write_sweep(output_json, results, feature_list, knee_index)
+    if knee_code_book is not None:
+        log.info("Writing the code book with {n} codes to {f}".format(
+            n=results[knee_index]['num_codes'], f=knee_code_book))
+        code_book.write_code_book(knee_code_book,
+                                  results[knee_index]['raw_codes'],
+                                  feature_list, std_dev)
+
+    return results
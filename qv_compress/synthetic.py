@@ -0,0 +1,165 @@
+"""synthetic contains methods for writing cmp.h5, SAM, and BAM files with
+random alignments and PacBio-like QVs, for benchmarking without real data.
+"""
+import logging
+import numpy
+
+from qv_compress import utils
+
+h5py = utils.LazyModule('h5py')
+pysam = utils.LazyModule('pysam')
+
+log = logging.getLogger('main')
+
+BASES = numpy.fromstring('ACGT', dtype='uint8')
+
+# Chance that an aligned base is a gap in the read, marked with QVs of 255
+GAP_RATE = 0.05
+
+# Chance that a base has a DeletionTag other than N
+DELETION_TAG_RATE = 0.4
+
+# Chance that a base has a MergeQV below the maximum of 100
+MERGE_RATE = 0.2
+
+def synthetic_qvs(num_bases, random_state):
+    """Draw PacBio-like QVs for a number of bases.
+
+    QVs are skewed towards low values like the raw QVs of RS reads, with
+    most MergeQVs at 100 and most DeletionTags N.
+
+    Args:
+        num_bases: the number of bases
+        random_state: a numpy.random.RandomState
+
+    Returns:
+        a dict from feature name to uint8 numpy array of values
+    """
+
+    qvs = {}
+    qvs['DeletionQV'] = numpy.minimum(
+        random_state.geometric(0.15, num_bases) + 1, 30).astype('uint8')
+    qvs['DeletionTag'] = numpy.where(
+        random_state.rand(num_bases) < DELETION_TAG_RATE,
+        BASES[random_state.randint(0, 4, num_bases)], ord('N')).astype('uint8')
+    qvs['InsertionQV'] = numpy.minimum(
+        random_state.geometric(0.12, num_bases) + 1, 30).astype('uint8')
+    qvs['MergeQV'] = numpy.where(
+        random_state.rand(num_bases) < MERGE_RATE,
+        random_state.randint(5, 30, num_bases), 100).astype('uint8')
+    qvs['SubstitutionQV'] = numpy.minimum(
+        random_state.geometric(0.08, num_bases) + 4, 40).astype('uint8')
+    return qvs
+
+def write_synthetic_cmph5(filename, num_aln_groups=4, num_reads=1000,
+                          read_length=1000, seed=0):
+    """Write a cmp.h5 file with the datasets qv_compress reads.
+
+    Each AlnGroup holds num_reads alignments of up to read_length bases,
+    separated by a base whose QVs are 0, with gaps in the reads marked by
+    QVs of 255.
+
+    Returns:
+        the total length of the QV datasets of all AlnGroups
+    """
+
+    random_state = numpy.random.RandomState(seed)
+    cmph5_file = h5py.File(filename, 'w')
+    aln_group_paths = []
+    aln_index = []
+    num_bases = 0
+
+    for aln_group_i in xrange(num_aln_groups):
+        aln_group_path = '/ref{r:06d}/movie{m}'.format(r=aln_group_i % 2 + 1,
+                                                      m=aln_group_i)
+        aln_group = cmph5_file.create_group(aln_group_path)
+
+        read_lengths = random_state.randint(read_length // 2, read_length + 1,
+                                            num_reads)
+        offsets = numpy.zeros(num_reads + 1, dtype='int64')
+        numpy.cumsum(read_lengths + 1, out=offsets[1:])
+        offsets += 1
+        aln_group_len = offsets[-1]
+
+        qvs = synthetic_qvs(aln_group_len, random_state)
+        gaps = random_state.rand(aln_group_len) < GAP_RATE
+        separators = numpy.append(0, offsets[1:] - 1)
+        for feature_name, values in qvs.items():
+            if feature_name != 'DeletionTag':
+                values[gaps] = 255
+            values[separators] = 0
+            aln_group.create_dataset(feature_name, data=values, chunks=True)
+        aln_group.create_dataset(
+            'AlnArray', data=random_state.randint(0, 256, aln_group_len)
+            .astype('uint8'), chunks=True)
+
+        for read_i in xrange(num_reads):
+            row = [0] * 22
+            row[0] = len(aln_index) + 1
+            row[1] = row[2] = aln_group_i + 1
+            row[3] = aln_group_i % 2 + 1
+            row[4] = read_i * 10
+            row[5] = read_i * 10 + read_lengths[read_i]
+            row[18] = offsets[read_i]
+            row[19] = offsets[read_i] + read_lengths[read_i]
+            aln_index.append(row)
+
+        aln_group_paths.append(aln_group_path)
+        num_bases += aln_group_len
+
+    cmph5_file['AlnGroup/Path'] = numpy.array(aln_group_paths)
+    cmph5_file['AlnGroup/ID'] = numpy.arange(1, num_aln_groups + 1,
+                                             dtype='uint32')
+    cmph5_file['AlnInfo/AlnIndex'] = numpy.array(aln_index, dtype='uint32')
+    cmph5_file['MovieInfo/ID'] = numpy.arange(1, num_aln_groups + 1,
+                                              dtype='uint32')
+    cmph5_file['MovieInfo/Name'] = numpy.array(
+        ['movie{m}'.format(m=k) for k in xrange(num_aln_groups)])
+    cmph5_file['RefGroup/ID'] = numpy.array([1, 2], dtype='uint32')
+    cmph5_file['RefGroup/Path'] = numpy.array(['/ref000001', '/ref000002'])
+    cmph5_file.close()
+
+    return num_bases
+
+def write_synthetic_sam(filename, num_reads=1000, read_length=1000,
+                        read_groups=('movie0',), seed=0):
+    """Write a SAM or BAM file of reads with the Quiver QV tags.
+
+    Reads are spread round-robin over read_groups.
+
+    Returns:
+        the total number of bases
+    """
+
+    random_state = numpy.random.RandomState(seed)
+    header = {'HD': {'VN': '1.4', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'ref000001', 'LN': 10 * num_reads + read_length}],
+              'RG': [{'ID': k} for k in read_groups]}
+    mode = 'wb' if filename.endswith(".bam") else 'wh'
+    sam_file = utils.open_sam_file(filename, mode, header=header)
+
+    read_lengths = random_state.randint(read_length // 2, read_length + 1,
+                                        num_reads)
+    for read_i in xrange(num_reads):
+        length = int(read_lengths[read_i])
+        record = pysam.AlignedSegment()
+        record.qname = 'read{r}'.format(r=read_i)
+        record.seq = BASES[random_state.randint(0, 4, length)].tostring()
+        record.flag = 0
+        record.tid = 0
+        record.pos = read_i * 10
+        record.mapq = 20
+        record.cigar = [(0, length)]
+
+        qvs = synthetic_qvs(length, random_state)
+        tags = [('RG', read_groups[read_i % len(read_groups)])]
+        for feature_name in utils.QUIVER_FEATURES:
+            values = qvs[feature_name]
+            if not feature_name.endswith("Tag"):
+                values = values + utils.CHAR_OFFSET
+            tags.append((utils.QUIVER_SAM_TAGS[feature_name], values.tostring()))
+        record.tags = tags
+        sam_file.write(record)
+
+    sam_file.close()
+    return int(read_lengths.sum())
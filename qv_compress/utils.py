@@ -1,7 +1,32 @@
 """Some utility methods for reading and modifying QVs in a cmp.h5 file."""
 import collections
-import h5py
+import distutils.version
+import importlib
+import logging
 import numpy 
+import os
+import time
+
+from qv_compress import metrics
+
+log = logging.getLogger('main')
+
+class LazyModule(object):
+    """Stand-in for a module that is only imported when one of its attributes
+    is first used, so that commands that don't need it start quickly.
+    """
+
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, name):
+        if self._module is None:
+            self._module = importlib.import_module(self._module_name)
+        return getattr(self._module, name)
+
+h5py = LazyModule('h5py')
+pysam = LazyModule('pysam')
 
 QUIVER_FEATURES = ('DeletionQV',
                    'DeletionTag',
@@ -24,6 +49,12 @@ TAG_ASSIGNMENTS = ((45, 0), # -
 
 CHAR_OFFSET = 33
 
+# Filename that means stdin or stdout for SAM and BAM files
+STREAM_FILENAME = '-'
+
+SAM_OUTPUT_FORMATS = ('bam', 'ubam', 'sam')
+
+
 def char_to_qv(char):
     """Converts a phred-encoded char to a numeric QV."""
     return ord(char) - CHAR_OFFSET
@@ -69,11 +100,11 @@ def remove_deletions_and_skips(ary, sentinel_index):
         sentinel_index: column of ary that will have the correct deletion and
             skip values. Usually this can be any column.
     """
-    skip_indices = numpy.where(ary[:, sentinel_index] == 0)[0]
-    del_indices = numpy.where(ary[:, sentinel_index] == 255)[0]
-    rows_to_del = numpy.concatenate((skip_indices, del_indices), 0)
+    sentinel = ary[:, sentinel_index]
+    keep = sentinel != 0
+    keep &= sentinel != 255
 
-    return numpy.delete(ary, rows_to_del, 0)
+    return ary[keep]
 
 
 def fix_mergeqv(ary, merge_index, new_extreme_value):
@@ -92,12 +123,170 @@ def fix_mergeqv(ary, merge_index, new_extreme_value):
 
     ary[:, merge_index][ary[:, merge_index] >= new_extreme_value] = 30
 
-def cmph5_chunker(cmph5_filename, feature_list, chunk_size, max_observations=None):
+def pack_rows(ary):
+    """Pack each row of an array of uint8 values into a single int64 key.
+    Rows of up to eight features can be packed.
+    """
+    ary = numpy.asarray(ary).astype('int64')
+    keys = numpy.zeros(ary.shape[0], dtype='int64')
+    for column_i in xrange(ary.shape[1]):
+        keys |= ary[:, column_i] << (8 * column_i)
+    return keys
+
+def unpack_rows(keys, num_columns):
+    """Convert keys made by pack_rows back into rows of uint8 values."""
+    ary = numpy.zeros((len(keys), num_columns), dtype='uint8')
+    for column_i in xrange(num_columns):
+        ary[:, column_i] = (keys >> (8 * column_i)) & 0xff
+    return ary
+
+def count_unique_rows(batches, num_columns):
+    """Collapse batches of uint8 rows into the distinct rows and the number
+    of times each occurs. Only the distinct rows are kept in memory, so the
+    batches can cover a whole file.
+
+    Returns:
+        unique_rows: uint8 numpy array of the distinct rows
+        counts: int64 numpy array of the count of each row
+    """
+    keys = numpy.zeros(0, dtype='int64')
+    counts = numpy.zeros(0, dtype='int64')
+
+    for batch in batches:
+        batch_keys, batch_counts = numpy.unique(pack_rows(batch),
+                                                return_counts=True)
+        keys, inverse = numpy.unique(numpy.concatenate((keys, batch_keys)),
+                                     return_inverse=True)
+        counts = numpy.bincount(
+            inverse, weights=numpy.concatenate((counts, batch_counts)),
+            minlength=len(keys)).astype('int64')
+
+    return unpack_rows(keys, num_columns), counts
+
+# Columns of AlnInfo/AlnIndex
+ALN_ID = 0
+ALN_GROUP_ID = 1
+MOVIE_ID = 2
+REF_GROUP_ID = 3
+T_START = 4
+T_END = 5
+OFFSET_BEGIN = 18
+OFFSET_END = 19
+
+CmpH5Chunk = collections.namedtuple(
+    'CmpH5Chunk', 'aln_group_path aln_group_start aln_group_end data')
+
+def cmph5_chunk_ranges(cmph5_file, feature_list, chunk_size, max_observations=None):
+    """Generator function for the ranges of a cmp.h5 file that cmph5_chunker
+    reads, without reading any data.
+
+    Args:
+        cmph5_file: an open h5py.File
+        feature_list: list of features that will be read from the cmph5 file
+        chunk_size: the number of aligned bases in each range
+        max_observations: stop after this many bases. If None, go until the
+            end of the file
+
+    Yields:
+        CmpH5Chunk tuples with data set to None
+    """
+
+    total_rows = 0
+
+    for aln_group_path in cmph5_file['AlnGroup/Path']:
+        aln_group_pos = 0
+        aln_group_len = len(cmph5_file[aln_group_path][feature_list[0]])
+
+        while aln_group_pos < aln_group_len:
+            num_rows_to_read = min(aln_group_len - aln_group_pos, chunk_size)
+            yield CmpH5Chunk(aln_group_path, aln_group_pos,
+                             aln_group_pos + num_rows_to_read, None)
+
+            aln_group_pos += num_rows_to_read
+            total_rows += num_rows_to_read
+
+            if max_observations is not None and total_rows >= max_observations:
+                return
+
+def read_cmph5_chunk(cmph5_file, chunk_range, feature_list, out=None,
+                     dtype='uint8'):
+    """Read the data for a range produced by cmph5_chunk_ranges.
+
+    Each feature is read straight from HDF5 into its column of the output,
+    with no intermediate arrays. Reads are much faster when the columns are
+    contiguous, so arrays are allocated in Fortran order.
+
+    Args:
+        cmph5_file: an open h5py.File
+        chunk_range: a CmpH5Chunk, usually from cmph5_chunk_ranges
+        feature_list: list of features to read
+        out: optional array with at least as many rows as the range and one
+            column per feature. If given, the data is a view of out.
+        dtype: the type of the array allocated when out is None
+
+    Returns:
+        a copy of chunk_range with the data filled in
+    """
+
+    num_rows = chunk_range.aln_group_end - chunk_range.aln_group_start
+    if out is None:
+        out = numpy.empty((num_rows, len(feature_list)), dtype=dtype,
+                          order='F')
+
+    aln_group = cmph5_file[chunk_range.aln_group_path]
+    source_sel = numpy.s_[chunk_range.aln_group_start:chunk_range.aln_group_end]
+    with metrics.stage("hdf5_read", num_rows,
+                       num_rows * len(feature_list) * out.itemsize):
+        for feature_i, feature_name in enumerate(feature_list):
+            column = out[:num_rows, feature_i]
+            if column.flags.c_contiguous:
+                aln_group[feature_name].read_direct(column, source_sel)
+            else:
+                aln_group[feature_name].read_direct(
+                    out, source_sel, numpy.s_[:num_rows, feature_i])
+
+    return chunk_range._replace(data=out[:num_rows])
+
+def cmph5_aln_group_movies(cmph5_file):
+    """Find the movie the alignments of each AlnGroup of a cmp.h5 come from,
+    using the AlnGroupID and MovieID columns of the AlnIndex.
+
+    Returns:
+        dict from AlnGroup path to movie name. AlnGroups with no alignments
+        are left out.
+
+    Raises:
+        ValueError: if an AlnGroup holds alignments from more than one movie
+    """
+
+    aln_index = cmph5_file['AlnInfo/AlnIndex'][:]
+    aln_group_paths = dict(zip(cmph5_file['AlnGroup/ID'][:].tolist(),
+                               [str(k) for k in cmph5_file['AlnGroup/Path']]))
+    movie_names = dict(zip(cmph5_file['MovieInfo/ID'][:].tolist(),
+                           [str(k) for k in cmph5_file['MovieInfo/Name']]))
+
+    pairs = numpy.unique((aln_index[:, ALN_GROUP_ID].astype('int64') << 32) |
+                         aln_index[:, MOVIE_ID].astype('int64'))
+    movies = {}
+    for aln_group_id, movie_id in zip((pairs >> 32).tolist(),
+                                      (pairs & 0xffffffff).tolist()):
+        aln_group_path = aln_group_paths[aln_group_id]
+        if aln_group_path in movies:
+            raise ValueError("AlnGroup {a} holds alignments from more than "
+                             "one movie".format(a=aln_group_path))
+        movies[aln_group_path] = movie_names[movie_id]
+    return movies
+
+def cmph5_chunker(cmph5_filename, feature_list, chunk_size, max_observations=None,
+                  dtype='uint8'):
     """Generator function for reading through a cmp.h5 file in chunks
     and producing appropriately shaped arrays for kmeans. Note that the size
     of the returned chunk will be smaller than chunk_size if the chunk
     would extend past the end of an alignment group.
 
+    Every chunk is read into the same buffer, so the data of a chunk is
+    only valid until the next one is read. Copy it to keep it longer.
+
     Args:
         cmph5_filename: path to a cmph5 file
         feature_list: list of features to read from the cmph5 file. Usually
@@ -105,40 +294,173 @@ def cmph5_chunker(cmph5_filename, feature_list, chunk_size, max_observations=Non
         chunk_size: the number of aligned bases to read at a time
         max_observations: stop after reading this many bases. If None, just
             read until the end of the file
+        dtype: the type of the data arrays. The QVs are uint8 in the file.
 
     Yields:
         Tuples of (aln_group_path, aln_group_start, aln_group_end, data)
     """
 
     cmph5_file = h5py.File(cmph5_filename, 'r')
-    aln_group_paths = cmph5_file['AlnGroup/Path']
-    CmpH5Chunk = collections.namedtuple(
-        'CmpH5Chunk', 'aln_group_path aln_group_start aln_group_end data')
-    total_rows = 0
+    output_data = numpy.empty((chunk_size, len(feature_list)), dtype=dtype,
+                              order='F')
 
-    for aln_group_path in aln_group_paths:
-        output_data = numpy.zeros(shape=(chunk_size, len(feature_list)))
-        aln_group_pos = 0
-        aln_group = cmph5_file[aln_group_path]
-        aln_group_len = len(aln_group[feature_list[0]])
+    for chunk_range in cmph5_chunk_ranges(cmph5_file, feature_list, chunk_size,
+                                          max_observations):
+        yield read_cmph5_chunk(cmph5_file, chunk_range, feature_list,
+                               out=output_data)
 
-        while aln_group_pos < aln_group_len:
-            num_rows_to_read = min(aln_group_len - aln_group_pos, chunk_size)
-            for feature_i in xrange(len(feature_list)):
-                feature_name = feature_list[feature_i]
-                output_data[:num_rows_to_read, feature_i] = (
-                    aln_group[feature_name][aln_group_pos:
-                                            aln_group_pos + num_rows_to_read])
-
-            if num_rows_to_read < chunk_size:
-                output_data = numpy.resize(output_data, (num_rows_to_read, len(feature_list)))
-            yield CmpH5Chunk(aln_group_path, aln_group_pos,
-                             aln_group_pos + num_rows_to_read, output_data)
+def sam_tag_to_array(values, feature_name):
+    """Convert a SAM tag string of QVs or tags to a uint8 numpy array in one
+    step. QVs are phred-encoded, while tags are stored as their ASCII values.
+    """
+    numeric_values = numpy.fromstring(values, dtype='uint8')
+    if not feature_name.endswith("Tag"):
+        numeric_values -= CHAR_OFFSET
+    return numeric_values
 
-            aln_group_pos += num_rows_to_read
-            total_rows += num_rows_to_read
+def sam_chunker(sam_file, feature_list, chunk_size):
+    """Generator function for reading through a SAM or BAM file in batches
+    of records. Each batch holds whole records and contains at least
+    chunk_size bases, unless the end of the file was reached.
 
-            if max_observations is not None and total_rows >= max_observations:
-                raise StopIteration
+    Args:
+        sam_file: an open pysam.Samfile
+        feature_list: list of features to read from each record
+        chunk_size: the minimum number of bases to collect in a batch
+            before yielding it
+
+    Yields:
+        Tuples of (records, offsets, data). offsets has one more entry than
+        records, so that the bases of records[i] are in
+        data[offsets[i]:offsets[i + 1]]. data is a uint8 numpy array with
+        one column per feature.
+    """
+
+    SamChunk = collections.namedtuple('SamChunk', 'records offsets data')
+    sam_tags = [QUIVER_SAM_TAGS[k] for k in feature_list]
+
+    records = []
+    tag_strings = [[] for _ in feature_list]
+    num_bases = 0
+    batch_start_time = time.time()
+
+    for record in sam_file:
+        records.append(record)
+        for feature_i, sam_tag in enumerate(sam_tags):
+            tag_strings[feature_i].append(record.opt(sam_tag))
+        num_bases += len(tag_strings[0][-1])
+
+        if num_bases >= chunk_size:
+            sam_chunk = _make_sam_chunk(SamChunk, records, tag_strings,
+                                        feature_list)
+            metrics.record("sam_read", time.time() - batch_start_time,
+                           num_bases, sam_chunk.data.nbytes)
+            yield sam_chunk
+            records = []
+            tag_strings = [[] for _ in feature_list]
+            num_bases = 0
+            batch_start_time = time.time()
+
+    if records:
+        sam_chunk = _make_sam_chunk(SamChunk, records, tag_strings, feature_list)
+        metrics.record("sam_read", time.time() - batch_start_time, num_bases,
+                       sam_chunk.data.nbytes)
+        yield sam_chunk
+
+def _make_sam_chunk(chunk_type, records, tag_strings, feature_list):
+    """Pack the tag strings of a batch of records into one contiguous array."""
+
+    offsets = numpy.zeros(len(records) + 1, dtype='int64')
+    numpy.cumsum([len(k) for k in tag_strings[0]], out=offsets[1:])
+
+    data = numpy.empty((offsets[-1], len(feature_list)), dtype='uint8')
+    for feature_i, feature_name in enumerate(feature_list):
+        data[:, feature_i] = sam_tag_to_array(''.join(tag_strings[feature_i]),
+                                              feature_name)
+    return chunk_type(records, offsets, data)
+
+def pysam_has_threads():
+    """pysam gained multi-threaded BGZF compression and decompression in 0.14"""
+    return (distutils.version.LooseVersion(pysam.__version__) >=
+            distutils.version.LooseVersion("0.14"))
+
+def pysam_has_compression_levels():
+    """Whether the installed pysam takes a BGZF compression level in the mode
+    of a BAM it writes, like 'wb5'. Older versions only know 'wb' and 'wbu'.
+    """
+    try:
+        sam_file = pysam.Samfile(os.devnull, 'wb1',
+                                 header={'HD': {'VN': '1.0'}})
+    except (AssertionError, ValueError):
+        return False
+    sam_file.close()
+    return True
+
+def open_sam_file(filename, mode='r', threads=1, **kwargs):
+    """Open a SAM or BAM file with pysam, using threads for BGZF compression
+    and decompression when the installed pysam supports it.
+    """
+    if threads > 1 and pysam_has_threads():
+        kwargs['threads'] = threads
+    return pysam.Samfile(filename, mode, **kwargs)
+
+def is_sam_filename(filename):
+    """Whether filename names a SAM or BAM file, or a stream of one."""
+    return (filename == STREAM_FILENAME or filename.endswith(".sam") or
+            filename.endswith(".bam"))
+
+def sam_output_mode(output_filename, output_format=None,
+                    compression_level=None):
+    """Return the pysam mode for writing a SAM or BAM file.
+
+    Args:
+        output_filename: the file to write, or '-' for stdout
+        output_format: 'bam', 'ubam' for uncompressed BAM, or 'sam'. If None,
+            it's 'sam' for a .sam file and 'bam' otherwise.
+        compression_level: BGZF compression level from 0 to 9 for BAM output.
+            If None, the htslib default is used.
+    """
+
+    if output_format is None:
+        output_format = 'sam' if output_filename.endswith(".sam") else 'bam'
+
+    if output_format == 'sam':
+        return 'wh'
+    elif output_format == 'ubam' or compression_level == 0:
+        return 'wbu'
+    elif compression_level is None:
+        return 'wb'
+    return 'wb{c}'.format(c=compression_level)
+
+def open_sam_output(output_filename, header, output_format=None,
+                    compression_level=None, threads=1):
+    """Open a SAM or BAM file, or stdout, for writing in the mode chosen by
+    sam_output_mode.
+
+    Raises:
+        ValueError: if compression_level is from 1 to 9 and the installed
+            pysam can't set it, see pysam_has_compression_levels
+    """
+
+    mode = sam_output_mode(output_filename, output_format, compression_level)
+    if (mode not in ('wb', 'wbu', 'wh') and
+            not pysam_has_compression_levels()):
+        raise ValueError("pysam {v} can't set a BAM compression level other "
+                         "than 0".format(v=pysam.__version__))
+    return open_sam_file(output_filename, mode, threads, header=header)
+
+def sam_num_reads(sam_file):
+    """Return the number of reads in an indexed BAM file from its index, or
+    None if it has no index.
+    """
+    try:
+        return sam_file.mapped + sam_file.unmapped
+    except (AttributeError, ValueError):
+        return None
 
-            output_data = numpy.zeros(shape=(chunk_size, len(feature_list)))
+def sam_header_dict(sam_file):
+    """Return the header of an open pysam.Samfile as a dict."""
+    header = sam_file.header
+    if not isinstance(header, dict):
+        header = header.to_dict()
+    return header
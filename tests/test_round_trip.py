@@ -0,0 +1,226 @@
+"""Round trip tests of encode and decode on synthetic cmp.h5 and BAM files.
+
+Run with python -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy
+import pysam
+
+from qv_compress import code_book, decode, quantize, synthetic, utils
+
+FEATURES = list(utils.QUIVER_FEATURES)
+
+class Interrupted(Exception):
+    """Raised to stop an encode part way through."""
+
+def read_aln_groups(filename, dataset_names):
+    """Return a dict from (AlnGroup path, dataset name) to the values of
+    that dataset, for every AlnGroup that has it.
+    """
+
+    cmph5_file = h5py.File(filename, 'r')
+    datasets = {}
+    for aln_group_path in cmph5_file['AlnGroup/Path']:
+        for dataset_name in dataset_names:
+            if dataset_name in cmph5_file[aln_group_path]:
+                datasets[aln_group_path, dataset_name] = \
+                    cmph5_file[aln_group_path][dataset_name][...]
+    cmph5_file.close()
+    return datasets
+
+def read_records(filename):
+    """Return the records of a SAM or BAM file as SAM text lines."""
+
+    sam_file = pysam.Samfile(filename)
+    records = [str(k) for k in sam_file]
+    sam_file.close()
+    return records
+
+def read_record_tags(filename):
+    """Return a list of dicts of the tags of each record of a SAM or BAM."""
+
+    sam_file = pysam.Samfile(filename)
+    record_tags = [dict(k.tags) for k in sam_file]
+    sam_file.close()
+    return record_tags
+
+class RoundTripTestCase(unittest.TestCase):
+    """Writes synthetic files and a code book trained on them to a temporary
+    directory.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="qv_compress_test")
+        self.cmph5_filename = self.work_file("base.cmp.h5")
+        self.bam_filename = self.work_file("base.bam")
+        self.code_book_filename = self.work_file("code_book.npz")
+
+        synthetic.write_synthetic_cmph5(self.cmph5_filename, num_aln_groups=3,
+                                        num_reads=60, read_length=400)
+        synthetic.write_synthetic_sam(self.bam_filename, num_reads=300,
+                                      read_length=400)
+
+        raw_codes, feature_list, std_dev = code_book.create_code_book(
+            self.cmph5_filename, 16, 20000, seed=0)
+        code_book.write_code_book(self.code_book_filename, raw_codes,
+                                  feature_list, std_dev)
+        self.raw_codes, self.feature_list, self.std_dev = \
+            quantize.load_code_book(self.code_book_filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def work_file(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def copy_cmph5(self, name):
+        filename = self.work_file(name)
+        shutil.copy(self.cmph5_filename, filename)
+        return filename
+
+    def expected_qvs(self, data):
+        """The QVs the code book decodes data to, one column per feature."""
+
+        assign_codes = quantize.make_code_assigner(
+            self.raw_codes, self.feature_list, std_dev=self.std_dev)
+        return self.raw_codes.astype('uint8')[assign_codes(data)]
+
+class CmpH5RoundTripTest(RoundTripTestCase):
+
+    def test_workers_and_pipeline_match_serial(self):
+        outputs = {}
+        for name, workers, pipeline in (('serial', 1, False),
+                                        ('workers', 2, False),
+                                        ('pipeline', 1, True)):
+            filename = self.copy_cmph5(name + ".cmp.h5")
+            quantize.add_vqs_to_file(filename, self.code_book_filename,
+                                     overwrite_qvs=True, workers=workers,
+                                     pipeline=pipeline)
+            outputs[name] = read_aln_groups(filename, ['VQ'] + FEATURES)
+
+        self.assertEqual(len(outputs['serial']), 3 * (len(FEATURES) + 1))
+        for name in ('workers', 'pipeline'):
+            self.assertEqual(sorted(outputs[name]), sorted(outputs['serial']))
+            for key, values in outputs['serial'].items():
+                numpy.testing.assert_array_equal(outputs[name][key], values,
+                                                 err_msg=name + str(key))
+
+    def test_decode_restores_qvs_and_deletion_tag(self):
+        original = read_aln_groups(self.cmph5_filename, FEATURES)
+        filename = self.copy_cmph5("encoded.cmp.h5")
+        quantize.add_vqs_to_file(filename, self.code_book_filename,
+                                 rle_deltag=True)
+        self.assertNotIn("DeletionTag", h5py.File(filename, 'r')[
+            '/ref000001/movie0'])
+
+        decode.decode_file(filename, self.code_book_filename)
+        decoded = read_aln_groups(filename, FEATURES)
+
+        for aln_group_path in set(k[0] for k in original):
+            data = numpy.column_stack([original[aln_group_path, k]
+                                       for k in self.feature_list])
+            expected = self.expected_qvs(data)
+            for feature_i, feature_name in enumerate(self.feature_list):
+                if feature_name == "DeletionTag":
+                    continue
+                numpy.testing.assert_array_equal(
+                    decoded[aln_group_path, feature_name],
+                    expected[:, feature_i])
+            numpy.testing.assert_array_equal(
+                decoded[aln_group_path, "DeletionTag"],
+                original[aln_group_path, "DeletionTag"])
+
+    def test_resume_after_interrupted_encode(self):
+        filename = self.copy_cmph5("interrupted.cmp.h5")
+        buffer_size = quantize.BUFFER_SIZE
+        write_vqs = quantize.write_vqs_to_cmph5
+        num_writes = [0]
+
+        def interrupting_write_vqs(*args):
+            if num_writes[0] == 5:
+                raise Interrupted()
+            num_writes[0] += 1
+            write_vqs(*args)
+
+        quantize.BUFFER_SIZE = 4096
+        quantize.write_vqs_to_cmph5 = interrupting_write_vqs
+        try:
+            self.assertRaises(Interrupted, quantize.add_vqs_to_file, filename,
+                              self.code_book_filename, overwrite_qvs=True)
+        finally:
+            quantize.write_vqs_to_cmph5 = write_vqs
+        try:
+            quantize.add_vqs_to_file(filename, self.code_book_filename,
+                                     overwrite_qvs=True)
+        finally:
+            quantize.BUFFER_SIZE = buffer_size
+
+        uninterrupted = self.copy_cmph5("uninterrupted.cmp.h5")
+        quantize.add_vqs_to_file(uninterrupted, self.code_book_filename,
+                                 overwrite_qvs=True)
+
+        resumed = read_aln_groups(filename, ['VQ'] + FEATURES)
+        expected = read_aln_groups(uninterrupted, ['VQ'] + FEATURES)
+        self.assertEqual(sorted(resumed), sorted(expected))
+        for key, values in expected.items():
+            numpy.testing.assert_array_equal(resumed[key], values,
+                                             err_msg=str(key))
+
+class SamRoundTripTest(RoundTripTestCase):
+
+    def test_sharded_bam_matches_serial(self):
+        serial_filename = self.work_file("serial.bam")
+        quantize.add_vqs_to_file(self.bam_filename, self.code_book_filename,
+                                 output_filename=serial_filename,
+                                 rle_deltag=True)
+        serial = read_records(serial_filename)
+        self.assertEqual(len(serial), 300)
+        self.assertGreater(len(quantize.bam_shard_ranges(self.bam_filename,
+                                                         12)), 1)
+
+        for workers in (2, 3):
+            sharded_filename = self.work_file(
+                "sharded{w}.bam".format(w=workers))
+            quantize.add_vqs_to_file(self.bam_filename,
+                                     self.code_book_filename,
+                                     output_filename=sharded_filename,
+                                     rle_deltag=True, workers=workers)
+            self.assertEqual(read_records(sharded_filename), serial)
+
+    def test_decode_restores_qvs_and_deletion_tag(self):
+        encoded_filename = self.work_file("encoded.bam")
+        decoded_filename = self.work_file("decoded.sam")
+        quantize.add_vqs_to_file(self.bam_filename, self.code_book_filename,
+                                 output_filename=encoded_filename,
+                                 rle_deltag=True)
+        decode.decode_file(encoded_filename, output_filename=decoded_filename)
+
+        original = read_record_tags(self.bam_filename)
+        decoded = read_record_tags(decoded_filename)
+        self.assertEqual(len(decoded), len(original))
+        deltag = utils.QUIVER_SAM_TAGS["DeletionTag"]
+
+        for original_tags, decoded_tags in zip(original, decoded):
+            self.assertNotIn('dr', decoded_tags)
+            self.assertEqual(decoded_tags[deltag], original_tags[deltag])
+
+            data = numpy.column_stack([
+                utils.sam_tag_to_array(original_tags[utils.QUIVER_SAM_TAGS[k]],
+                                       k) for k in self.feature_list])
+            expected = self.expected_qvs(data)
+            for feature_i, feature_name in enumerate(self.feature_list):
+                if feature_name == "DeletionTag":
+                    continue
+                sam_tag = utils.QUIVER_SAM_TAGS[feature_name]
+                numpy.testing.assert_array_equal(
+                    utils.sam_tag_to_array(decoded_tags[sam_tag],
+                                           feature_name),
+                    expected[:, feature_i])
+
+if __name__ == '__main__':
+    unittest.main()